@@ -59,21 +59,92 @@ CREATE TABLE IF NOT EXISTS notification_registrations (
     PRIMARY KEY(toshi_id, service, registration_id, eth_address)
 );
 
-CREATE TABLE IF NOT EXISTS filter_registrations (
-    filter_id VARCHAR,
-    registration_id VARCHAR,
-    contract_address VARCHAR,
-    topic_id VARCHAR,
-    topic VARCHAR,
-
-    PRIMARY KEY (filter_id),
-    UNIQUE (registration_id, contract_address, topic_id)
-);
-
 CREATE TABLE IF NOT EXISTS last_blocknumber (
     blocknumber INTEGER
 );
 
+-- running totals of pending transaction values per address, kept up to date
+-- by the trigger on the transactions table. confirmed transactions are kept
+-- (keyed by their block number) until the block monitor has processed the block
+CREATE TABLE IF NOT EXISTS pending_balances (
+    eth_address VARCHAR NOT NULL,
+    status transaction_status NOT NULL,
+    -- 0 for transactions that are not confirmed yet
+    blocknumber BIGINT NOT NULL DEFAULT 0,
+
+    pending_sent NUMERIC NOT NULL DEFAULT 0,
+    pending_received NUMERIC NOT NULL DEFAULT 0,
+
+    PRIMARY KEY (eth_address, status, blocknumber)
+);
+
+CREATE OR REPLACE FUNCTION hex_to_numeric(hex VARCHAR) RETURNS NUMERIC AS $$
+DECLARE
+    result NUMERIC := 0;
+    digits VARCHAR;
+BEGIN
+    IF hex IS NULL THEN
+        RETURN 0;
+    END IF;
+    digits := lower(hex);
+    IF left(digits, 2) = '0x' THEN
+        digits := substr(digits, 3);
+    END IF;
+    FOR i IN 1..length(digits) LOOP
+        result := result * 16 + (strpos('0123456789abcdef', substr(digits, i, 1)) - 1);
+    END LOOP;
+    RETURN result;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION update_pending_balances() RETURNS TRIGGER AS $$
+DECLARE
+    last_block BIGINT;
+BEGIN
+    IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+        IF OLD.status != 'error' AND (OLD.status != 'confirmed' OR OLD.blocknumber IS NOT NULL) THEN
+            -- rows for confirmed transactions may already have been cleaned up
+            -- by the block monitor, in which case there's nothing to subtract
+            UPDATE pending_balances
+            SET pending_sent = pending_sent - (hex_to_numeric(OLD.value) + hex_to_numeric(OLD.gas) * hex_to_numeric(OLD.gas_price))
+            WHERE eth_address = OLD.from_address AND status = OLD.status
+            AND blocknumber = CASE WHEN OLD.status = 'confirmed' THEN OLD.blocknumber ELSE 0 END;
+            UPDATE pending_balances
+            SET pending_received = pending_received - hex_to_numeric(OLD.value)
+            WHERE eth_address = OLD.to_address AND status = OLD.status
+            AND blocknumber = CASE WHEN OLD.status = 'confirmed' THEN OLD.blocknumber ELSE 0 END;
+            DELETE FROM pending_balances
+            WHERE (eth_address = OLD.from_address OR eth_address = OLD.to_address) AND status = OLD.status
+            AND blocknumber = CASE WHEN OLD.status = 'confirmed' THEN OLD.blocknumber ELSE 0 END
+            AND pending_sent = 0 AND pending_received = 0;
+        END IF;
+    END IF;
+    IF TG_OP = 'UPDATE' OR TG_OP = 'INSERT' THEN
+        SELECT blocknumber INTO last_block FROM last_blocknumber;
+        -- confirmed transactions in blocks that have already been processed are
+        -- included in the balance returned by the node
+        IF NEW.status != 'error' AND (NEW.status != 'confirmed' OR NEW.blocknumber > COALESCE(last_block, 0)) THEN
+            INSERT INTO pending_balances (eth_address, status, blocknumber, pending_sent)
+            VALUES (NEW.from_address, NEW.status, CASE WHEN NEW.status = 'confirmed' THEN NEW.blocknumber ELSE 0 END,
+                    hex_to_numeric(NEW.value) + hex_to_numeric(NEW.gas) * hex_to_numeric(NEW.gas_price))
+            ON CONFLICT (eth_address, status, blocknumber) DO UPDATE
+            SET pending_sent = pending_balances.pending_sent + EXCLUDED.pending_sent;
+            INSERT INTO pending_balances (eth_address, status, blocknumber, pending_received)
+            VALUES (NEW.to_address, NEW.status, CASE WHEN NEW.status = 'confirmed' THEN NEW.blocknumber ELSE 0 END,
+                    hex_to_numeric(NEW.value))
+            ON CONFLICT (eth_address, status, blocknumber) DO UPDATE
+            SET pending_received = pending_balances.pending_received + EXCLUDED.pending_received;
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trigger_update_pending_balances
+AFTER INSERT OR DELETE OR UPDATE OF status, blocknumber, from_address, to_address, value, gas, gas_price
+ON transactions
+FOR EACH ROW EXECUTE PROCEDURE update_pending_balances();
+
 CREATE TABLE IF NOT EXISTS tokens (
     contract_address VARCHAR PRIMARY KEY, -- contract address
     symbol VARCHAR, -- currency symbol
@@ -88,6 +159,26 @@ CREATE TABLE IF NOT EXISTS tokens (
     last_modified TIMESTAMP WITHOUT TIME ZONE DEFAULT (now() AT TIME ZONE 'utc')
 );
 
+-- bumped every time the tokens table changes, so that the token list
+-- only needs to be rebuilt when something has actually changed
+CREATE TABLE IF NOT EXISTS token_list_version (
+    version BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO token_list_version (version) VALUES (0);
+
+CREATE OR REPLACE FUNCTION bump_token_list_version() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE token_list_version SET version = version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trigger_bump_token_list_version
+AFTER INSERT OR DELETE OR UPDATE OR TRUNCATE
+ON tokens
+FOR EACH STATEMENT EXECUTE PROCEDURE bump_token_list_version();
+
 CREATE TABLE IF NOT EXISTS token_balances (
     contract_address VARCHAR,
     eth_address VARCHAR,
@@ -201,6 +292,16 @@ CREATE TABLE IF NOT EXISTS fungible_collectible_balances (
     PRIMARY KEY (contract_address, owner_address)
 );
 
+-- number of tokens (or ready fungible assets) of each collectible
+-- held by each owner, maintained by the collectible managers
+CREATE TABLE IF NOT EXISTS collectible_owner_summaries (
+    owner_address VARCHAR,
+    collectible_address VARCHAR,
+    value BIGINT NOT NULL DEFAULT 0,
+
+    PRIMARY KEY (owner_address, collectible_address)
+);
+
 CREATE TABLE IF NOT EXISTS from_address_gas_price_whitelist (
     address VARCHAR PRIMARY KEY
 );
@@ -209,12 +310,33 @@ CREATE TABLE IF NOT EXISTS to_address_gas_price_whitelist (
     address VARCHAR PRIMARY KEY
 );
 
+-- notifies the web processes to reload their copies of the gas price
+-- whitelists every time one of them changes
+CREATE OR REPLACE FUNCTION notify_gas_price_whitelist_changed() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('gas_price_whitelist_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trigger_notify_from_address_gas_price_whitelist_changed
+AFTER INSERT OR DELETE OR UPDATE OR TRUNCATE
+ON from_address_gas_price_whitelist
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_gas_price_whitelist_changed();
+
+CREATE TRIGGER trigger_notify_to_address_gas_price_whitelist_changed
+AFTER INSERT OR DELETE OR UPDATE OR TRUNCATE
+ON to_address_gas_price_whitelist
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_gas_price_whitelist_changed();
+
 CREATE INDEX IF NOT EXISTS idx_transactions_hash ON transactions (hash);
 CREATE INDEX IF NOT EXISTS idx_transactions_hash_by_id_sorted ON transactions (hash, transaction_id DESC);
 
 CREATE INDEX IF NOT EXISTS idx_transactions_from_address_updated ON transactions (from_address, updated NULLS FIRST);
 CREATE INDEX IF NOT EXISTS idx_transactions_to_address_updated ON transactions (to_address, updated NULLS FIRST);
 CREATE INDEX IF NOT EXISTS idx_transactions_from_address_nonce ON transactions (from_address, nonce DESC);
+CREATE INDEX IF NOT EXISTS idx_transactions_from_address_created_transaction_id ON transactions (from_address, created, transaction_id);
+CREATE INDEX IF NOT EXISTS idx_transactions_to_address_created_transaction_id ON transactions (to_address, created, transaction_id);
 
 CREATE INDEX IF NOT EXISTS idx_transactions_from_address_status_blocknumber_desc ON transactions (from_address, status, blocknumber DESC NULLS FIRST);
 CREATE INDEX IF NOT EXISTS idx_transactions_to_address_status_blocknumber_desc ON transactions (to_address, status, blocknumber DESC NULLS FIRST);
@@ -223,9 +345,7 @@ CREATE INDEX IF NOT EXISTS idx_notification_registrations_eth_address ON notific
 
 CREATE INDEX IF NOT EXISTS idx_transactions_status_v_created ON transactions (status NULLS FIRST, v NULLS LAST, created DESC);
 CREATE INDEX IF NOT EXISTS idx_transactions_created ON transactions (created);
-
-CREATE INDEX IF NOT EXISTS idx_filter_registrations_contract_address_topic ON filter_registrations (contract_address, topic_id);
-CREATE INDEX IF NOT EXISTS idx_filter_registrations_filter_id_registration_id ON filter_registrations (filter_id, registration_id);
+CREATE INDEX IF NOT EXISTS idx_transactions_updated ON transactions (updated);
 
 CREATE INDEX IF NOT EXISTS idx_tokens_contract_address ON tokens (contract_address);
 CREATE INDEX IF NOT EXISTS idx_token_registrations_last_queried ON token_registrations (last_queried ASC);
@@ -237,9 +357,13 @@ CREATE INDEX IF NOT EXISTS idx_token_balance_eth_address_visibility_balance ON t
 CREATE INDEX IF NOT EXISTS idx_collectible_transfer_events_collectible_address ON collectible_transfer_events (collectible_address);
 
 CREATE INDEX IF NOT EXISTS idx_collectible_transfer_logs_transaction_hash ON collectible_transfer_logs (transaction_hash);
+CREATE INDEX IF NOT EXISTS idx_collectible_tokens_contract_address_owner_address ON collectible_tokens (contract_address, owner_address);
+CREATE INDEX IF NOT EXISTS idx_fungible_collectible_balances_owner_address ON fungible_collectible_balances (owner_address);
 
 CREATE INDEX IF NOT EXISTS idx_block_blocknumber_desc ON blocks (blocknumber DESC);
 CREATE INDEX IF NOT EXISTS idx_block_hash ON blocks (hash);
 CREATE INDEX IF NOT EXISTS idx_block_parent_hash ON blocks (parent_hash);
 
-UPDATE database_version SET version_number = 25;
+CREATE INDEX IF NOT EXISTS idx_pending_balances_blocknumber ON pending_balances (blocknumber);
+
+UPDATE database_version SET version_number = 32;
@@ -0,0 +1,99 @@
+-- running totals of pending transaction values per address, kept up to date
+-- by the trigger on the transactions table. confirmed transactions are kept
+-- (keyed by their block number) until the block monitor has processed the block
+CREATE TABLE IF NOT EXISTS pending_balances (
+    eth_address VARCHAR NOT NULL,
+    status transaction_status NOT NULL,
+    -- 0 for transactions that are not confirmed yet
+    blocknumber BIGINT NOT NULL DEFAULT 0,
+
+    pending_sent NUMERIC NOT NULL DEFAULT 0,
+    pending_received NUMERIC NOT NULL DEFAULT 0,
+
+    PRIMARY KEY (eth_address, status, blocknumber)
+);
+
+CREATE OR REPLACE FUNCTION hex_to_numeric(hex VARCHAR) RETURNS NUMERIC AS $$
+DECLARE
+    result NUMERIC := 0;
+    digits VARCHAR;
+BEGIN
+    IF hex IS NULL THEN
+        RETURN 0;
+    END IF;
+    digits := lower(hex);
+    IF left(digits, 2) = '0x' THEN
+        digits := substr(digits, 3);
+    END IF;
+    FOR i IN 1..length(digits) LOOP
+        result := result * 16 + (strpos('0123456789abcdef', substr(digits, i, 1)) - 1);
+    END LOOP;
+    RETURN result;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION update_pending_balances() RETURNS TRIGGER AS $$
+DECLARE
+    last_block BIGINT;
+BEGIN
+    IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+        IF OLD.status != 'error' AND (OLD.status != 'confirmed' OR OLD.blocknumber IS NOT NULL) THEN
+            -- rows for confirmed transactions may already have been cleaned up
+            -- by the block monitor, in which case there's nothing to subtract
+            UPDATE pending_balances
+            SET pending_sent = pending_sent - (hex_to_numeric(OLD.value) + hex_to_numeric(OLD.gas) * hex_to_numeric(OLD.gas_price))
+            WHERE eth_address = OLD.from_address AND status = OLD.status
+            AND blocknumber = CASE WHEN OLD.status = 'confirmed' THEN OLD.blocknumber ELSE 0 END;
+            UPDATE pending_balances
+            SET pending_received = pending_received - hex_to_numeric(OLD.value)
+            WHERE eth_address = OLD.to_address AND status = OLD.status
+            AND blocknumber = CASE WHEN OLD.status = 'confirmed' THEN OLD.blocknumber ELSE 0 END;
+            DELETE FROM pending_balances
+            WHERE (eth_address = OLD.from_address OR eth_address = OLD.to_address) AND status = OLD.status
+            AND blocknumber = CASE WHEN OLD.status = 'confirmed' THEN OLD.blocknumber ELSE 0 END
+            AND pending_sent = 0 AND pending_received = 0;
+        END IF;
+    END IF;
+    IF TG_OP = 'UPDATE' OR TG_OP = 'INSERT' THEN
+        SELECT blocknumber INTO last_block FROM last_blocknumber;
+        -- confirmed transactions in blocks that have already been processed are
+        -- included in the balance returned by the node
+        IF NEW.status != 'error' AND (NEW.status != 'confirmed' OR NEW.blocknumber > COALESCE(last_block, 0)) THEN
+            INSERT INTO pending_balances (eth_address, status, blocknumber, pending_sent)
+            VALUES (NEW.from_address, NEW.status, CASE WHEN NEW.status = 'confirmed' THEN NEW.blocknumber ELSE 0 END,
+                    hex_to_numeric(NEW.value) + hex_to_numeric(NEW.gas) * hex_to_numeric(NEW.gas_price))
+            ON CONFLICT (eth_address, status, blocknumber) DO UPDATE
+            SET pending_sent = pending_balances.pending_sent + EXCLUDED.pending_sent;
+            INSERT INTO pending_balances (eth_address, status, blocknumber, pending_received)
+            VALUES (NEW.to_address, NEW.status, CASE WHEN NEW.status = 'confirmed' THEN NEW.blocknumber ELSE 0 END,
+                    hex_to_numeric(NEW.value))
+            ON CONFLICT (eth_address, status, blocknumber) DO UPDATE
+            SET pending_received = pending_balances.pending_received + EXCLUDED.pending_received;
+        END IF;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trigger_update_pending_balances
+AFTER INSERT OR DELETE OR UPDATE OF status, blocknumber, from_address, to_address, value, gas, gas_price
+ON transactions
+FOR EACH ROW EXECUTE PROCEDURE update_pending_balances();
+
+CREATE INDEX IF NOT EXISTS idx_pending_balances_blocknumber ON pending_balances (blocknumber);
+
+INSERT INTO pending_balances (eth_address, status, blocknumber, pending_sent, pending_received)
+SELECT eth_address, status, blocknumber, SUM(pending_sent), SUM(pending_received) FROM (
+    SELECT from_address AS eth_address, status, CASE WHEN status = 'confirmed' THEN blocknumber ELSE 0 END AS blocknumber,
+    hex_to_numeric(value) + hex_to_numeric(gas) * hex_to_numeric(gas_price) AS pending_sent, 0 AS pending_received
+    FROM transactions
+    WHERE (status = 'new' OR status = 'queued' OR status = 'unconfirmed')
+    OR (status = 'confirmed' AND blocknumber > (SELECT COALESCE(MAX(blocknumber), 0) FROM last_blocknumber))
+    UNION ALL
+    SELECT to_address AS eth_address, status, CASE WHEN status = 'confirmed' THEN blocknumber ELSE 0 END AS blocknumber,
+    0 AS pending_sent, hex_to_numeric(value) AS pending_received
+    FROM transactions
+    WHERE (status = 'new' OR status = 'queued' OR status = 'unconfirmed')
+    OR (status = 'confirmed' AND blocknumber > (SELECT COALESCE(MAX(blocknumber), 0) FROM last_blocknumber))
+) pending
+GROUP BY eth_address, status, blocknumber;
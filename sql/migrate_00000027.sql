@@ -0,0 +1,19 @@
+-- bumped every time the tokens table changes, so that the token list
+-- only needs to be rebuilt when something has actually changed
+CREATE TABLE IF NOT EXISTS token_list_version (
+    version BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO token_list_version (version) VALUES (0);
+
+CREATE OR REPLACE FUNCTION bump_token_list_version() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE token_list_version SET version = version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trigger_bump_token_list_version
+AFTER INSERT OR DELETE OR UPDATE OR TRUNCATE
+ON tokens
+FOR EACH STATEMENT EXECUTE PROCEDURE bump_token_list_version();
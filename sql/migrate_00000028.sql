@@ -0,0 +1,2 @@
+CREATE INDEX IF NOT EXISTS idx_transactions_from_address_created_transaction_id ON transactions (from_address, created, transaction_id);
+CREATE INDEX IF NOT EXISTS idx_transactions_to_address_created_transaction_id ON transactions (to_address, created, transaction_id);
@@ -0,0 +1,23 @@
+CREATE TABLE IF NOT EXISTS collectible_owner_summaries (
+    owner_address VARCHAR,
+    collectible_address VARCHAR,
+    value BIGINT NOT NULL DEFAULT 0,
+
+    PRIMARY KEY (owner_address, collectible_address)
+);
+
+CREATE INDEX IF NOT EXISTS idx_collectible_tokens_contract_address_owner_address ON collectible_tokens (contract_address, owner_address);
+CREATE INDEX IF NOT EXISTS idx_fungible_collectible_balances_owner_address ON fungible_collectible_balances (owner_address);
+
+INSERT INTO collectible_owner_summaries (owner_address, collectible_address, value)
+SELECT t.owner_address, t.contract_address, COUNT(t.token_id)
+FROM collectible_tokens t
+GROUP BY t.owner_address, t.contract_address;
+
+INSERT INTO collectible_owner_summaries (owner_address, collectible_address, value)
+SELECT b.owner_address, fc.collectible_address, COUNT(b.contract_address)
+FROM fungible_collectible_balances b
+JOIN fungible_collectibles fc ON fc.contract_address = b.contract_address
+WHERE b.balance != '0x0' AND fc.ready = true
+GROUP BY b.owner_address, fc.collectible_address
+ON CONFLICT (owner_address, collectible_address) DO NOTHING;
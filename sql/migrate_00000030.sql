@@ -0,0 +1,18 @@
+-- notifies the web processes to reload their copies of the gas price
+-- whitelists every time one of them changes
+CREATE OR REPLACE FUNCTION notify_gas_price_whitelist_changed() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('gas_price_whitelist_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER trigger_notify_from_address_gas_price_whitelist_changed
+AFTER INSERT OR DELETE OR UPDATE OR TRUNCATE
+ON from_address_gas_price_whitelist
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_gas_price_whitelist_changed();
+
+CREATE TRIGGER trigger_notify_to_address_gas_price_whitelist_changed
+AFTER INSERT OR DELETE OR UPDATE OR TRUNCATE
+ON to_address_gas_price_whitelist
+FOR EACH STATEMENT EXECUTE PROCEDURE notify_gas_price_whitelist_changed();
@@ -0,0 +1,3 @@
+-- websocket subscriptions and filters are kept in redis now
+DELETE FROM notification_registrations WHERE service = 'ws';
+DROP TABLE IF EXISTS filter_registrations;
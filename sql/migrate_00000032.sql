@@ -0,0 +1,2 @@
+-- the rebroadcast scheduler loads the transactions updated since its last sync
+CREATE INDEX IF NOT EXISTS idx_transactions_updated ON transactions (updated);
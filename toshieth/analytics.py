@@ -0,0 +1,76 @@
+import asyncio
+import logging
+
+from toshieth import queries
+
+log = logging.getLogger("toshieth.analytics")
+
+# how long events are buffered before they are sent
+ANALYTICS_FLUSH_INTERVAL = 1
+# events are sent straight away once this many are buffered
+ANALYTICS_MAX_BATCH_SIZE = 500
+
+class AnalyticsBuffer:
+    """Buffers analytics events so they can be sent after the request that
+    caused them has been responded to.
+
+    Events with an unknown toshi id are given the toshi id registered for
+    notifications of the event's eth address (if any), using a single query
+    for all the events in a batch"""
+
+    def __init__(self, flush_interval=ANALYTICS_FLUSH_INTERVAL, max_batch_size=ANALYTICS_MAX_BATCH_SIZE):
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self._events = []
+        self._flush_handle = None
+
+    def add(self, tracker, toshi_id, eth_address, event, add_user_agent=True):
+        """queues a call to `tracker.track` (where tracker is an
+        `AnalyticsMixin`), looking up the toshi id from the eth address
+        if it's None"""
+
+        self._events.append((tracker, toshi_id, eth_address, event, add_user_agent))
+        if len(self._events) >= self.max_batch_size:
+            self._schedule_flush(0)
+        elif self._flush_handle is None:
+            self._schedule_flush(self.flush_interval)
+
+    def _schedule_flush(self, delay):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        loop = asyncio.get_event_loop()
+        self._flush_handle = loop.call_later(delay, lambda: loop.create_task(self.flush()))
+
+    async def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        events, self._events = self._events, []
+        if not events:
+            return
+
+        eth_addresses = {eth_address for _, toshi_id, eth_address, _, _ in events
+                         if toshi_id is None and eth_address is not None}
+        toshi_ids = {}
+        if eth_addresses:
+            try:
+                async with events[0][0].application.connection_pool.acquire() as con:
+                    rows = await con.fetch(queries.TOSHI_IDS, list(eth_addresses))
+                for row in rows:
+                    toshi_ids.setdefault(row['eth_address'], row['toshi_id'])
+            except:
+                log.exception("Error looking up toshi ids for analytics events")
+
+        for tracker, toshi_id, eth_address, event, add_user_agent in events:
+            try:
+                tracker.track(toshi_id or toshi_ids.get(eth_address), event, add_user_agent=add_user_agent)
+            except:
+                log.exception("Error sending analytics event '{}'".format(event))
+
+    def clear(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._events = []
+
+analytics_buffer = AnalyticsBuffer()
@@ -2,6 +2,8 @@ import asyncio
 import os
 import toshi.web
 
+from toshieth import cache
+from toshieth import database
 from toshieth import handlers
 from toshieth import websocket
 
@@ -14,7 +16,18 @@ from toshi.jsonrpc.client import JsonRPCClient
 
 def extra_service_config():
     config.set_from_os_environ('ethereum', 'url', 'ETHEREUM_NODE_URL')
+    config.set_from_os_environ('ethereum', 'urls', 'ETHEREUM_NODE_URLS')
+    config.set_from_os_environ('ethereum', 'max_concurrency', 'ETHEREUM_NODE_MAX_CONCURRENCY')
     config.set_from_os_environ('monitor', 'url', 'MONITOR_ETHEREUM_NODE_URL')
+    config.set_from_os_environ('monitor', 'urls', 'MONITOR_ETHEREUM_NODE_URLS')
+    config.set_from_os_environ('icons', 'cache_dir', 'TOKEN_ICON_CACHE_DIR')
+    config.set_from_os_environ('websocket', 'max_queue_size', 'WEBSOCKET_MAX_QUEUE_SIZE')
+    config.set_from_os_environ('websocket', 'max_lag', 'WEBSOCKET_MAX_LAG')
+    config.set_from_os_environ('websocket', 'flush_window', 'WEBSOCKET_FLUSH_WINDOW')
+    # default the single node url to the first node of the pool
+    for section in ('ethereum', 'monitor'):
+        if section in config and config[section].get('urls') and not config[section].get('url'):
+            config[section]['url'] = config[section]['urls'].split(',')[0].strip()
     if 'ethereum' in config:
         if 'ETHEREUM_NETWORK_ID' in os.environ:
             config['ethereum']['network_id'] = os.environ['ETHEREUM_NETWORK_ID']
@@ -30,10 +43,13 @@ def extra_service_config():
 
 urls = [
     (r"^/v1/tx/skel/?$", handlers.TransactionSkeletonHandler),
+    (r"^/v1/tx/skel/batch/?$", handlers.TransactionSkeletonBatchHandler),
     (r"^/v1/tx/?$", handlers.SendTransactionHandler),
+    (r"^/v1/tx/batch/?$", handlers.SendTransactionBatchHandler),
     (r"^/v1/tx/cancel/?$", handlers.CancelTransactionHandler),
     (r"^/v1/tx/(0x[0-9a-fA-F]{64})/?$", handlers.TransactionHandler),
     (r"^/v1/balance/(0x[0-9a-fA-F]{40})/?$", handlers.BalanceHandler),
+    (r"^/v1/balances/?$", handlers.MultipleBalancesHandler),
     (r"^/v1/address/(0x[0-9a-fA-F]{40})/?$", handlers.AddressHandler),
     (r"^/v1/timestamp/?$", GenerateTimestamp),
     (r"^/v1/(apn|gcm)/register/?$", handlers.PNRegistrationHandler),
@@ -57,7 +73,8 @@ urls = [
     (r"^/token/(?P<address>.+)\.(?P<format>.+)$", handlers.TokenIconHandler),
 
     # status
-    (r"^/v1/status/?$", handlers.StatusHandler)
+    (r"^/v1/status/?$", handlers.StatusHandler),
+    (r"^/v1/status/websockets/?$", websocket.WebsocketStatusHandler)
 ]
 
 class Application(toshi.web.Application):
@@ -71,7 +88,15 @@ class Application(toshi.web.Application):
         await super()._start()
         self.worker = websocket.EthServiceWorker()
         self.worker.work()
+        cache.listen_for_new_blocks()
+        cache.listen_for_reorgs()
+        cache.listen_for_transaction_updates()
+        cache.listen_for_address_updates()
+        await cache.gas_price_whitelist_cache.listen(database.connect)
 
 def main():
     app = Application(urls)
-    app.start()
+    try:
+        app.start()
+    finally:
+        asyncio.get_event_loop().run_until_complete(cache.gas_price_whitelist_cache.stop_listening())
@@ -0,0 +1,721 @@
+import asyncio
+import collections
+import gzip
+import hashlib
+import logging
+import mmap
+import os
+import re
+import time
+import weakref
+
+from toshi.config import config
+from toshi.redis import get_redis_connection
+from toshi.utils import parse_int
+
+log = logging.getLogger("toshieth.cache")
+
+# published by the block monitor every time a new block has been processed
+NEW_BLOCK_CHANNEL = "toshieth.cache:new_block"
+# published by the block monitor when a reorg is handled
+REORG_CHANNEL = "toshieth.cache:reorg"
+# published by the manager when the status of a transaction changes
+TRANSACTION_CHANNEL = "toshieth.cache:transaction"
+# published whenever the state served for an address changes outside of a new block
+ADDRESS_CHANNEL = "toshieth.cache:address"
+
+# contract code only changes when a contract is created or self destructs
+CODE_CACHE_TTL = 3600
+# addresses without code are rechecked sooner as contracts may be deployed to them
+EMPTY_CODE_CACHE_TTL = 60
+GAS_ESTIMATE_CACHE_TTL = 3600
+NODE_GAS_PRICE_CACHE_TTL = 15
+# number of blocks after which a transaction is considered safe from reorgs
+TRANSACTION_CONFIRMATION_DEPTH = 12
+PENDING_TRANSACTION_CACHE_TTL = 5
+RECENT_TRANSACTION_CACHE_TTL = 15
+CONFIRMED_TRANSACTION_CACHE_TTL = 86400
+TOKEN_LIST_CACHE_TTL = 86400
+# how long the current icon hash of a token is trusted before checking the database again
+TOKEN_ICON_HASH_CACHE_TTL = 60
+TOKEN_ICON_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# registrations are only ever added, but are rechecked in case they are cleaned up
+TOKEN_REGISTRATION_CACHE_TTL = 3600
+# how often the buffered token registration query times are written to the database
+TOKEN_REGISTRATION_FLUSH_INTERVAL = 60
+RESPONSE_CACHE_MAX_ENTRIES = 10000
+# how long the locally known version of an address is trusted, in case an
+# update message was missed
+ADDRESS_VERSION_CACHE_TTL = 60
+# address versions only need to outlive the block they were bumped in
+ADDRESS_VERSION_REDIS_TTL = 86400
+# notified by the database every time one of the gas price whitelists changes
+GAS_PRICE_WHITELIST_CHANNEL = "gas_price_whitelist_changed"
+# the whitelists are reloaded at least this often in case a notification is missed
+GAS_PRICE_WHITELIST_CACHE_TTL = 300
+# how often the connection listening for whitelist changes is checked
+GAS_PRICE_WHITELIST_LISTENER_CHECK_INTERVAL = 5
+
+_MISSING = object()
+
+class LRUCache:
+    """Simple in memory least recently used cache with optional expiry times"""
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            return default
+        if expires is not None and expires < time.time():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        self._data[key] = (value, time.time() + ttl if ttl is not None else None)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        value, _ = self._data.pop(key, (default, None))
+        return value
+
+    def evict(self, predicate):
+        """removes all the entries whose key matches the given predicate"""
+        for key in [key for key in self._data if predicate(key)]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+class SingleFlight:
+    """Makes sure only one call for a given key is in progress at a time,
+    concurrent callers for the same key share the result of the first"""
+
+    def __init__(self):
+        self._inflight = {}
+
+    async def do(self, key, func):
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = asyncio.get_event_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await func()
+        except Exception as e:
+            future.set_exception(e)
+            # mark the exception as retrieved in case there were no other callers
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+_block_caches = weakref.WeakSet()
+
+class BlockCache:
+    """Caches values that are fixed for a given block number (e.g. the
+    balance of an address at a specific block). Values are kept in a per
+    process LRU backed by redis so they are shared between processes.
+
+    Entries for older blocks are evicted from the LRU as soon as a newer
+    block is seen, while redis entries simply expire."""
+
+    def __init__(self, name, *, maxsize=10000, redis_ttl=60, encode=str, decode=int):
+        self.name = name
+        self.redis_ttl = redis_ttl
+        self.encode = encode
+        self.decode = decode
+        self.blocknumber = 0
+        self._lru = LRUCache(maxsize)
+        self._single_flight = SingleFlight()
+        _block_caches.add(self)
+
+    def new_block(self, blocknumber):
+        if blocknumber > self.blocknumber:
+            self.blocknumber = blocknumber
+            self._lru.evict(lambda key: key[1] < blocknumber)
+
+    def clear(self):
+        self.blocknumber = 0
+        self._lru.clear()
+
+    def redis_key(self, key, blocknumber):
+        return "toshieth.cache:{}:{}:{}".format(self.name, key, blocknumber)
+
+    async def get(self, key, blocknumber, func):
+        """returns the value for `key` at the given block number, calling
+        `func` to produce it if it's not already cached"""
+
+        if blocknumber is None:
+            # no way to know what block "latest" refers to
+            return await func()
+
+        self.new_block(blocknumber)
+        value = self._lru.get((key, blocknumber), _MISSING)
+        if value is not _MISSING:
+            return value
+        return await self._single_flight.do((key, blocknumber), lambda: self._fetch(key, blocknumber, func))
+
+    async def _fetch(self, key, blocknumber, func):
+        redis_key = self.redis_key(key, blocknumber)
+        try:
+            value = await get_redis_connection().get(redis_key, encoding='utf-8')
+        except:
+            log.exception("Error reading {} from redis".format(redis_key))
+            value = None
+        if value is not None:
+            value = self.decode(value)
+        else:
+            value = await func()
+            try:
+                await get_redis_connection().set(redis_key, self.encode(value), expire=self.redis_ttl)
+            except:
+                log.exception("Error writing {} to redis".format(redis_key))
+        if blocknumber >= self.blocknumber:
+            self._lru.set((key, blocknumber), value)
+        return value
+
+_latest_blocknumber = 0
+
+def notify_new_block(blocknumber):
+    """evicts entries from older blocks from all the block caches"""
+    global _latest_blocknumber
+    _latest_blocknumber = max(_latest_blocknumber, blocknumber)
+    for cache in list(_block_caches):
+        cache.new_block(blocknumber)
+
+class TransactionCache:
+    """Caches the (serialized) responses for transaction lookups in a per
+    process LRU backed by redis. Entries for pending and recently confirmed
+    transactions are short lived, while transactions that are deep enough in
+    the chain are kept for much longer. Status changes are propagated via
+    `invalidate_transaction`"""
+
+    KINDS = ('rpc', 'sofa')
+
+    def __init__(self, maxsize=10000):
+        self._lru = LRUCache(maxsize)
+
+    def redis_key(self, tx_hash, kind):
+        return "toshieth.cache:tx:{}:{}".format(kind, tx_hash)
+
+    def ttl(self, tx):
+        """returns how long the given transaction (in json rpc form) can be cached"""
+        blocknumber = parse_int(tx.get('blockNumber')) if tx else None
+        if blocknumber is None:
+            return PENDING_TRANSACTION_CACHE_TTL
+        if _latest_blocknumber and _latest_blocknumber - blocknumber >= TRANSACTION_CONFIRMATION_DEPTH:
+            return CONFIRMED_TRANSACTION_CACHE_TTL
+        return RECENT_TRANSACTION_CACHE_TTL
+
+    async def get(self, tx_hash, kind='rpc'):
+        value = self._lru.get((tx_hash, kind))
+        if value is not None:
+            return value
+        try:
+            pipe = get_redis_connection().pipeline()
+            fut_value = pipe.get(self.redis_key(tx_hash, kind), encoding='utf-8')
+            fut_ttl = pipe.ttl(self.redis_key(tx_hash, kind))
+            await pipe.execute()
+            value, ttl = fut_value.result(), fut_ttl.result()
+        except:
+            log.exception("Error reading transaction {} from redis".format(tx_hash))
+            return None
+        if value is not None and ttl > 0:
+            self._lru.set((tx_hash, kind), value, ttl=ttl)
+        return value
+
+    async def set(self, tx_hash, value, ttl, kind='rpc'):
+        self._lru.set((tx_hash, kind), value, ttl=ttl)
+        try:
+            await get_redis_connection().set(self.redis_key(tx_hash, kind), value, expire=ttl)
+        except:
+            log.exception("Error writing transaction {} to redis".format(tx_hash))
+
+    def evict(self, tx_hash):
+        for kind in self.KINDS:
+            self._lru.pop((tx_hash, kind))
+
+    def clear(self):
+        self._lru.clear()
+
+SerializedResponse = collections.namedtuple('SerializedResponse', ['etag', 'body', 'gzipped'])
+
+class TokenListCache:
+    """Keeps the serialized token list for each version of the tokens table
+    (and each base url the icon urls are built with), along with a gzipped
+    copy, in a per process LRU backed by redis. The body is stored in redis
+    under its content hash so identical lists are only stored once"""
+
+    def __init__(self, maxsize=16):
+        self._lru = LRUCache(maxsize)
+
+    def redis_key(self, version, base_url):
+        return "toshieth.cache:token_list:{}:{}".format(version, base_url)
+
+    def redis_body_key(self, etag):
+        return "toshieth.cache:token_list_body:{}".format(etag)
+
+    async def get(self, version, base_url):
+        response = self._lru.get((version, base_url))
+        if response is not None:
+            return response
+        try:
+            redis = get_redis_connection()
+            etag = await redis.get(self.redis_key(version, base_url), encoding='utf-8')
+            gzipped = await redis.get(self.redis_body_key(etag)) if etag else None
+        except:
+            log.exception("Error reading token list from redis")
+            return None
+        if gzipped is None:
+            return None
+        response = SerializedResponse(etag, gzip.decompress(gzipped), gzipped)
+        self._lru.set((version, base_url), response)
+        return response
+
+    async def set(self, version, base_url, body):
+        etag = hashlib.sha256(body).hexdigest()
+        response = SerializedResponse(etag, body, gzip.compress(body))
+        self._lru.set((version, base_url), response)
+        try:
+            redis = get_redis_connection()
+            await redis.set(self.redis_body_key(etag), response.gzipped, expire=TOKEN_LIST_CACHE_TTL)
+            await redis.set(self.redis_key(version, base_url), etag, expire=TOKEN_LIST_CACHE_TTL)
+        except:
+            log.exception("Error writing token list to redis")
+        return response
+
+    def clear(self):
+        self._lru.clear()
+
+class ResponseCache:
+    """Caches serialized GET responses for the current block. Entries are
+    keyed by the request, the latest processed block number and the version
+    of the address the response is about, which is bumped (and published to
+    every process) whenever something changes the address's state in between
+    blocks. Responses are only cached once the latest block is known"""
+
+    def __init__(self, maxsize=RESPONSE_CACHE_MAX_ENTRIES):
+        self._lru = LRUCache(maxsize)
+        self._versions = LRUCache(maxsize, ttl=ADDRESS_VERSION_CACHE_TTL)
+
+    def redis_version_key(self, address):
+        return "toshieth.cache:address_version:{}".format(address)
+
+    async def version(self, address):
+        if address is None:
+            return 0
+        version = self._versions.get(address)
+        if version is None:
+            try:
+                version = await get_redis_connection().get(self.redis_version_key(address), encoding='utf-8')
+            except:
+                log.exception("Error reading address version from redis")
+                return None
+            version = parse_int(version) or 0
+            self._versions.set(address, version)
+        return version
+
+    def set_version(self, address, version):
+        if version > self._versions.get(address, -1):
+            self._versions.set(address, version)
+
+    async def key(self, uri, address=None):
+        """returns the cache key for the given request uri about the given
+        address, or None if the response shouldn't be cached"""
+
+        if _latest_blocknumber == 0:
+            return None
+        blocknumber = _latest_blocknumber
+        version = await self.version(address)
+        if version is None:
+            return None
+        return (uri, address, blocknumber, version)
+
+    def get(self, key):
+        return self._lru.get(key)
+
+    def set(self, key, body):
+        # the etag is derived from the body, so requests that get different
+        # responses (e.g. for different hosts) never share an etag
+        etag = hashlib.sha1(body).hexdigest()
+        response = SerializedResponse(etag, body, None)
+        self._lru.set(key, response)
+        return response
+
+    def clear(self):
+        self._lru.clear()
+        self._versions.clear()
+
+class TokenRegistrationCache:
+    """Remembers which addresses are registered for token balance updates,
+    and buffers the last time each address's tokens were queried in redis
+    so they can be written to the database in batches rather than on
+    every read"""
+
+    redis_key = "toshieth.cache:token_registrations:last_queried"
+
+    def __init__(self, maxsize=100000):
+        self._registered = LRUCache(maxsize, ttl=TOKEN_REGISTRATION_CACHE_TTL)
+
+    def is_registered(self, eth_address):
+        return eth_address in self._registered
+
+    def set_registered(self, eth_address):
+        self._registered.set(eth_address, True)
+
+    async def touch(self, eth_address):
+        try:
+            await get_redis_connection().hset(self.redis_key, eth_address, int(time.time()))
+        except:
+            log.exception("Error buffering token registration query time for {}".format(eth_address))
+
+    async def pop_touched(self):
+        """returns and clears the buffered query times as a dict of
+        address to unix timestamp"""
+
+        tr = get_redis_connection().multi_exec()
+        fut1 = tr.hgetall(self.redis_key, encoding='utf-8')
+        fut2 = tr.delete(self.redis_key)
+        await tr.execute()
+        touched = await fut1
+        await fut2
+        return {eth_address: int(timestamp) for eth_address, timestamp in touched.items()}
+
+    def clear(self):
+        self._registered.clear()
+
+class GasPriceWhitelistCache:
+    """Keeps copies of the (tiny) gas price whitelist tables in memory,
+    reloading them when the database notifies that they have changed"""
+
+    def __init__(self, ttl=GAS_PRICE_WHITELIST_CACHE_TTL):
+        self.ttl = ttl
+        self._whitelists = None
+        self._expires = 0
+        # bumped every time the whitelists are invalidated, so loads that
+        # were started before the change don't store stale copies
+        self._generation = 0
+        # the listening process of each event loop
+        self._listeners = weakref.WeakKeyDictionary()
+        self._single_flight = SingleFlight()
+
+    async def get(self, pool):
+        """returns the sets of whitelisted from and to addresses"""
+
+        if self._whitelists is not None and time.time() < self._expires:
+            return self._whitelists
+        return await self._single_flight.do('whitelists', lambda: self._load(pool))
+
+    async def is_whitelisted(self, pool, from_address, to_address):
+        from_addresses, to_addresses = await self.get(pool)
+        return from_address in from_addresses or to_address in to_addresses
+
+    async def _load(self, pool):
+        generation = self._generation
+        async with pool.acquire() as con:
+            from_rows = await con.fetch("SELECT address FROM from_address_gas_price_whitelist")
+            to_rows = await con.fetch("SELECT address FROM to_address_gas_price_whitelist")
+        whitelists = (frozenset(row['address'] for row in from_rows),
+                      frozenset(row['address'] for row in to_rows))
+        if generation == self._generation:
+            self._whitelists = whitelists
+            self._expires = time.time() + self.ttl
+        return whitelists
+
+    async def listen(self, connect, check_interval=GAS_PRICE_WHITELIST_LISTENER_CHECK_INTERVAL):
+        """keeps a dedicated connection (opened by calling `connect`)
+        listening for changes to the whitelists, reconnecting whenever the
+        connection is lost"""
+
+        await self.stop_listening()
+        self._listeners[asyncio.get_event_loop()] = asyncio.get_event_loop().create_task(
+            self._listen(connect, check_interval))
+
+    async def stop_listening(self):
+        process = self._listeners.pop(asyncio.get_event_loop(), None)
+        if process is not None:
+            process.cancel()
+            try:
+                await process
+            except asyncio.CancelledError:
+                pass
+
+    async def _listen(self, connect, check_interval):
+        con = None
+        try:
+            while True:
+                if con is not None and not con.is_closed():
+                    try:
+                        # make sure the connection is still alive
+                        await con.fetchval("SELECT 1")
+                    except asyncio.CancelledError:
+                        raise
+                    except:
+                        log.warning("Lost connection listening for gas price whitelist changes")
+                        con.terminate()
+                if con is None or con.is_closed():
+                    try:
+                        con = await connect()
+                        await con.add_listener(GAS_PRICE_WHITELIST_CHANNEL, lambda *args: self.clear())
+                    except asyncio.CancelledError:
+                        raise
+                    except:
+                        log.exception("Error listening for gas price whitelist changes")
+                        if con is not None:
+                            con.terminate()
+                            con = None
+                    # anything loaded while not listening may have missed a change
+                    self.clear()
+                await asyncio.sleep(check_interval)
+        finally:
+            if con is not None and not con.is_closed():
+                await con.close()
+
+    def clear(self):
+        self._generation += 1
+        self._whitelists = None
+
+class IconCache:
+    """Caches token icons by (address, format, hash) in a per process LRU
+    bounded by the total size of the icons, optionally backed by a directory
+    of memory mapped files (set with TOKEN_ICON_CACHE_DIR) that is shared by
+    all the processes on the host.
+
+    The current hash of each icon is cached separately for a short time, so
+    most requests don't need to touch the database at all"""
+
+    def __init__(self, maxbytes=TOKEN_ICON_CACHE_MAX_BYTES):
+        self.maxbytes = maxbytes
+        self._size = 0
+        self._data = collections.OrderedDict()
+        self._hashes = LRUCache(10000, ttl=TOKEN_ICON_HASH_CACHE_TTL)
+
+    @property
+    def directory(self):
+        if 'icons' in config:
+            return config['icons'].get('cache_dir')
+        return None
+
+    def get_hash(self, address, format):
+        """returns the (hash, last_modified) of the icon if it's known"""
+        return self._hashes.get((address, format))
+
+    def set_hash(self, address, format, hash, last_modified):
+        self._hashes.set((address, format), (hash, last_modified))
+
+    def get(self, address, format, hash):
+        key = (address, format, hash)
+        data = self._data.get(key)
+        if data is not None:
+            self._data.move_to_end(key)
+            return data
+        path = self._path(address, format, hash)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    data = m[:]
+        except (OSError, ValueError):
+            log.exception("Error reading icon from {}".format(path))
+            return None
+        self._add(key, data)
+        return data
+
+    def set(self, address, format, hash, data):
+        self._add((address, format, hash), data)
+        path = self._path(address, format, hash)
+        if path is None or os.path.exists(path):
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # write to a temporary file first so other processes never see partial icons
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            log.exception("Error writing icon to {}".format(path))
+
+    def clear(self):
+        self._data.clear()
+        self._size = 0
+        self._hashes.clear()
+
+    def _add(self, key, data):
+        if len(data) > self.maxbytes:
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self._size -= len(old)
+        self._data[key] = data
+        self._size += len(data)
+        while self._size > self.maxbytes:
+            _, evicted = self._data.popitem(last=False)
+            self._size -= len(evicted)
+
+    def _path(self, address, format, hash):
+        directory = self.directory
+        if not directory:
+            return None
+        # only use values that are safe to use as file names
+        if not all(isinstance(part, str) and re.fullmatch("[0-9a-zA-Z]+", part) for part in (address, format, hash)):
+            return None
+        return os.path.join(directory, "{}.{}.{}".format(address, format, hash))
+
+def notify_reorg(blocknumber):
+    """drops everything that may depend on the state of the replaced blocks"""
+    log.info("clearing caches after reorg at block #{}".format(blocknumber))
+    clear_caches()
+
+def clear_caches():
+    global _latest_blocknumber
+    _latest_blocknumber = 0
+    for cache in list(_block_caches):
+        cache.clear()
+    transaction_cache.clear()
+    token_list_cache.clear()
+    icon_cache.clear()
+    response_cache.clear()
+    code_cache.clear()
+    gas_estimate_cache.clear()
+    gas_price_cache.clear()
+    gas_price_whitelist_cache.clear()
+
+class RedisChannelListener:
+    """Subscribes to redis pub/sub channels, passing each message received
+    to the callbacks registered for the channel"""
+
+    def __init__(self):
+        self._callbacks = {}
+        self._processes = {}
+
+    def listen(self, channel, callback):
+        self._callbacks.setdefault(channel, []).append(callback)
+        if channel not in self._processes:
+            self._processes[channel] = asyncio.get_event_loop().create_task(self._listen(channel))
+
+    def shutdown(self):
+        for process in self._processes.values():
+            process.cancel()
+        self._processes = {}
+
+    async def _listen(self, channel):
+        while True:
+            try:
+                redis = get_redis_connection()
+                ch, = await redis.subscribe(channel)
+                while await ch.wait_message():
+                    message = await ch.get(encoding='utf-8')
+                    for callback in self._callbacks.get(channel, []):
+                        try:
+                            callback(message)
+                        except:
+                            log.exception("Error handling message on channel {}".format(channel))
+            except asyncio.CancelledError:
+                raise
+            except:
+                log.exception("Error listening to channel {}".format(channel))
+            # resubscribe after a short delay if the connection was lost
+            await asyncio.sleep(1)
+
+listener = RedisChannelListener()
+
+def listen_for_new_blocks():
+    listener.listen(NEW_BLOCK_CHANNEL, lambda message: notify_new_block(int(message)))
+
+async def publish_new_block(blocknumber):
+    await get_redis_connection().publish(NEW_BLOCK_CHANNEL, blocknumber)
+
+def listen_for_transaction_updates():
+    listener.listen(TRANSACTION_CHANNEL, lambda message: transaction_cache.evict(message))
+
+async def invalidate_transaction(tx_hash):
+    """removes the transaction from the shared cache and tells all the
+    processes to drop their local copies"""
+    transaction_cache.evict(tx_hash)
+    redis = get_redis_connection()
+    await redis.delete(*[transaction_cache.redis_key(tx_hash, kind) for kind in TransactionCache.KINDS])
+    await redis.publish(TRANSACTION_CHANNEL, tx_hash)
+
+def _notify_address(message):
+    address, _, version = message.rpartition(':')
+    response_cache.set_version(address, int(version))
+
+def listen_for_address_updates():
+    listener.listen(ADDRESS_CHANNEL, _notify_address)
+
+async def invalidate_addresses(*addresses):
+    """bumps the version of the given addresses, so responses cached for
+    them by any process are no longer used"""
+
+    for address in set(addresses):
+        if address is None:
+            continue
+        try:
+            redis = get_redis_connection()
+            tr = redis.multi_exec()
+            fut1 = tr.incr(response_cache.redis_version_key(address))
+            fut2 = tr.expire(response_cache.redis_version_key(address), ADDRESS_VERSION_REDIS_TTL)
+            await tr.execute()
+            version = await fut1
+            await fut2
+            response_cache.set_version(address, version)
+            await redis.publish(ADDRESS_CHANNEL, "{}:{}".format(address, version))
+        except:
+            log.exception("Error invalidating cached responses for {}".format(address))
+
+def listen_for_reorgs():
+    listener.listen(REORG_CHANNEL, lambda message: notify_reorg(int(message)))
+
+async def publish_reorg(blocknumber):
+    await get_redis_connection().publish(REORG_CHANNEL, blocknumber)
+
+balance_cache = BlockCache('eth_getBalance')
+
+code_cache = LRUCache(10000)
+# keyed by (to_address, method selector, code hash, data size in words)
+gas_estimate_cache = LRUCache(10000, ttl=GAS_ESTIMATE_CACHE_TTL)
+gas_price_cache = LRUCache(1, ttl=NODE_GAS_PRICE_CACHE_TTL)
+transaction_cache = TransactionCache()
+token_list_cache = TokenListCache()
+icon_cache = IconCache()
+token_registration_cache = TokenRegistrationCache()
+response_cache = ResponseCache()
+gas_price_whitelist_cache = GasPriceWhitelistCache()
+
+async def get_code(eth, address):
+    """returns the contract code at the given address"""
+
+    code = code_cache.get(address)
+    if code is None:
+        code = await eth.eth_getCode(address)
+        code_cache.set(address, code, ttl=CODE_CACHE_TTL if code else EMPTY_CODE_CACHE_TTL)
+    return code
+
+async def get_node_gas_price(eth):
+    gas_price = gas_price_cache.get('gas_price')
+    if gas_price is None:
+        gas_price = await eth.eth_gasPrice()
+        if gas_price is not None:
+            gas_price_cache.set('gas_price', gas_price)
+    return gas_price
@@ -2,7 +2,7 @@ import asyncio
 import os
 from toshi.database import prepare_database
 from toshi.redis import prepare_redis
-from toshi.jsonrpc.client import JsonRPCClient
+from toshieth.ethclient import get_ethereum_client
 
 from toshi.config import config
 
@@ -20,11 +20,73 @@ def extra_service_config():
         else:
             raise Exception("Missing $COLLECTIBLE_IMAGE_FORMAT_STRING")
 
+async def update_collectible_owner_summaries(con, collectible_address, owner_addresses):
+    """recounts the tokens of the given collectible owned by each of the given
+    addresses. Should be called in the same database transaction as the
+    ownership changes, including the previous owners of any transferred tokens.
+    Returns the addresses whose cached responses need to be invalidated once
+    the transaction is committed"""
+
+    owner_addresses = list(set(owner_addresses))
+    if not owner_addresses:
+        return owner_addresses
+    await _lock_summaries(con, collectible_address)
+    await con.execute(
+        "INSERT INTO collectible_owner_summaries (owner_address, collectible_address, value) "
+        "SELECT o.owner_address, $1, COUNT(t.token_id) "
+        "FROM unnest($2::VARCHAR[]) AS o (owner_address) "
+        "LEFT JOIN collectible_tokens t ON t.contract_address = $1 AND t.owner_address = o.owner_address "
+        "GROUP BY o.owner_address "
+        "ON CONFLICT (owner_address, collectible_address) DO UPDATE "
+        "SET value = EXCLUDED.value",
+        collectible_address, owner_addresses)
+    await _remove_empty_summaries(con, collectible_address, owner_addresses)
+    return owner_addresses
+
+async def update_fungible_collectible_owner_summaries(con, collectible_address, owner_addresses):
+    """recounts the number of ready assets of the given fungible collectible
+    that each of the given addresses has a balance of. Must be called in the
+    same database transaction as the balance changes"""
+
+    owner_addresses = list(set(owner_addresses))
+    if not owner_addresses:
+        return owner_addresses
+    await _lock_summaries(con, collectible_address)
+    await con.execute(
+        "INSERT INTO collectible_owner_summaries (owner_address, collectible_address, value) "
+        "SELECT o.owner_address, $1, COUNT(b.contract_address) "
+        "FROM unnest($2::VARCHAR[]) AS o (owner_address) "
+        "LEFT JOIN (fungible_collectible_balances b "
+        "           JOIN fungible_collectibles fc ON fc.contract_address = b.contract_address "
+        "           AND fc.collectible_address = $1 AND fc.ready = true) "
+        "ON b.owner_address = o.owner_address AND b.balance != '0x0' "
+        "GROUP BY o.owner_address "
+        "ON CONFLICT (owner_address, collectible_address) DO UPDATE "
+        "SET value = EXCLUDED.value",
+        collectible_address, owner_addresses)
+    await _remove_empty_summaries(con, collectible_address, owner_addresses)
+    return owner_addresses
+
+async def _lock_summaries(con, collectible_address):
+    # the assets of a fungible collectible are processed concurrently, so
+    # recounts of the same collectible are serialized until the end of the
+    # transaction, otherwise a recount blocked on another transaction's
+    # summary rows would overwrite them with a count from before that
+    # transaction was committed
+    await con.execute("SELECT pg_advisory_xact_lock(hashtext('collectible_owner_summaries:' || $1))",
+                      collectible_address)
+
+async def _remove_empty_summaries(con, collectible_address, owner_addresses):
+    await con.execute(
+        "DELETE FROM collectible_owner_summaries "
+        "WHERE collectible_address = $1 AND owner_address = ANY($2) AND value = 0",
+        collectible_address, owner_addresses)
+
 class CollectiblesTaskManager:
 
     def __init__(self):
         extra_service_config()
-        self.eth = JsonRPCClient(config['ethereum']['url'], should_retry=False)
+        self.eth = get_ethereum_client(should_retry=False)
         asyncio.get_event_loop().create_task(self._initialize())
 
     async def _initialize(self):
@@ -7,7 +7,8 @@ from ethereum.utils import sha3
 from ethereum.abi import decode_abi, process_type, decode_single
 from toshi.utils import parse_int
 from toshi.jsonrpc.errors import JsonRPCError
-from toshieth.collectibles.base import CollectiblesTaskManager
+from toshieth.cache import invalidate_addresses
+from toshieth.collectibles.base import CollectiblesTaskManager, update_collectible_owner_summaries
 from urllib.parse import urlparse
 from tornado.httpclient import AsyncHTTPClient
 from tornado.escape import json_decode
@@ -247,18 +248,30 @@ class ERC721TaskManager(CollectiblesTaskManager):
                     new_tokens.append(new_token)
 
             async with self.pool.acquire() as con:
-                if len(new_tokens) > 0:
+                async with con.transaction():
+                    previous_owners = await con.fetch(
+                        "SELECT owner_address FROM collectible_tokens WHERE contract_address = $1 AND token_id = ANY($2)",
+                        collectible_address, list(updates.keys()))
+
+                    if len(new_tokens) > 0:
+                        await con.executemany(
+                            "INSERT INTO collectible_tokens (contract_address, token_id, owner_address, token_uri, name, description, image) "
+                            "VALUES ($1, $2, $3, $4, $5, $6, $7)",
+                            new_tokens)
+
                     await con.executemany(
-                        "INSERT INTO collectible_tokens (contract_address, token_id, owner_address, token_uri, name, description, image) "
-                        "VALUES ($1, $2, $3, $4, $5, $6, $7)",
-                        new_tokens)
-
-                await con.executemany(
-                    "INSERT INTO collectible_tokens (contract_address, token_id, owner_address) "
-                    "VALUES ($1, $2, $3) "
-                    "ON CONFLICT (contract_address, token_id) DO UPDATE "
-                    "SET owner_address = EXCLUDED.owner_address",
-                    list(updates.values()))
+                        "INSERT INTO collectible_tokens (contract_address, token_id, owner_address) "
+                        "VALUES ($1, $2, $3) "
+                        "ON CONFLICT (contract_address, token_id) DO UPDATE "
+                        "SET owner_address = EXCLUDED.owner_address",
+                        list(updates.values()))
+
+                    owners = await update_collectible_owner_summaries(
+                        con, collectible_address,
+                        [row['owner_address'] for row in previous_owners] +
+                        [token[2] for token in new_tokens] +
+                        [token[2] for token in updates.values()])
+            await invalidate_addresses(*owners)
 
         ready = collectible['ready'] or to_block_number == latest_block_number
 
@@ -7,7 +7,8 @@ from toshi.ethereum.utils import data_decoder
 from ethereum.utils import sha3
 from ethereum.abi import decode_abi, process_type, decode_single
 from toshi.utils import parse_int
-from toshieth.collectibles.base import CollectiblesTaskManager
+from toshieth.cache import invalidate_addresses
+from toshieth.collectibles.base import CollectiblesTaskManager, update_fungible_collectible_owner_summaries
 from urllib.parse import urlparse
 from tornado.httpclient import AsyncHTTPClient
 from tornado.escape import json_decode
@@ -328,18 +329,33 @@ class FungibleCollectibleTaskManager(CollectiblesTaskManager):
 
             if len(updates) > 0:
                 async with self.pool.acquire() as con:
-                    await con.executemany(
-                        "INSERT INTO fungible_collectible_balances (contract_address, owner_address, balance) "
-                        "VALUES ($1, $2, $3) "
-                        "ON CONFLICT (contract_address, owner_address) DO UPDATE "
-                        "SET balance = EXCLUDED.balance",
-                        [(contract_address, address, hex(value)) for address, value in updates.items()])
+                    async with con.transaction():
+                        await con.executemany(
+                            "INSERT INTO fungible_collectible_balances (contract_address, owner_address, balance) "
+                            "VALUES ($1, $2, $3) "
+                            "ON CONFLICT (contract_address, owner_address) DO UPDATE "
+                            "SET balance = EXCLUDED.balance",
+                            [(contract_address, address, hex(value)) for address, value in updates.items()])
+                        if collectible['ready']:
+                            await update_fungible_collectible_owner_summaries(
+                                con, collectible['collectible_address'], updates.keys())
+                await invalidate_addresses(*updates.keys())
 
         ready = collectible['ready'] or to_block_number == latest_block_number
 
         async with self.pool.acquire() as con:
-            await con.execute("UPDATE fungible_collectibles SET last_block = $1, ready = $2 WHERE contract_address = $3",
-                              to_block_number, ready, contract_address)
+            async with con.transaction():
+                await con.execute("UPDATE fungible_collectibles SET last_block = $1, ready = $2 WHERE contract_address = $3",
+                                  to_block_number, ready, contract_address)
+                if ready and not collectible['ready']:
+                    # the asset now counts towards the summaries of all its owners
+                    owners = await con.fetch("SELECT owner_address FROM fungible_collectible_balances WHERE contract_address = $1",
+                                             contract_address)
+                    owners = await update_fungible_collectible_owner_summaries(
+                        con, collectible['collectible_address'], [row['owner_address'] for row in owners])
+                else:
+                    owners = []
+            await invalidate_addresses(*owners)
 
         del self._processing[contract_address]
         if to_block_number < latest_block_number or contract_address in self._queue:
@@ -5,7 +5,8 @@ from toshi.config import config
 from toshi.ethereum.utils import data_decoder
 from ethereum.abi import decode_abi, process_type, decode_single
 from toshi.utils import parse_int
-from toshieth.collectibles.base import CollectiblesTaskManager
+from toshieth.cache import invalidate_addresses
+from toshieth.collectibles.base import CollectiblesTaskManager, update_collectible_owner_summaries
 
 log = logging.getLogger("toshieth.cryptopunks")
 
@@ -107,12 +108,20 @@ class CryptoPunksTaskManager(CollectiblesTaskManager):
                     updates.append((CRYPTO_PUNKS_CONTRACT_ADDRESS, hex(tx['token_id']), tx['to_address'], token_image))
 
             async with self.pool.acquire() as con:
-                await con.executemany(
-                    "INSERT INTO collectible_tokens (contract_address, token_id, owner_address, image) "
-                    "VALUES ($1, $2, $3, $4) "
-                    "ON CONFLICT (contract_address, token_id) DO UPDATE "
-                    "SET owner_address = EXCLUDED.owner_address",
-                    updates)
+                async with con.transaction():
+                    previous_owners = await con.fetch(
+                        "SELECT owner_address FROM collectible_tokens WHERE contract_address = $1 AND token_id = ANY($2)",
+                        CRYPTO_PUNKS_CONTRACT_ADDRESS, [token[1] for token in updates])
+                    await con.executemany(
+                        "INSERT INTO collectible_tokens (contract_address, token_id, owner_address, image) "
+                        "VALUES ($1, $2, $3, $4) "
+                        "ON CONFLICT (contract_address, token_id) DO UPDATE "
+                        "SET owner_address = EXCLUDED.owner_address",
+                        updates)
+                    owners = await update_collectible_owner_summaries(
+                        con, CRYPTO_PUNKS_CONTRACT_ADDRESS,
+                        [row['owner_address'] for row in previous_owners] + [token[2] for token in updates])
+            await invalidate_addresses(*owners)
 
         ready = collectible['ready'] or to_block_number == latest_block_number
 
@@ -0,0 +1,133 @@
+import asyncio
+import asyncpg
+import logging
+
+from toshi.config import config
+
+log = logging.getLogger("toshieth.database")
+
+# the database config options that are connection parameters (the rest
+# being settings for the pool)
+_CONNECT_PARAMETERS = ('dsn', 'host', 'port', 'user', 'password', 'database')
+
+async def connect():
+    """opens a connection to the configured database outside of the pool,
+    for things that need to hold on to a connection indefinitely (e.g. to
+    listen for notifications)"""
+
+    return await asyncpg.connect(**{key: value for key, value in config['database'].items()
+                                    if key in _CONNECT_PARAMETERS})
+
+class RequestDatabaseContext:
+    """Drop in replacement for the `self.db` context of `DatabaseMixin` that
+    can hold on to a single pool connection for the whole lifetime of a
+    request, rather than acquiring and releasing one for every
+    `async with self.db` block.
+
+    The first block to be entered runs in a transaction, which is rolled
+    back once the last block exits unless `commit` was called. Nested blocks
+    (e.g. from helper methods called inside a block) and blocks entered
+    concurrently by other tasks using the same context (e.g. from
+    `asyncio.gather`) join the transaction that is already running, rather
+    than failing, and take turns running their statements on the
+    connection. `commit` commits everything done on the connection so far
+    and starts a new transaction for the blocks that are still running.
+
+    The connection is only kept between blocks while the context is held
+    (see `hold` and `release`), otherwise it's returned to the pool when the
+    last block exits."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.connection = None
+        self.transaction = None
+        self.depth = 0
+        self.held = False
+        # guards both the state of the context and the connection, which can
+        # only run one statement at a time
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        async with self._lock:
+            if self.depth == 0:
+                if self.connection is None:
+                    self.connection = await self.pool.acquire()
+                try:
+                    self.transaction = self.connection.transaction()
+                    await self.transaction.start()
+                except:
+                    self.transaction = None
+                    await self._release_connection()
+                    raise
+            self.depth += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._lock:
+            self.depth -= 1
+            if self.depth > 0:
+                return
+            try:
+                if self.transaction is not None:
+                    await self.transaction.rollback()
+            except:
+                log.exception("Error rolling back request transaction")
+                # don't keep using a connection in an unknown state
+                await self._release_connection()
+            finally:
+                self.transaction = None
+            if not self.held:
+                await self._release_connection()
+
+    async def _run(self, method, query, *args, **kwargs):
+        if self.connection is None:
+            raise Exception("Database connection used outside of an `async with` block")
+        # a connection can only run one statement at a time
+        async with self._lock:
+            return await getattr(self.connection, method)(query, *args, **kwargs)
+
+    async def fetch(self, query, *args, **kwargs):
+        return await self._run('fetch', query, *args, **kwargs)
+
+    async def fetchrow(self, query, *args, **kwargs):
+        return await self._run('fetchrow', query, *args, **kwargs)
+
+    async def fetchval(self, query, *args, **kwargs):
+        return await self._run('fetchval', query, *args, **kwargs)
+
+    async def execute(self, query, *args, **kwargs):
+        return await self._run('execute', query, *args, **kwargs)
+
+    async def executemany(self, command, args, **kwargs):
+        return await self._run('executemany', command, args, **kwargs)
+
+    async def commit(self):
+        async with self._lock:
+            if self.transaction is None:
+                return
+            await self.transaction.commit()
+            self.transaction = None
+            if self.depth > 1:
+                # other blocks are still running, keep them in a transaction
+                self.transaction = self.connection.transaction()
+                await self.transaction.start()
+
+    def hold(self):
+        """keeps the connection acquired between blocks until `release` is called"""
+        self.held = True
+
+    async def release(self):
+        """stops holding the connection, returning it to the pool if no
+        block is currently using it"""
+        self.held = False
+        async with self._lock:
+            if self.depth == 0:
+                await self._release_connection()
+
+    async def _release_connection(self):
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            try:
+                await self.pool.release(connection)
+            except:
+                log.exception("Error releasing request database connection")
@@ -8,16 +8,17 @@ from toshi.log import configure_logger, log_unhandled_exceptions
 from toshi.utils import parse_int
 from toshi.config import config
 
-from toshi.ethereum.mixin import EthereumMixin
 from toshi.jsonrpc.errors import JsonRPCError
 
+from toshieth.cache import invalidate_addresses, token_registration_cache, TOKEN_REGISTRATION_FLUSH_INTERVAL
+from toshieth.ethclient import EthereumClientMixin
 from toshieth.tasks import BaseEthServiceWorker, BaseTaskHandler, manager_dispatcher, erc20_dispatcher
 
 log = logging.getLogger("toshieth.erc20manager")
 
 RETRY_DELAY = 10
 
-class ERC20UpdateHandler(EthereumMixin, BaseTaskHandler):
+class ERC20UpdateHandler(EthereumClientMixin, BaseTaskHandler):
 
     @log_unhandled_exceptions(logger=log)
     async def update_token_cache(self, contract_address, *eth_addresses, blocknumber=None):
@@ -117,6 +118,7 @@ class ERC20UpdateHandler(EthereumMixin, BaseTaskHandler):
                         bulk_insert)
                     await self.db.commit()
                     send_update = True
+                await invalidate_addresses(*eth_addresses)
 
             # token updates need to send a refresh trigger to clients
             # currently clients only use a TokenPayment as a trigger to refresh their
@@ -138,12 +140,40 @@ class ERC20UpdateHandler(EthereumMixin, BaseTaskHandler):
             end_time = time.time()
             log.info("DONE update_token_cache(\"*\", {}) in {}s".format(eth_addresses[0], round(end_time - start_time, 2)))
 
+    @log_unhandled_exceptions(logger=log)
+    async def flush_token_registrations(self, frequency):
+        """writes the buffered token registration query times to the database"""
+
+        try:
+            touched = await token_registration_cache.pop_touched()
+            if touched:
+                addresses, timestamps = zip(*touched.items())
+                async with self.db:
+                    await self.db.execute(
+                        "UPDATE token_registrations r "
+                        "SET last_queried = to_timestamp(t.timestamp) AT TIME ZONE 'utc' "
+                        "FROM unnest($1::VARCHAR[], $2::BIGINT[]) AS t (eth_address, timestamp) "
+                        "WHERE r.eth_address = t.eth_address",
+                        addresses, timestamps)
+                    await self.db.commit()
+                log.debug("updated last_queried for {} token registrations".format(len(addresses)))
+        finally:
+            if frequency:
+                erc20_dispatcher.flush_token_registrations(frequency).delay(frequency)
+
 class TaskManager(BaseEthServiceWorker):
 
     def __init__(self):
         super().__init__([(ERC20UpdateHandler,)], queue_name="erc20")
         configure_logger(log)
 
+    def start_interval_services(self):
+        erc20_dispatcher.flush_token_registrations(TOKEN_REGISTRATION_FLUSH_INTERVAL).delay(TOKEN_REGISTRATION_FLUSH_INTERVAL)
+
+    async def _work(self):
+        await super()._work()
+        self.start_interval_services()
+
 if __name__ == "__main__":
     from toshieth.app import extra_service_config
     extra_service_config()
@@ -0,0 +1,421 @@
+import asyncio
+import functools
+import logging
+import time
+import weakref
+
+from toshi.config import config
+from toshi.jsonrpc.client import JsonRPCClient
+from toshi.jsonrpc.errors import JsonRPCError
+
+from toshieth.cache import SingleFlight
+
+log = logging.getLogger("toshieth.ethclient")
+
+DEFAULT_MAX_CONCURRENCY = 10
+# how long to wait for a read before sending the same request to a second node
+DEFAULT_HEDGE_DELAY = 0.5
+# how often the head block of each node is checked
+HEAD_REFRESH_INTERVAL = 2.0
+# weight given to new samples in the per node latency average
+LATENCY_DECAY = 0.2
+# how many blocks behind the furthest ahead node a node can be and still be
+# used for calls on the latest state of the chain
+DEFAULT_HEAD_TOLERANCE = 1
+
+JSONRPC_METHOD_PREFIXES = ('eth_', 'net_', 'web3_', 'parity_', 'trace_')
+
+# calls that have side effects or depend on node local state, and so
+# cannot be shared between concurrent callers
+NON_COALESCABLE_METHODS = {
+    'eth_sendRawTransaction',
+    'eth_newFilter',
+    'eth_newBlockFilter',
+    'eth_newPendingTransactionFilter',
+    'eth_getFilterChanges',
+    'eth_uninstallFilter'
+}
+
+# lookups by hash, which fail on nodes that haven't seen the block yet
+HASH_LOOKUP_METHODS = {
+    'eth_getTransactionByHash',
+    'eth_getTransactionReceipt',
+    'eth_getBlockByHash'
+}
+
+# calls that take a `block` argument and default to the latest block
+BLOCK_STATE_METHODS = {
+    'eth_getBalance',
+    'eth_getTransactionCount',
+    'eth_getCode',
+    'eth_getStorageAt',
+    'eth_call',
+    'eth_estimateGas'
+}
+
+class MethodStats:
+    __slots__ = ('calls', 'errors', 'total_time', 'max_time')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, duration, error=False):
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'average_time': self.total_time / self.calls if self.calls else 0.0,
+            'max_time': self.max_time
+        }
+
+class _BulkRequest:
+    """Wraps a bulk request so that executing it counts towards the
+    client's concurrency limit"""
+
+    def __init__(self, client, bulk):
+        self._client = client
+        self._bulk = bulk
+
+    def __getattr__(self, name):
+        return getattr(self._bulk, name)
+
+    async def execute(self):
+        async with self._client._semaphore:
+            return await self._bulk.execute()
+
+class EthereumClient:
+    """A long lived ethereum json rpc client meant to be shared by everything
+    in the process.
+
+    Calls made in the same event loop iteration are sent to the node as a
+    single batch request, identical calls that are already in flight are
+    shared instead of being sent again, and the number of requests to the
+    node at any one time is capped."""
+
+    def __init__(self, url, *, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 connect_timeout=5.0, request_timeout=5.0, should_retry=True, batch=True):
+        self.url = url
+        self._client = JsonRPCClient(url, connect_timeout=connect_timeout, request_timeout=request_timeout,
+                                     should_retry=should_retry)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._batch = batch
+        self._pending = None
+        self._single_flight = SingleFlight()
+        self._stats = {}
+
+    def __getattr__(self, name):
+        if not name.startswith(JSONRPC_METHOD_PREFIXES):
+            raise AttributeError(name)
+        return functools.partial(self._call, name)
+
+    def bulk(self, **kwargs):
+        return _BulkRequest(self, self._client.bulk(**kwargs))
+
+    def stats(self):
+        """returns the call counts and latencies per json rpc method"""
+        return {method: stats.to_dict() for method, stats in self._stats.items()}
+
+    async def _call(self, method, *args, **kwargs):
+        if method not in NON_COALESCABLE_METHODS:
+            key = (method, args, tuple(sorted(kwargs.items())))
+            try:
+                hash(key)
+            except TypeError:
+                key = None
+            if key is not None:
+                return await self._single_flight.do(key, lambda: self._send(method, args, kwargs))
+        return await self._send(method, args, kwargs)
+
+    async def _send(self, method, args, kwargs):
+        start_time = time.time()
+        error = False
+        try:
+            if not self._batch:
+                async with self._semaphore:
+                    return await getattr(self._client, method)(*args, **kwargs)
+            if self._pending is None:
+                self._pending = (self._client.bulk(), [])
+                # send everything queued up by the end of this loop iteration
+                asyncio.get_event_loop().call_soon(self._flush)
+            bulk, futures = self._pending
+            future = getattr(bulk, method)(*args, **kwargs)
+            futures.append(future)
+            return await future
+        except:
+            error = True
+            raise
+        finally:
+            self._stats.setdefault(method, MethodStats()).record(time.time() - start_time, error)
+
+    def _flush(self):
+        bulk, futures = self._pending
+        self._pending = None
+        asyncio.get_event_loop().create_task(self._execute(bulk, futures))
+
+    async def _execute(self, bulk, futures):
+        try:
+            async with self._semaphore:
+                await bulk.execute()
+        except Exception as e:
+            log.exception("Error executing batch request to {}".format(self.url))
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+
+class _Node:
+    __slots__ = ('client', 'latency', 'head')
+
+    def __init__(self, client):
+        self.client = client
+        self.latency = 0.0
+        self.head = 0
+
+    def record_latency(self, duration):
+        self.latency = (1 - LATENCY_DECAY) * self.latency + LATENCY_DECAY * duration
+
+class _PoolBulkRequest:
+    """Collects the calls of a bulk request so the node it's sent to can be
+    picked once all the calls (and so the blocks they need) are known"""
+
+    def __init__(self, pool, kwargs):
+        self._pool = pool
+        self._kwargs = kwargs
+        self._calls = []
+
+    def __getattr__(self, name):
+        if not name.startswith(JSONRPC_METHOD_PREFIXES):
+            raise AttributeError(name)
+        return functools.partial(self._add, name)
+
+    def _add(self, method, *args, **kwargs):
+        future = asyncio.get_event_loop().create_future()
+        self._calls.append((method, args, kwargs, future))
+        return future
+
+    async def execute(self):
+        required_blocks = [self._pool._required_block(method, args, kwargs)
+                           for method, args, kwargs, _ in self._calls]
+        required_blocks = [block for block in required_blocks if block is not None]
+        node = self._pool._candidates(max(required_blocks) if required_blocks else None)[0]
+        bulk = node.client.bulk(**self._kwargs)
+        results = []
+        for method, args, kwargs, future in self._calls:
+            try:
+                results.append((getattr(bulk, method)(*args, **kwargs), future))
+            except Exception as e:
+                future.set_exception(e)
+        try:
+            rval = await bulk.execute()
+        except Exception as e:
+            for _, future in results:
+                if not future.done():
+                    future.set_exception(e)
+            raise
+        for result, future in results:
+            if future.done():
+                continue
+            if result.exception() is not None:
+                future.set_exception(result.exception())
+            else:
+                future.set_result(result.result())
+        return rval
+
+class EthereumNodePool:
+    """Spreads json rpc calls over a set of ethereum nodes.
+
+    Reads are sent to the node with the lowest average latency that has
+    reached the block required by the call, and are hedged by
+    sending the same call to the next best node if the first doesn't
+    respond within `hedge_delay` seconds. Transactions are sent to all
+    the nodes. Filter calls always go to the first node, as filters only
+    exist on the node they were created on.
+
+    Calls for a specific block need a node that has reached it, while hash
+    lookups and calls on the latest state need a node that is at most
+    `head_tolerance` blocks behind the furthest ahead node."""
+
+    def __init__(self, urls, *, hedge_delay=DEFAULT_HEDGE_DELAY, head_refresh_interval=HEAD_REFRESH_INTERVAL,
+                 head_tolerance=DEFAULT_HEAD_TOLERANCE, **kwargs):
+        if not urls:
+            raise ValueError("At least one node url is required")
+        self.nodes = [_Node(EthereumClient(url, **kwargs)) for url in urls]
+        self.hedge_delay = hedge_delay
+        self.head_tolerance = head_tolerance
+        self.head_refresh_interval = head_refresh_interval
+        self._head_process = None
+
+    def __getattr__(self, name):
+        if not name.startswith(JSONRPC_METHOD_PREFIXES):
+            raise AttributeError(name)
+        return functools.partial(self._call, name)
+
+    def bulk(self, **kwargs):
+        if len(self.nodes) == 1:
+            return self.nodes[0].client.bulk(**kwargs)
+        self._start_head_process()
+        return _PoolBulkRequest(self, kwargs)
+
+    def stats(self):
+        return {node.client.url: {
+            'latency': node.latency,
+            'head': node.head,
+            'methods': node.client.stats()
+        } for node in self.nodes}
+
+    def shutdown(self):
+        if self._head_process is not None:
+            self._head_process.cancel()
+            self._head_process = None
+
+    def _required_block(self, method, args, kwargs):
+        if method in HASH_LOOKUP_METHODS:
+            return self._latest_required_block()
+        if method == 'eth_getBlockByNumber':
+            block = args[0] if args else kwargs.get('number')
+        elif method == 'eth_getLogs':
+            block = kwargs.get('toBlock')
+        elif method in BLOCK_STATE_METHODS:
+            block = kwargs.get('block', 'latest')
+        else:
+            block = None
+        if isinstance(block, int):
+            return block
+        if block in ('latest', 'pending'):
+            return self._latest_required_block()
+        return None
+
+    def _latest_required_block(self):
+        head = max(node.head for node in self.nodes)
+        if head == 0:
+            # no heads known yet
+            return None
+        return head - self.head_tolerance
+
+    def _candidates(self, required_block):
+        """returns the nodes ordered by preference for a call that requires
+        the given block"""
+
+        ready = [node for node in self.nodes
+                 if required_block is None or node.head >= required_block]
+        if not ready:
+            # nobody has the block yet, the node that is furthest
+            # ahead has the best chance of seeing it first
+            return sorted(self.nodes, key=lambda node: -node.head)
+        return sorted(ready, key=lambda node: node.latency)
+
+    def _start_head_process(self):
+        if len(self.nodes) > 1 and self._head_process is None:
+            self._head_process = asyncio.get_event_loop().create_task(self._refresh_heads())
+
+    async def _call(self, method, *args, **kwargs):
+        self._start_head_process()
+
+        if method == 'eth_sendRawTransaction':
+            return await self._send_to_all(method, args, kwargs)
+        elif method in NON_COALESCABLE_METHODS:
+            return await getattr(self.nodes[0].client, method)(*args, **kwargs)
+
+        nodes = self._candidates(self._required_block(method, args, kwargs))
+        primary = asyncio.get_event_loop().create_task(self._timed_call(nodes[0], method, args, kwargs))
+        if len(nodes) == 1:
+            return await primary
+
+        done, _ = await asyncio.wait([primary], timeout=self.hedge_delay)
+        if done and (primary.exception() is None or isinstance(primary.exception(), JsonRPCError)):
+            # the node responded (even if it was with an error)
+            return primary.result()
+
+        secondary = asyncio.get_event_loop().create_task(self._timed_call(nodes[1], method, args, kwargs))
+        if done:
+            # the first node failed, rely on the second one
+            return await secondary
+
+        # hedge the slow request
+        pending = {primary, secondary}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None or isinstance(task.exception(), JsonRPCError):
+                    for other in pending:
+                        # let the other request finish (so the latency is still
+                        # recorded) but make sure errors aren't reported
+                        other.add_done_callback(lambda f: f.cancelled() or f.exception())
+                    return task.result()
+                error = error or task.exception()
+        raise error
+
+    async def _timed_call(self, node, method, args, kwargs):
+        start_time = time.time()
+        try:
+            result = await getattr(node.client, method)(*args, **kwargs)
+        except JsonRPCError:
+            node.record_latency(time.time() - start_time)
+            raise
+        except:
+            # make sure failing nodes are less likely to be picked
+            node.record_latency(max(self.hedge_delay * 4, time.time() - start_time))
+            raise
+        node.record_latency(time.time() - start_time)
+        return result
+
+    async def _send_to_all(self, method, args, kwargs):
+        results = await asyncio.gather(
+            *[self._timed_call(node, method, args, kwargs) for node in self.nodes],
+            return_exceptions=True)
+        for result in results:
+            if not isinstance(result, Exception):
+                return result
+        # every node failed, report the error from the preferred node
+        raise results[0]
+
+    async def _refresh_heads(self):
+        while True:
+            results = await asyncio.gather(
+                *[self._timed_call(node, 'eth_blockNumber', (), {}) for node in self.nodes],
+                return_exceptions=True)
+            for node, result in zip(self.nodes, results):
+                if isinstance(result, Exception):
+                    log.warning("Error getting head block from {}: {}".format(node.client.url, result))
+                else:
+                    node.head = result
+            await asyncio.sleep(self.head_refresh_interval)
+
+_clients = weakref.WeakKeyDictionary()
+
+def get_node_urls(section='ethereum'):
+    """returns the list of node urls configured for the given config section"""
+
+    if 'urls' in config[section] and config[section]['urls']:
+        return [url.strip() for url in config[section]['urls'].split(',') if url.strip()]
+    return [config[section]['url']]
+
+def get_ethereum_client(section='ethereum', *, should_retry=True):
+    """returns the shared node pool configured by the given config section
+    (`ethereum` for the main nodes, `monitor` for the block monitor's nodes)
+    for the current event loop"""
+
+    if section not in config:
+        section = 'ethereum'
+    clients = _clients.setdefault(asyncio.get_event_loop(), {})
+    if (section, should_retry) not in clients:
+        clients[(section, should_retry)] = EthereumNodePool(
+            get_node_urls(section),
+            max_concurrency=config['ethereum'].getint('max_concurrency', DEFAULT_MAX_CONCURRENCY),
+            should_retry=should_retry)
+    return clients[(section, should_retry)]
+
+class EthereumClientMixin:
+
+    @property
+    def eth(self):
+        return get_ethereum_client()
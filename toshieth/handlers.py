@@ -1,5 +1,6 @@
-import os
 import binascii
+import datetime
+import os
 import tornado.httpclient
 
 # -*- coding: utf-8 -*-
@@ -17,7 +18,10 @@ from toshi.utils import validate_address, parse_int
 from toshi.log import log, log_headers_on_error
 
 from toshi.config import config
-from toshieth.mixins import BalanceMixin
+from toshieth import queries
+from toshieth.cache import get_node_gas_price, transaction_cache, token_list_cache, icon_cache, token_registration_cache
+from toshieth.ethclient import get_ethereum_client
+from toshieth.mixins import BalanceMixin, CachedResponseMixin
 from toshieth.jsonrpc import ToshiEthJsonRPC
 from toshieth.utils import database_transaction_to_rlp_transaction
 from toshi.ethereum.tx import transaction_to_json, DEFAULT_GASPRICE
@@ -50,20 +54,36 @@ class TokenIconHandler(DatabaseMixin, SimpleFileHandler):
 
     async def get(self, address, format):
 
-        async with self.db:
-            row = await self.db.fetchrow(
-                "SELECT * FROM tokens WHERE contract_address = $1 AND format = lower($2)",
-                address, format
-            )
+        format = format.lower()
+        icon = icon_cache.get_hash(address, format)
+        if icon is None:
+            # only fetch the hash here, the icon itself is usually cached
+            async with self.db:
+                row = await self.db.fetchrow(
+                    "SELECT hash, last_modified FROM tokens WHERE contract_address = $1 AND format = $2",
+                    address, format
+                )
+            if row is None:
+                raise HTTPError(404)
+            icon = (row['hash'], row['last_modified'])
+            icon_cache.set_hash(address, format, *icon)
+        hash, last_modified = icon
 
-        if row is None:
-            raise HTTPError(404)
+        data = icon_cache.get(address, format, hash) if hash else None
+        if data is None:
+            async with self.db:
+                data = await self.db.fetchval(
+                    "SELECT icon FROM tokens WHERE contract_address = $1 AND format = $2",
+                    address, format
+                )
+            if data is not None and hash:
+                icon_cache.set(address, format, hash, data)
 
         await self.handle_file_response(
-            data=row['icon'],
+            data=data,
             content_type="image/png",
-            etag=row['hash'],
-            last_modified=row['last_modified']
+            etag=hash,
+            last_modified=last_modified
         )
 
 
@@ -75,33 +95,52 @@ class TokenListHandler(DatabaseMixin, BaseHandler):
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
         self.set_header('Access-Control-Allow-Methods', 'GET')
 
+        # the version is bumped by a trigger every time the tokens table changes
         async with self.db:
-            count = await self.db.fetchval("SELECT COUNT(*) FROM tokens")
-        limit = 100
-        results = []
-        for offset in range(0, count, limit):
-            async with self.db:
-                rows = await self.db.fetch("SELECT symbol, name, contract_address, decimals, icon_url, format FROM tokens OFFSET $1 LIMIT $2", offset, limit)
-            for row in rows:
-                token = {
-                    'symbol': row['symbol'],
-                    'name': row['name'],
-                    'contract_address': row['contract_address'],
-                    'decimals': row['decimals'] or 0
-                }
-                if row['icon_url'] is not None:
-                    token['icon'] = row['icon_url']
-                elif row['format'] is not None:
-                    token['icon'] = "{}://{}/token/{}.{}".format(self.request.protocol, self.request.host,
-                                                                 token['contract_address'], row['format'])
-                else:
-                    token['icon'] = None
-                results.append(token)
+            version = await self.db.fetchval("SELECT version FROM token_list_version")
+        base_url = "{}://{}".format(self.request.protocol, self.request.host)
+        token_list = await token_list_cache.get(version, base_url)
+        if token_list is None:
+            token_list = await token_list_cache.set(
+                version, base_url, json_encode({"tokens": await self.get_tokens()}).encode('utf-8'))
+
+        self.set_header("Etag", '"{}"'.format(token_list.etag))
+        self.set_header("Vary", "Accept-Encoding")
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        if "gzip" in self.request.headers.get("Accept-Encoding", ""):
+            self.set_header("Content-Encoding", "gzip")
+            self.write(token_list.gzipped)
+        else:
+            self.write(token_list.body)
 
-        self.write({"tokens": results})
+    async def get_tokens(self):
+
+        async with self.db:
+            rows = await self.db.fetch("SELECT symbol, name, contract_address, decimals, icon_url, format FROM tokens")
+        results = []
+        for row in rows:
+            token = {
+                'symbol': row['symbol'],
+                'name': row['name'],
+                'contract_address': row['contract_address'],
+                'decimals': row['decimals'] or 0
+            }
+            if row['icon_url'] is not None:
+                token['icon'] = row['icon_url']
+            elif row['format'] is not None:
+                token['icon'] = "{}://{}/token/{}.{}".format(self.request.protocol, self.request.host,
+                                                             token['contract_address'], row['format'])
+            else:
+                token['icon'] = None
+            results.append(token)
+        return results
 
 
-class TokenBalanceHandler(DatabaseMixin, BaseHandler):
+class TokenBalanceHandler(CachedResponseMixin, DatabaseMixin, BaseHandler):
 
     async def get(self, eth_address, token_address=None):
 
@@ -111,18 +150,26 @@ class TokenBalanceHandler(DatabaseMixin, BaseHandler):
 
         force_update = self.get_argument('force_update', None)
 
-        try:
-            result = await ToshiEthJsonRPC(None, self.application, self.request).get_token_balances(
-                eth_address, token_address=token_address, force_update=force_update)
-        except JsonRPCError as e:
-            raise JSONHTTPError(400, body={'errors': [e.data]})
+        async def get_token_balances():
+            try:
+                async with ToshiEthJsonRPC(None, self.application, self.request) as rpc:
+                    result = await rpc.get_token_balances(
+                        eth_address, token_address=token_address, force_update=force_update)
+            except JsonRPCError as e:
+                raise JSONHTTPError(400, body={'errors': [e.data]})
+
+            if token_address:
+                if result is None:
+                    raise JSONHTTPError(404)
+                return result
+            else:
+                return {"tokens": result}
 
-        if token_address:
-            if result is None:
-                raise JSONHTTPError(404)
-            self.write(result)
-        else:
-            self.write({"tokens": result})
+        if force_update:
+            self.write(await get_token_balances())
+        elif await self.write_cached_response(get_token_balances, eth_address.lower()):
+            # keep the last query time up to date for polls within a block
+            await token_registration_cache.touch(eth_address)
 
 class TokenHandler(DatabaseMixin, RequestVerificationMixin, BaseHandler):
 
@@ -133,7 +180,8 @@ class TokenHandler(DatabaseMixin, RequestVerificationMixin, BaseHandler):
         self.set_header('Access-Control-Allow-Methods', 'GET')
 
         try:
-            result = await ToshiEthJsonRPC(None, self.application, self.request).get_token(contract_address)
+            async with ToshiEthJsonRPC(None, self.application, self.request) as rpc:
+                result = await rpc.get_token(contract_address)
         except JsonRPCError as e:
             raise JSONHTTPError(400, body={'errors': [e.data]})
 
@@ -146,7 +194,8 @@ class TokenHandler(DatabaseMixin, RequestVerificationMixin, BaseHandler):
         eth_address = self.verify_request()
 
         try:
-            result = await ToshiEthJsonRPC(eth_address, self.application, self.request).add_token(**self.json)
+            async with ToshiEthJsonRPC(eth_address, self.application, self.request) as rpc:
+                result = await rpc.add_token(**self.json)
         except JsonRPCInternalError as e:
             raise JSONHTTPError(500, body={'errors': [e.data]})
         except JsonRPCError as e:
@@ -162,7 +211,8 @@ class TokenHandler(DatabaseMixin, RequestVerificationMixin, BaseHandler):
         eth_address = self.verify_request()
 
         try:
-            await ToshiEthJsonRPC(eth_address, self.application, self.request).remove_token(contract_address=contract_address)
+            async with ToshiEthJsonRPC(eth_address, self.application, self.request) as rpc:
+                await rpc.remove_token(contract_address=contract_address)
         except JsonRPCInternalError as e:
             raise JSONHTTPError(500, body={'errors': [e.data]})
         except JsonRPCError as e:
@@ -173,7 +223,7 @@ class TokenHandler(DatabaseMixin, RequestVerificationMixin, BaseHandler):
         self.set_status(204)
 
 
-class CollectiblesHandler(DatabaseMixin, BaseHandler):
+class CollectiblesHandler(CachedResponseMixin, DatabaseMixin, BaseHandler):
 
     async def get(self, address, contract_address=None):
 
@@ -181,16 +231,20 @@ class CollectiblesHandler(DatabaseMixin, BaseHandler):
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
         self.set_header('Access-Control-Allow-Methods', 'GET')
 
-        try:
-            result = await ToshiEthJsonRPC(None, self.application, self.request).get_collectibles(address, contract_address)
-        except JsonRPCError as e:
-            raise JSONHTTPError(400, body={'errors': [e.data]})
+        async def get_collectibles():
+            try:
+                async with ToshiEthJsonRPC(None, self.application, self.request) as rpc:
+                    result = await rpc.get_collectibles(address, contract_address)
+            except JsonRPCError as e:
+                raise JSONHTTPError(400, body={'errors': [e.data]})
 
-        if result is None:
-            raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
-        self.write(result)
+            if result is None:
+                raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
+            return result
 
-class BalanceHandler(DatabaseMixin, BaseHandler):
+        await self.write_cached_response(get_collectibles, address.lower())
+
+class BalanceHandler(CachedResponseMixin, DatabaseMixin, BaseHandler):
 
     async def get(self, address):
 
@@ -198,12 +252,59 @@ class BalanceHandler(DatabaseMixin, BaseHandler):
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
         self.set_header('Access-Control-Allow-Methods', 'GET')
 
+        async def get_balance():
+            try:
+                async with ToshiEthJsonRPC(None, self.application, self.request) as rpc:
+                    return await rpc.get_balance(address)
+            except JsonRPCError as e:
+                raise JSONHTTPError(400, body={'errors': [e.data]})
+
+        await self.write_cached_response(get_balance, address.lower())
+
+class MultipleBalancesHandler(DatabaseMixin, BaseHandler):
+
+    async def get(self):
+
+        self.set_header("Access-Control-Allow-Origin", "*")
+        self.set_header("Access-Control-Allow-Headers", "x-requested-with")
+        self.set_header('Access-Control-Allow-Methods', 'GET')
+
+        addresses = self.get_query_arguments('address')
+
         try:
-            result = await ToshiEthJsonRPC(None, self.application, self.request).get_balance(address)
+            async with ToshiEthJsonRPC(None, self.application, self.request) as rpc:
+                result = await rpc.get_multiple_balances(addresses)
         except JsonRPCError as e:
             raise JSONHTTPError(400, body={'errors': [e.data]})
 
-        self.write(result)
+        self.write({"balances": result})
+
+def normalize_transaction_skeleton_arguments(args):
+    if 'from' in args:
+        args['from_address'] = args.pop('from')
+    if 'to' in args:
+        args['to_address'] = args.pop('to')
+    elif 'to_address' not in args:
+        args['to_address'] = None
+    # the following are to deal with different representations
+    # of the same concept from different places
+    if 'gasPrice' in args:
+        args['gas_price'] = args.pop('gasPrice')
+    if 'gasprice' in args:
+        args['gas_price'] = args.pop('gasprice')
+    if 'startgas' in args:
+        args['gas'] = args.pop('startgas')
+    if 'gasLimit' in args:
+        args['gas'] = args.pop('gasLimit')
+    if 'networkId' in args:
+        args['network_id'] = args.pop('networkId')
+    if 'chainId' in args:
+        args['network_id'] = args.pop('chainId')
+    if 'chain_id' in args:
+        args['network_id'] = args.pop('chain_id')
+    if 'tokenAddress' in args:
+        args['token_address'] = args.pop('tokenAddress')
+    return args
 
 class TransactionSkeletonHandler(RedisMixin, BaseHandler):
 
@@ -211,31 +312,9 @@ class TransactionSkeletonHandler(RedisMixin, BaseHandler):
 
         try:
             # normalize inputs
-            if 'from' in self.json:
-                self.json['from_address'] = self.json.pop('from')
-            if 'to' in self.json:
-                self.json['to_address'] = self.json.pop('to')
-            elif 'to_address' not in self.json:
-                self.json['to_address'] = None
-            # the following are to deal with different representations
-            # of the same concept from different places
-            if 'gasPrice' in self.json:
-                self.json['gas_price'] = self.json.pop('gasPrice')
-            if 'gasprice' in self.json:
-                self.json['gas_price'] = self.json.pop('gasprice')
-            if 'startgas' in self.json:
-                self.json['gas'] = self.json.pop('startgas')
-            if 'gasLimit' in self.json:
-                self.json['gas'] = self.json.pop('gasLimit')
-            if 'networkId' in self.json:
-                self.json['network_id'] = self.json.pop('networkId')
-            if 'chainId' in self.json:
-                self.json['network_id'] = self.json.pop('chainId')
-            if 'chain_id' in self.json:
-                self.json['network_id'] = self.json.pop('chain_id')
-            if 'tokenAddress' in self.json:
-                self.json['token_address'] = self.json.pop('tokenAddress')
-            result = await ToshiEthJsonRPC(None, self.application, self.request).create_transaction_skeleton(**self.json)
+            normalize_transaction_skeleton_arguments(self.json)
+            async with ToshiEthJsonRPC(None, self.application, self.request) as rpc:
+                result = await rpc.create_transaction_skeleton(**self.json)
         except JsonRPCError as e:
             log.warning("/tx/skel failed: " + json_encode(e.data) + "\" -> arguments: " + json_encode(self.json) + "\"")
             raise JSONHTTPError(400, body={'errors': [e.data]})
@@ -245,6 +324,24 @@ class TransactionSkeletonHandler(RedisMixin, BaseHandler):
 
         self.write(result)
 
+class TransactionSkeletonBatchHandler(RedisMixin, BaseHandler):
+
+    async def post(self):
+
+        if 'transactions' not in self.json or not isinstance(self.json['transactions'], list) or \
+           not all(isinstance(args, dict) for args in self.json['transactions']):
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
+
+        try:
+            transactions = [normalize_transaction_skeleton_arguments(args) for args in self.json['transactions']]
+            async with ToshiEthJsonRPC(None, self.application, self.request) as rpc:
+                results = await rpc.create_transaction_skeletons(transactions)
+        except JsonRPCError as e:
+            log.warning("/tx/skel/batch failed: " + json_encode(e.data))
+            raise JSONHTTPError(400, body={'errors': [e.data]})
+
+        self.write({"transactions": results})
+
 class SendTransactionHandler(BalanceMixin, DatabaseMixin, RedisMixin, RequestVerificationMixin, BaseHandler):
 
     async def post(self):
@@ -256,7 +353,8 @@ class SendTransactionHandler(BalanceMixin, DatabaseMixin, RedisMixin, RequestVer
             sender_toshi_id = None
 
         try:
-            result = await ToshiEthJsonRPC(sender_toshi_id, self.application, self.request).send_transaction(**self.json)
+            async with ToshiEthJsonRPC(sender_toshi_id, self.application, self.request) as rpc:
+                result = await rpc.send_transaction(**self.json)
         except JsonRPCInternalError as e:
             log.exception("Error in POST /tx from: {}: args: {}".format(sender_toshi_id, json_encode(self.json)))
             raise JSONHTTPError(500, body={'errors': [e.data]})
@@ -271,6 +369,33 @@ class SendTransactionHandler(BalanceMixin, DatabaseMixin, RedisMixin, RequestVer
             "tx_hash": result
         })
 
+class SendTransactionBatchHandler(BalanceMixin, DatabaseMixin, RedisMixin, RequestVerificationMixin, BaseHandler):
+
+    async def post(self):
+
+        if self.is_request_signed():
+            sender_toshi_id = self.verify_request()
+        else:
+            # these are anonymous transactions
+            sender_toshi_id = None
+
+        if 'transactions' not in self.json:
+            raise JSONHTTPError(400, body={'errors': [{'id': 'bad_arguments', 'message': 'Bad Arguments'}]})
+
+        try:
+            async with ToshiEthJsonRPC(sender_toshi_id, self.application, self.request) as rpc:
+                results = await rpc.send_transactions(self.json['transactions'])
+        except JsonRPCInternalError as e:
+            log.exception("Error in POST /tx/batch from: {}: args: {}".format(sender_toshi_id, json_encode(self.json)))
+            raise JSONHTTPError(500, body={'errors': [e.data]})
+        except JsonRPCError as e:
+            log.exception("Error in POST /tx/batch from: {}: args: {}".format(sender_toshi_id, json_encode(self.json)))
+            raise JSONHTTPError(400, body={'errors': [e.data]})
+
+        self.write({
+            "transactions": results
+        })
+
 class TransactionHandler(DatabaseMixin, BaseHandler):
 
     async def get(self, tx_hash):
@@ -281,8 +406,16 @@ class TransactionHandler(DatabaseMixin, BaseHandler):
 
         format = self.get_query_argument('format', 'rpc').lower()
 
+        if format == 'sofa':
+            message = await transaction_cache.get(tx_hash, kind='sofa')
+            if message is not None:
+                self.set_header('Content-Type', 'text/plain')
+                self.write(message.encode('utf-8'))
+                return
+
         try:
-            tx = await ToshiEthJsonRPC(None, self.application, self.request).get_transaction(tx_hash)
+            async with ToshiEthJsonRPC(None, self.application, self.request) as rpc:
+                tx = await rpc.get_transaction(tx_hash)
         except JsonRPCError as e:
             raise JSONHTTPError(400, body={'errors': [e.data]})
 
@@ -292,9 +425,7 @@ class TransactionHandler(DatabaseMixin, BaseHandler):
         if format == 'sofa':
 
             async with self.db:
-                row = await self.db.fetchrow(
-                    "SELECT * FROM transactions where hash = $1 ORDER BY transaction_id DESC",
-                    tx_hash)
+                row = await self.db.fetchrow(queries.TRANSACTION_BY_HASH, tx_hash)
             if row is None:
                 raise JSONHTTPError(404, body={'errors': [{'id': 'not_found', 'message': 'Not Found'}]})
             if tx is None:
@@ -303,6 +434,7 @@ class TransactionHandler(DatabaseMixin, BaseHandler):
                 tx['error'] = True
             payment = SofaPayment.from_transaction(tx, networkId=config['ethereum']['network_id'])
             message = payment.render()
+            await transaction_cache.set(tx_hash, message, transaction_cache.ttl(tx), kind='sofa')
             self.set_header('Content-Type', 'text/plain')
             self.write(message.encode('utf-8'))
 
@@ -325,12 +457,35 @@ class CancelTransactionHandler(DatabaseMixin, BaseHandler):
         signature = self.json['signature']
 
         try:
-            await ToshiEthJsonRPC(None, self.application, self.request).cancel_queued_transaction(tx_hash, signature)
+            async with ToshiEthJsonRPC(None, self.application, self.request) as rpc:
+                await rpc.cancel_queued_transaction(tx_hash, signature)
         except JsonRPCError as e:
             raise JSONHTTPError(400, body={'errors': [e.data]})
 
         self.set_status(204)
 
+# only the columns needed to render the address's transaction history
+ADDRESS_TRANSACTION_COLUMNS = ("transaction_id, hash, from_address, to_address, nonce, value, gas, gas_price, "
+                               "data, created, updated, status, blocknumber")
+
+def encode_transaction_cursor(row):
+    """returns an opaque cursor pointing at the given transaction row"""
+    created = row['created'] - datetime.datetime(1970, 1, 1)
+    return "{}-{}".format(created // datetime.timedelta(microseconds=1), row['transaction_id'])
+
+def decode_transaction_cursor(cursor):
+    """returns the (created, transaction_id) pair encoded in the given cursor,
+    or None if the cursor is invalid"""
+    created, _, transaction_id = cursor.partition('-')
+    created = parse_int(created)
+    transaction_id = parse_int(transaction_id)
+    if created is None or transaction_id is None:
+        return None
+    try:
+        return datetime.datetime(1970, 1, 1) + datetime.timedelta(microseconds=created), transaction_id
+    except OverflowError:
+        return None
+
 class AddressHandler(DatabaseMixin, BaseHandler):
 
     async def get(self, address):
@@ -341,6 +496,8 @@ class AddressHandler(DatabaseMixin, BaseHandler):
 
         offset = parse_int(self.get_argument('offset', '0'))
         limit = parse_int(self.get_argument('limit', '10'))
+        cursor = self.get_argument('cursor', None)
+        decoded_cursor = decode_transaction_cursor(cursor) if cursor is not None else None
         status = set([s.lower() for s in self.get_arguments('status')])
         direction = set([d.lower() for d in self.get_arguments('direction')])
         order = self.get_argument('order', 'desc').upper()
@@ -348,23 +505,18 @@ class AddressHandler(DatabaseMixin, BaseHandler):
         if not validate_address(address) or \
            offset is None or \
            limit is None or \
+           offset < 0 or limit < 0 or \
+           (cursor is not None and decoded_cursor is None) or \
            (status and not status.issubset(['confirmed', 'unconfirmed', 'queued', 'error'])) or \
            (direction and not direction.issubset(['in', 'out'])) or \
            (order not in ['DESC', 'ASC']):
             raise JSONHTTPError(400, body={'id': 'bad_arguments', 'message': 'Bad Arguments'})
 
-        query = "SELECT * FROM transactions WHERE "
-        args = [address, offset, limit]
-
-        if len(direction) == 0 or len(direction) == 2:
-            query += "(from_address = $1 OR to_address = $1) "
-        elif 'in' in direction:
-            query += "to_address = $1 "
-        elif 'out' in direction:
-            query += "from_address = $1 "
+        args = [address]
+        conditions = []
 
         if len(status) == 0:
-            query += "AND (status != 'error' OR status = 'new') "
+            conditions.append("(status != 'error' OR status = 'new')")
         else:
             status_query = []
             for s in status:
@@ -373,9 +525,38 @@ class AddressHandler(DatabaseMixin, BaseHandler):
                 else:
                     status_query.append("status = ${}".format(len(args) + 1))
                 args.append(s)
-            query += "AND (" + " OR ".join(status_query) + ") "
-
-        query += "ORDER BY created {} OFFSET $2 LIMIT $3".format(order)
+            conditions.append("(" + " OR ".join(status_query) + ")")
+
+        if decoded_cursor is not None:
+            # continue from the last row of the previous page, rather than
+            # skipping over all the earlier rows
+            args.extend(decoded_cursor)
+            conditions.append("(created, transaction_id) {} (${}, ${})".format(
+                '<' if order == 'DESC' else '>', len(args) - 1, len(args)))
+            offset = 0
+
+        # each branch only needs to provide enough rows for the requested page
+        args.append(offset + limit)
+        branch_limit = "${}".format(len(args))
+        args.append(offset)
+        page_offset = "${}".format(len(args))
+        args.append(limit)
+        page_limit = "${}".format(len(args))
+
+        order_by = "ORDER BY created {0}, transaction_id {0}".format(order)
+        branches = []
+        if len(direction) != 1 or 'out' in direction:
+            branches.append("from_address = $1")
+        if len(direction) != 1 or 'in' in direction:
+            # transactions sent to self are already included by the from_address branch
+            branches.append("to_address = $1 AND from_address != $1" if branches else "to_address = $1")
+        # a separate query per address column so each can be answered by
+        # an index scan in the requested order
+        query = " UNION ALL ".join(
+            "(SELECT {} FROM transactions WHERE {} {} LIMIT {})".format(
+                ADDRESS_TRANSACTION_COLUMNS, " AND ".join([branch] + conditions), order_by, branch_limit)
+            for branch in branches)
+        query = "SELECT * FROM ({}) AS t {} OFFSET {} LIMIT {}".format(query, order_by, page_offset, page_limit)
 
         async with self.db:
             rows = await self.db.fetch(query, *args)
@@ -399,7 +580,8 @@ class AddressHandler(DatabaseMixin, BaseHandler):
             "transactions": transactions,
             "offset": offset,
             "limit": limit,
-            "order": order
+            "order": order,
+            "next_cursor": encode_transaction_cursor(rows[-1]) if rows and len(rows) == limit else None
         }
         if len(direction) == 1:
             resp['direction'] = direction.pop()
@@ -407,7 +589,7 @@ class AddressHandler(DatabaseMixin, BaseHandler):
             resp['status'] = "&".join(status)
         self.write(resp)
 
-class GasPriceHandler(RedisMixin, BaseHandler):
+class GasPriceHandler(CachedResponseMixin, RedisMixin, BaseHandler):
 
     async def get(self):
 
@@ -415,18 +597,22 @@ class GasPriceHandler(RedisMixin, BaseHandler):
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
         self.set_header('Access-Control-Allow-Methods', 'GET')
 
+        await self.write_cached_response(self.get_gas_price)
+
+    async def get_gas_price(self):
+
         gas_station_gas_price = await self.redis.get('gas_station_fast_gas_price')
         if gas_station_gas_price is None:
-            gas_station_gas_price = await self.eth.eth_gasPrice()
+            gas_station_gas_price = await get_node_gas_price(get_ethereum_client())
             if gas_station_gas_price:
                 gas_station_gas_price = hex(gas_station_gas_price)
             else:
                 gas_station_gas_price = hex(config['ethereum'].getint('default_gasprice', DEFAULT_GASPRICE))
         else:
             gas_station_gas_price = gas_station_gas_price.decode('utf-8')
-        self.write({
+        return {
             "gas_price": gas_station_gas_price
-        })
+        }
 
 
 class PNRegistrationHandler(RequestVerificationMixin, DatabaseMixin, BaseHandler):
@@ -1,12 +1,13 @@
 import asyncio
 import binascii
+import random
+from tornado.escape import json_decode, json_encode
 from toshi.jsonrpc.handlers import JsonRPCBase, map_jsonrpc_arguments
 from toshi.jsonrpc.errors import JsonRPCInvalidParamsError, JsonRPCError
 from toshi.analytics import AnalyticsMixin
 from toshi.database import DatabaseMixin
-from toshi.jsonrpc.client import JsonRPCClient
 from toshi.redis import RedisMixin
-from toshi.ethereum.utils import data_decoder, data_encoder, checksum_validate_address
+from toshi.ethereum.utils import data_decoder, data_encoder, checksum_validate_address, sha3
 from ethereum.exceptions import InvalidTransaction
 from ethereum.abi import decode_abi
 from functools import partial
@@ -24,12 +25,35 @@ from toshi.ethereum.utils import personal_ecrecover
 from toshi.log import log
 
 from toshi.config import config
+from toshieth import queries
+from toshieth.analytics import analytics_buffer
+from toshieth.cache import (
+    gas_estimate_cache, transaction_cache, token_registration_cache, gas_price_whitelist_cache,
+    get_code, get_node_gas_price, invalidate_addresses
+)
+from toshieth.database import RequestDatabaseContext
+from toshieth.ethclient import get_ethereum_client
 from toshieth.mixins import BalanceMixin
+from toshieth.nonce import nonce_manager
 from toshieth.utils import RedisLock, RedisLockException, database_transaction_to_rlp_transaction, unwrap_or
 from toshieth.tasks import manager_dispatcher, erc20_dispatcher
 
 from toshieth.constants import ERC20_NAME_CALL_DATA, ERC20_DECIMALS_CALL_DATA, ERC20_SYMBOL_CALL_DATA, ERC20_BALANCEOF_CALL_DATA
 
+# maximum number of skeletons that can be created in a single batch request
+MAX_BATCH_SIZE = 100
+# multiplier applied to cached gas estimates to cover variations between senders
+GAS_ESTIMATE_SAFETY_MARGIN = 1.1
+# fraction of cached gas estimates that are checked against the node
+GAS_ESTIMATE_VERIFY_RATE = 0.05
+ERC20_TRANSFER_SELECTOR = data_decoder("0xa9059cbb")
+
+def is_erc20_transfer_data(data):
+    """checks if the given transaction data is an erc20 `transfer` or `transferFrom` call"""
+    data = data_encoder(data)
+    return (data.startswith("0xa9059cbb") and len(data) == 138) or \
+        (data.startswith("0x23b872dd") and len(data) == 202)
+
 class JsonRPCInsufficientFundsError(JsonRPCError):
     def __init__(self, *, request=None, data=None):
         super().__init__(request.get('id') if request else None,
@@ -37,23 +61,13 @@ class JsonRPCInsufficientFundsError(JsonRPCError):
                          'id' not in request if request else False)
 
 
-COLLECTIBLE_UNION_QUERY = """
-SELECT t.contract_address AS contract_address, COUNT(t.token_id) AS value, c.name, c.icon, c.url
-FROM collectible_tokens t
-JOIN collectibles c ON c.contract_address = t.contract_address
-WHERE t.owner_address = $1 AND c.ready = true
-GROUP BY t.contract_address, c.name, c.icon, c.url
-
-UNION
-
-SELECT c.contract_address AS contract_address, COUNT(b.contract_address) AS value, c.name, c.icon, c.url
-FROM fungible_collectible_balances b
-JOIN fungible_collectibles fc ON fc.contract_address = b.contract_address
-JOIN collectibles c ON fc.collectible_address = c.contract_address
-WHERE b.owner_address = $1 AND b.balance != '0x0' AND fc.ready = true
-GROUP BY c.contract_address, c.name, c.icon, c.url
-
-ORDER BY contract_address
+# collectible_owner_summaries is kept up to date by the collectible managers
+COLLECTIBLE_SUMMARY_QUERY = """
+SELECT s.collectible_address AS contract_address, s.value, c.name, c.icon, c.url
+FROM collectible_owner_summaries s
+JOIN collectibles c ON c.contract_address = s.collectible_address
+WHERE s.owner_address = $1 AND c.ready = true
+ORDER BY s.collectible_address
 """
 
 class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin, RedisMixin):
@@ -63,17 +77,27 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
         self.application = application
         self.request = request
 
+    async def __aenter__(self):
+        # hold on to a single database connection until the request is done
+        self.db.hold()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.db.release()
+
+    @property
+    def db(self):
+        if not hasattr(self, '_request_db'):
+            self._request_db = RequestDatabaseContext(self.application.connection_pool)
+        return self._request_db
+
     @property
     def network_id(self):
         return parse_int(config['ethereum']['network_id'])
 
     @property
     def eth(self):
-        if not hasattr(self, '_eth_jsonrpc_client'):
-            self._eth_jsonrpc_client = JsonRPCClient(
-                config['ethereum']['url'],
-                connect_timeout=5.0, request_timeout=5.0)
-        return self._eth_jsonrpc_client
+        return get_ethereum_client()
 
     async def get_balance(self, address):
 
@@ -87,22 +111,46 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
             "unconfirmed_balance": hex(unconfirmed)
         }
 
+    async def get_multiple_balances(self, addresses):
+
+        if not isinstance(addresses, list) or len(addresses) == 0:
+            raise JsonRPCInvalidParamsError(data={'id': 'bad_arguments', 'message': 'Bad Arguments'})
+        if len(addresses) > MAX_BATCH_SIZE:
+            raise JsonRPCInvalidParamsError(data={'id': 'too_many_addresses',
+                                                  'message': 'Cannot get the balance of more than {} addresses at once'.format(MAX_BATCH_SIZE)})
+        for address in addresses:
+            if not validate_address(address):
+                raise JsonRPCInvalidParamsError(data={'id': 'invalid_address', 'message': 'Invalid Address'})
+
+        balances = await self.get_balances_for_addresses(addresses)
+
+        return {
+            address: {
+                "confirmed_balance": hex(confirmed),
+                "unconfirmed_balance": hex(unconfirmed)
+            } for address, (confirmed, unconfirmed, _, _) in balances.items()
+        }
+
     async def get_transaction_count(self, address):
 
         if not validate_address(address):
             raise JsonRPCInvalidParamsError(data={'id': 'invalid_address', 'message': 'Invalid Address'})
 
-        # get the network nonce
-        nw_nonce = await self.eth.eth_getTransactionCount(address)
+        return await nonce_manager.get(address, partial(self._get_network_transaction_count, address))
+
+    async def _reconcile_transaction_count(self, address):
+        return await nonce_manager.reconcile(address, partial(self._get_network_transaction_count, address))
+
+    async def _get_network_transaction_count(self, address):
 
         # check the database for queued txs
         async with self.db:
-            nonce = await self.db.fetchval(
-                "SELECT nonce FROM transactions "
-                "WHERE from_address = $1 "
-                "AND (status = 'new' OR status = 'queued' OR status = 'unconfirmed') "
-                "ORDER BY nonce DESC",
-                address)
+            nonce = await self.db.fetchval(queries.LAST_QUEUED_NONCE, address)
+
+        # get the network nonce. this has to come from the latest block rather
+        # than the last one processed by the monitor, otherwise transactions in
+        # blocks it hasn't seen yet are missed and their nonces reused
+        nw_nonce = await self.eth.eth_getTransactionCount(address)
 
         if nonce is not None:
             # return the next usable nonce
@@ -116,6 +164,127 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
     @map_jsonrpc_arguments({'from': 'from_address', 'to': 'to_address'})
     async def create_transaction_skeleton(self, *, to_address, from_address, value=0, nonce=None, gas=None, gas_price=None, data=None, network_id=None, token_address=None):
 
+        skel = await self._prepare_transaction_skeleton(
+            {}, to_address=to_address, from_address=from_address, value=value, nonce=nonce, gas=gas,
+            gas_price=gas_price, data=data, network_id=network_id, token_address=token_address)
+        if skel['nonce'] is None:
+            # check cache for nonce
+            skel['nonce'] = await self.get_transaction_count(skel['from_address'])
+        return self._build_transaction_skeleton(skel)
+
+    async def create_transaction_skeletons(self, skeletons):
+        """creates multiple transaction skeletons at once, sharing the gas price
+        lookup between them and giving transactions from the same sender
+        consecutive nonces. Transactions from the same sender are checked
+        against what the sender has left after the ones before them. Returns a
+        list with either the skeleton or the error for each of the given
+        requests"""
+
+        if not isinstance(skeletons, list) or not all(isinstance(skel, dict) for skel in skeletons):
+            raise JsonRPCInvalidParamsError(data={'id': 'bad_arguments', 'message': 'Bad Arguments'})
+        if len(skeletons) > MAX_BATCH_SIZE:
+            raise JsonRPCInvalidParamsError(data={'id': 'too_many_transactions',
+                                                  'message': 'Cannot create more than {} transactions at once'.format(MAX_BATCH_SIZE)})
+
+        shared = {'gas_price': await self._get_default_gas_price()}
+
+        async def prepare(skel, spent):
+            try:
+                return await self._prepare_transaction_skeleton(shared, spent=spent, **skel)
+            except JsonRPCError as e:
+                return e
+            except TypeError:
+                return JsonRPCInvalidParamsError(data={'id': 'bad_arguments', 'message': 'Bad Arguments'})
+
+        async def prepare_sender(indexes):
+            # the sender's transactions are prepared one after the other, so
+            # each one only gets what the ones before it left over
+            spent = {}
+            balance = None
+            for i in indexes:
+                skel = prepared[i] = await prepare(skeletons[i], spent)
+                if isinstance(skel, JsonRPCError):
+                    continue
+                cost = skel['value'] + skel['gas'] * skel['gas_price']
+                if len(indexes) > 1:
+                    if balance is None:
+                        _, balance, _, _ = await self.get_balances(skel['from_address'])
+                    if spent.get(None, 0) + cost > balance:
+                        prepared[i] = JsonRPCInsufficientFundsError(data={'id': 'insufficient_funds', 'message': 'Insufficient Funds'})
+                        continue
+                spent[None] = spent.get(None, 0) + cost
+                if skel['token_value'] is not None:
+                    token_address = skel['to_address'].lower()
+                    spent[token_address] = spent.get(token_address, 0) + skel['token_value']
+
+        skeletons = [dict(skel) for skel in skeletons]
+        senders = {}
+        for i, skel in enumerate(skeletons):
+            if 'from' in skel:
+                skel['from_address'] = skel.pop('from')
+            if 'to' in skel:
+                skel['to_address'] = skel.pop('to')
+            from_address = skel.get('from_address')
+            key = from_address.strip().lower() if isinstance(from_address, str) else i
+            senders.setdefault(key, []).append(i)
+
+        # different senders are prepared concurrently, the node calls they
+        # make are sent as batch requests by the shared ethereum client
+        prepared = [None] * len(skeletons)
+        failures = [result for result in await asyncio.gather(
+            *[prepare_sender(indexes) for indexes in senders.values()], return_exceptions=True)
+            if isinstance(result, Exception)]
+        if failures:
+            raise failures[0]
+
+        # assign nonces in request order, skipping failed requests so
+        # there are no gaps in each sender's nonces, and making sure nonces
+        # given explicitly by earlier requests aren't reused
+        next_nonces = {}
+        explicit_nonces = {}
+        results = []
+        for skel in prepared:
+            if isinstance(skel, JsonRPCError):
+                results.append({'errors': [skel.data]})
+                continue
+            sender = skel['from_address'].lower()
+            if skel['nonce'] is None:
+                if sender not in next_nonces:
+                    next_nonces[sender] = max(await self.get_transaction_count(skel['from_address']),
+                                              explicit_nonces.get(sender, 0))
+                skel['nonce'] = next_nonces[sender]
+            try:
+                results.append(self._build_transaction_skeleton(skel))
+            except JsonRPCError as e:
+                results.append({'errors': [e.data]})
+                continue
+            if sender in next_nonces:
+                next_nonces[sender] = max(next_nonces[sender], skel['nonce'] + 1)
+            else:
+                explicit_nonces[sender] = max(explicit_nonces.get(sender, 0), skel['nonce'] + 1)
+        return results
+
+    async def _get_default_gas_price(self):
+        # try and use cached gas station gas price
+        gas_station_gas_price = await self.redis.get('gas_station_fast_gas_price')
+        if gas_station_gas_price:
+            gas_price = parse_int(gas_station_gas_price)
+            if gas_price is not None:
+                return gas_price
+        gas_price = await get_node_gas_price(self.eth)
+        if gas_price is None:
+            gas_price = config['ethereum'].getint('default_gasprice', DEFAULT_GASPRICE)
+        return gas_price
+
+    async def _prepare_transaction_skeleton(self, shared, *, to_address, from_address, value=0, nonce=None, gas=None, gas_price=None, data=None, network_id=None, token_address=None, spent=None):
+        """validates the skeleton arguments and works out the gas, gas price, value and
+        data of the transaction. `shared` holds lookups already done for a batch of
+        skeletons, and `spent` the amounts of ether (keyed by None) and tokens (keyed
+        by the token's address) already used by earlier transactions from the sender
+        in the batch"""
+
+        spent = spent or {}
+
         # strip begining and trailing whitespace from addresses
         if to_address is not None and isinstance(to_address, str):
             to_address = to_address.strip()
@@ -162,22 +331,16 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
         # anytime the nonce is also set, use the provided gas (this is to
         # support easier overwriting of transactions)
         if gas_price is not None and nonce is None:
-            async with self.db:
-                whitelisted = await self.db.fetchrow("SELECT 1 FROM from_address_gas_price_whitelist WHERE address = $1", from_address)
-                if not whitelisted:
-                    whitelisted = await self.db.fetchrow("SELECT 1 FROM to_address_gas_price_whitelist WHERE address = $1", to_address)
+            whitelisted = await gas_price_whitelist_cache.is_whitelisted(
+                self.application.connection_pool, from_address, to_address)
             if not whitelisted:
                 gas_price = None
 
         if gas_price is None:
-            # try and use cached gas station gas price
-            gas_station_gas_price = await self.redis.get('gas_station_fast_gas_price')
-            if gas_station_gas_price:
-                gas_price = parse_int(gas_station_gas_price)
-            if gas_price is None:
-                gas_price = await self.eth.eth_gasPrice()
-                if gas_price is None:
-                    gas_price = config['ethereum'].getint('default_gasprice', DEFAULT_GASPRICE)
+            if 'gas_price' in shared:
+                gas_price = shared['gas_price']
+            else:
+                gas_price = await self._get_default_gas_price()
         else:
             gas_price = parse_int(gas_price)
             if gas_price is None:
@@ -188,10 +351,7 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
             if gas is None:
                 raise JsonRPCInvalidParamsError(data={'id': 'invalid_gas', 'message': 'Invalid Gas'})
 
-        if nonce is None:
-            # check cache for nonce
-            nonce = await self.get_transaction_count(from_address)
-        else:
+        if nonce is not None:
             nonce = parse_int(nonce)
             if nonce is None:
                 raise JsonRPCInvalidParamsError(data={'id': 'invalid_nonce', 'message': 'Invalid Nonce'})
@@ -219,9 +379,7 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
             if isinstance(value, str) and value.lower() == "max":
                 # get the balance in the database
                 async with self.db:
-                    value = await self.db.fetchval("SELECT balance FROM token_balances "
-                                                   "WHERE contract_address = $1 AND eth_address = $2",
-                                                   token_address, from_address)
+                    value = await self.db.fetchval(queries.TOKEN_BALANCE, token_address, from_address)
                 if value is None:
                     # get the value from the ethereum node
                     data = "0x70a08231000000000000000000000000" + from_address[2:].lower()
@@ -229,6 +387,9 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
                         value = await self.eth.eth_call(to_address=token_address, data=data)
                     except:
                         log.exception("Unable to get balance for token {} for address {}".format(token_address, from_address))
+                value = parse_int(value)
+                if value is not None:
+                    value -= spent.get(token_address.lower(), 0)
 
             value = parse_int(value)
             if value is None or value < 0:
@@ -242,8 +403,9 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
 
             if value == "max":
                 network_balance, balance, _, _ = await self.get_balances(from_address)
+                balance -= spent.get(None, 0)
                 if gas is None:
-                    code = await self.eth.eth_getCode(to_address)
+                    code = await get_code(self.eth, to_address)
                     if code:
                         # we might have to do some work
                         try:
@@ -286,8 +448,21 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
                     raise JsonRPCInvalidParamsError(data={'id': 'invalid_value', 'message': 'Invalid Value'})
 
         if gas is None:
+            bal = None
+            if token_address is not None:
+                async with self.db:
+                    bal = await self.db.fetchval(queries.TOKEN_BALANCE, token_address, from_address)
+                if bal is not None:
+                    bal = parse_int(bal) - spent.get(token_address.lower(), 0)
+                    # the node only knows about the current balance, not what
+                    # earlier transactions in the batch are going to send
+                    if token_address.lower() in spent and bal < token_value:
+                        raise JsonRPCInsufficientFundsError(data={'id': 'insufficient_funds', 'message': 'Insufficient Funds'})
             try:
-                gas = await self.eth.eth_estimateGas(from_address, to_address, data=data, value=value)
+                # cached estimates skip the node's check that the call succeeds, so they
+                # are only used for token transfers the sender is known to be able to afford
+                gas = await self._estimate_gas(from_address, to_address, data, value,
+                                               cacheable=bal is not None and bal >= token_value)
             except JsonRPCError:
                 # this can occur if sending a transaction to a contract that doesn't match a valid method
                 # and the contract has no default method implemented.
@@ -297,19 +472,21 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
                     # when dealing with erc20, this usually means the user's balance for that token isn't
                     # high enough, check that and throw an error if it's the case, and if not fall
                     # back to the standard invalid_data error
-                    async with self.db:
-                        bal = await self.db.fetchval("SELECT balance FROM token_balances "
-                                                     "WHERE contract_address = $1 AND eth_address = $2",
-                                                     token_address, from_address)
-                    if bal is not None:
-                        bal = parse_int(bal)
-                        if bal < token_value:
-                            raise JsonRPCInsufficientFundsError(data={'id': 'insufficient_funds', 'message': 'Insufficient Funds'})
+                    if bal is not None and bal < token_value:
+                        raise JsonRPCInsufficientFundsError(data={'id': 'insufficient_funds', 'message': 'Insufficient Funds'})
                 raise JsonRPCInvalidParamsError(data={'id': 'invalid_data', 'message': 'Unable to estimate gas for contract call'})
             # if data is present, buffer gas estimate by 20%
             if len(data) > 0:
                 gas = int(gas * 1.2)
 
+        return {'from_address': from_address, 'to_address': to_address, 'value': value,
+                'token_value': token_value if token_address else None, 'nonce': nonce,
+                'gas': gas, 'gas_price': gas_price, 'data': data}
+
+    def _build_transaction_skeleton(self, skel):
+
+        nonce, gas, gas_price = skel['nonce'], skel['gas'], skel['gas_price']
+        to_address, value, data = skel['to_address'], skel['value'], skel['data']
         try:
             tx = create_transaction(nonce=nonce, gasprice=gas_price, startgas=gas,
                                     to=to_address, value=value, data=data,
@@ -331,9 +508,47 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
         transaction = encode_transaction(tx)
 
         return {"tx": transaction, "gas": hex(gas), "gas_price": hex(gas_price), "nonce": hex(nonce),
-                "value": hex(token_value) if token_address else hex(value)}
+                "value": hex(skel['token_value']) if skel['token_value'] is not None else hex(value)}
+
+    async def _estimate_gas(self, from_address, to_address, data, value, cacheable=False):
+
+        if not cacheable:
+            return await self.eth.eth_estimateGas(from_address, to_address, data=data, value=value)
+
+        code = await get_code(self.eth, to_address)
+        if not isinstance(code, bytes):
+            code = data_decoder(code)
+        key = (to_address, data[:4], sha3(code), len(data) // 32)
+        cached = gas_estimate_cache.get(key)
+        if cached is not None and random.random() >= GAS_ESTIMATE_VERIFY_RATE:
+            return int(cached * GAS_ESTIMATE_SAFETY_MARGIN)
+
+        if data[:4] == ERC20_TRANSFER_SELECTOR and len(data) == 68:
+            # only estimates for transfers to addresses without a balance are
+            # cached. they pay for an extra storage write (~20k gas), so the
+            # cached estimate also covers transfers to existing holders
+            # without having to look up the recipient's balance
+            try:
+                recipient_balance = parse_int(await self.eth.eth_call(
+                    to_address=to_address, data=ERC20_BALANCEOF_CALL_DATA + data_encoder(data[4:36])[2:]))
+            except JsonRPCError:
+                recipient_balance = None
+            if recipient_balance != 0:
+                gas = await self.eth.eth_estimateGas(from_address, to_address, data=data, value=value)
+                if cached is not None:
+                    return max(gas, int(cached * GAS_ESTIMATE_SAFETY_MARGIN))
+                return gas
 
-    async def send_transaction(self, *, tx, signature=None):
+        gas = await self.eth.eth_estimateGas(from_address, to_address, data=data, value=value)
+        if cached is not None and gas > cached * GAS_ESTIMATE_SAFETY_MARGIN:
+            log.warning("Cached gas estimate for {} ({}) too low: cached: {}, node: {}".format(
+                to_address, data_encoder(data[:4]), cached, gas))
+        gas_estimate_cache.set(key, max(gas, cached or 0))
+        return gas
+
+    def _decode_signed_transaction(self, tx, signature=None):
+        """decodes the given transaction, adding the signature to it if
+        it's not already signed"""
 
         try:
             tx = decode_transaction(tx)
@@ -385,6 +600,12 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
                 'message': 'Invalid Network ID'
             })
 
+        return tx
+
+    async def send_transaction(self, *, tx, signature=None):
+
+        tx = self._decode_signed_transaction(tx, signature)
+
         from_address = data_encoder(tx.sender)
         to_address = data_encoder(tx.to)
 
@@ -394,12 +615,14 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
                 raise_when_locked=partial(JsonRPCInvalidParamsError, data={'id': 'invalid_nonce', 'message': 'Nonce already used'}),
                 ex=5):
 
-            # check for transaction overwriting
             async with self.db:
-                existing = await self.db.fetchrow("SELECT * FROM transactions WHERE "
-                                                  "from_address = $1 AND nonce = $2 AND "
-                                                  "(status != 'error' or status = 'new')",
-                                                  from_address, tx.nonce)
+                # check for transaction overwriting
+                existing = await self.db.fetchrow(queries.ACTIVE_TRANSACTION_BY_NONCE, from_address, tx.nonce)
+                if is_erc20_transfer_data(tx.data):
+                    # check if the token is a known erc20 token
+                    erc20_token = await self.db.fetchrow(queries.TOKEN, to_address)
+                else:
+                    erc20_token = False
 
             # disallow transaction overwriting when the gas is lower or the transaction is confirmed
             if existing and (parse_int(existing['gas_price']) >= tx.gasprice or existing['status'] == 'confirmed'):
@@ -416,6 +639,9 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
             # validate the nonce (only necessary if tx doesn't already exist)
             if not existing:
                 c_nonce = await self.get_transaction_count(from_address)
+                if tx.nonce != c_nonce:
+                    # make sure the stored nonce hasn't drifted from the node before rejecting
+                    c_nonce = await self._reconcile_transaction_count(from_address)
 
                 if tx.nonce < c_nonce:
                     raise JsonRPCInvalidParamsError(data={'id': 'invalid_nonce', 'message': 'Provided nonce is too low'})
@@ -435,89 +661,185 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
                 log.info("Setting tx '{}' to error due to forced overwrite".format(existing['hash']))
                 manager_dispatcher.update_transaction(existing['transaction_id'], 'error')
 
-            data = data_encoder(tx.data)
-            if data and \
-               ((data.startswith("0xa9059cbb") and len(data) == 138) or \
-                (data.startswith("0x23b872dd") and len(data) == 202)):
-                # check if the token is a known erc20 token
-                async with self.db:
-                    erc20_token = await self.db.fetchrow("SELECT * FROM tokens WHERE contract_address = $1",
-                                                         to_address)
-            else:
-                erc20_token = False
-
             # add tx to database
             async with self.db:
-                db_tx = await self.db.fetchrow(
-                    "INSERT INTO transactions "
-                    "(hash, from_address, to_address, nonce, "
-                    "value, gas, gas_price, "
-                    "data, v, r, s, "
-                    "sender_toshi_id) "
-                    "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12) "
-                    "RETURNING transaction_id",
-                    tx_hash, from_address, to_address, tx.nonce,
-                    hex(tx.value), hex(tx.startgas), hex(tx.gasprice),
-                    data_encoder(tx.data), hex(tx.v), hex(tx.r), hex(tx.s),
-                    self.user_toshi_id)
-
-                if erc20_token:
-                    token_value = int(data[-64:], 16)
-                    if data.startswith("0x23b872dd"):
-                        erc20_from_address = "0x" + data[34:74]
-                        erc20_to_address = "0x" + data[98:138]
-                    else:
-                        erc20_from_address = from_address
-                        erc20_to_address = "0x" + data[34:74]
-                    await self.db.execute(
-                        "INSERT INTO token_transactions "
-                        "(transaction_id, transaction_log_index, contract_address, from_address, to_address, value) "
-                        "VALUES ($1, $2, $3, $4, $5, $6)",
-                        db_tx['transaction_id'], 0, erc20_token['contract_address'],
-                        erc20_from_address, erc20_to_address, hex(token_value))
-
+                await self._insert_transaction(tx, tx_hash, erc20_token)
                 await self.db.commit()
+            if not existing:
+                await nonce_manager.submitted(from_address, tx.nonce)
+            await invalidate_addresses(from_address, to_address)
 
             # trigger processing the transaction queue
             manager_dispatcher.process_transaction_queue(from_address)
             # analytics
-            # use notification registrations to try find toshi ids for users
-            if self.user_toshi_id:
-                sender_toshi_id = self.user_toshi_id
-            else:
-                async with self.db:
-                    sender_toshi_id = await self.db.fetchval(
-                        "SELECT toshi_id FROM notification_registrations WHERE "
-                        "eth_address = $1",
-                        from_address)
-            async with self.db:
-                receiver_toshi_id = await self.db.fetchval(
-                    "SELECT toshi_id FROM notification_registrations WHERE "
-                    "eth_address = $1",
-                    to_address)
-            self.track(sender_toshi_id, "Sent transaction")
+            # the buffer uses notification registrations to try find toshi ids for users
+            analytics_buffer.add(self, self.user_toshi_id, from_address, "Sent transaction")
             # it doesn't make sense to add user agent here as we
             # don't know the receiver's user agent
-            self.track(receiver_toshi_id, "Received transaction", add_user_agent=False)
+            analytics_buffer.add(self, None, to_address, "Received transaction", add_user_agent=False)
 
         return tx_hash
 
+    async def send_transactions(self, transactions):
+        """adds multiple signed transactions to the transaction queue at once.
+
+        All the transactions from a sender are validated against a single
+        snapshot of the sender's balance and nonce, and must have consecutive
+        nonces starting at the sender's next usable nonce (overwriting queued
+        transactions is only possible via `send_transaction`). Returns a list
+        with either the transaction hash or the error for each transaction"""
+
+        if not isinstance(transactions, list) or not all(isinstance(tx, dict) for tx in transactions):
+            raise JsonRPCInvalidParamsError(data={'id': 'bad_arguments', 'message': 'Bad Arguments'})
+        if len(transactions) > MAX_BATCH_SIZE:
+            raise JsonRPCInvalidParamsError(data={'id': 'too_many_transactions',
+                                                  'message': 'Cannot send more than {} transactions at once'.format(MAX_BATCH_SIZE)})
+
+        results = [None] * len(transactions)
+        senders = {}
+        for i, args in enumerate(transactions):
+            try:
+                if 'tx' not in args or set(args) - {'tx', 'signature'}:
+                    raise JsonRPCInvalidParamsError(data={'id': 'bad_arguments', 'message': 'Bad Arguments'})
+                tx = self._decode_signed_transaction(args['tx'], args.get('signature'))
+                from_address = data_encoder(tx.sender)
+            except JsonRPCError as e:
+                results[i] = {'errors': [e.data]}
+                continue
+            except InvalidTransaction:
+                results[i] = {'errors': [{'id': 'invalid_signature', 'message': 'Invalid Signature'}]}
+                continue
+            senders.setdefault(from_address, []).append((i, tx))
+
+        locks = []
+        try:
+            # prevent spamming of transactions with the same nonce from the same sender.
+            # locks are only recorded once they are taken, so exactly those are released
+            for from_address, txs in senders.items():
+                for i, tx in txs:
+                    lock = RedisLock("{}:{}".format(from_address, tx.nonce), ex=5)
+                    try:
+                        await lock.__aenter__()
+                    except RedisLockException:
+                        results[i] = {'errors': [{'id': 'invalid_nonce', 'message': 'Nonce already used'}]}
+                        continue
+                    locks.append(lock)
+
+            accepted = []
+            for from_address, txs in senders.items():
+                txs = sorted([(i, tx) for i, tx in txs if results[i] is None], key=lambda item: item[1].nonce)
+                if not txs:
+                    continue
+                _, balance, _, _ = await self.get_balances(from_address)
+                nonce = await self.get_transaction_count(from_address)
+                if txs[0][1].nonce != nonce:
+                    nonce = await self._reconcile_transaction_count(from_address)
+                for i, tx in txs:
+                    if tx.nonce < nonce:
+                        error = {'id': 'invalid_nonce', 'message': 'Provided nonce is too low'}
+                    elif tx.nonce > nonce:
+                        error = {'id': 'invalid_nonce', 'message': 'Provided nonce is too high'}
+                    elif balance < (tx.value + (tx.startgas * tx.gasprice)):
+                        error = {'id': 'insufficient_funds', 'message': 'Insufficient Funds'}
+                    elif tx.intrinsic_gas_used > tx.startgas:
+                        error = {
+                            'id': 'invalid_transaction',
+                            'message': 'Transaction gas is too low. There is not enough gas to cover minimal cost of the transaction (minimal: {}, got: {}). Try increasing supplied gas.'.format(tx.intrinsic_gas_used, tx.startgas)}
+                    else:
+                        error = None
+                    if error:
+                        results[i] = {'errors': [error]}
+                        continue
+                    balance -= tx.value + (tx.startgas * tx.gasprice)
+                    nonce += 1
+                    accepted.append((i, tx, calculate_transaction_hash(tx)))
+
+            if not accepted:
+                return results
+
+            token_addresses = {data_encoder(tx.to) for _, tx, _ in accepted if is_erc20_transfer_data(tx.data)}
+            async with self.db:
+                if token_addresses:
+                    erc20_tokens = {row['contract_address']: row for row in await self.db.fetch(
+                        queries.TOKENS, list(token_addresses))}
+                else:
+                    erc20_tokens = {}
+                for _, tx, tx_hash in accepted:
+                    await self._insert_transaction(tx, tx_hash, erc20_tokens.get(data_encoder(tx.to), False))
+                await self.db.commit()
+        finally:
+            for lock in locks:
+                await lock.__aexit__(None, None, None)
+
+        for i, _, tx_hash in accepted:
+            results[i] = {'tx_hash': tx_hash}
+        last_nonces = {}
+        for _, tx, _ in accepted:
+            last_nonces[data_encoder(tx.sender)] = max(tx.nonce, last_nonces.get(data_encoder(tx.sender), 0))
+        for from_address, nonce in last_nonces.items():
+            await nonce_manager.submitted(from_address, nonce)
+        await invalidate_addresses(*[data_encoder(address) for _, tx, _ in accepted for address in (tx.sender, tx.to)])
+
+        # trigger processing the transaction queues
+        from_addresses = {data_encoder(tx.sender) for _, tx, _ in accepted}
+        for from_address in from_addresses:
+            manager_dispatcher.process_transaction_queue(from_address)
+
+        # analytics
+        # the buffer uses notification registrations to try find toshi ids for users
+        for _, tx, _ in accepted:
+            analytics_buffer.add(self, self.user_toshi_id, data_encoder(tx.sender), "Sent transaction")
+            # it doesn't make sense to add user agent here as we
+            # don't know the receiver's user agent
+            analytics_buffer.add(self, None, data_encoder(tx.to), "Received transaction", add_user_agent=False)
+
+        return results
+
+    async def _insert_transaction(self, tx, tx_hash, erc20_token):
+        """adds the transaction to the database. must be called with the
+        database connection acquired, and doesn't commit"""
+
+        from_address = data_encoder(tx.sender)
+        to_address = data_encoder(tx.to)
+        data = data_encoder(tx.data)
+        db_tx = await self.db.fetchrow(
+            queries.INSERT_TRANSACTION,
+            tx_hash, from_address, to_address, tx.nonce,
+            hex(tx.value), hex(tx.startgas), hex(tx.gasprice),
+            data, hex(tx.v), hex(tx.r), hex(tx.s),
+            self.user_toshi_id)
+
+        if erc20_token:
+            token_value = int(data[-64:], 16)
+            if data.startswith("0x23b872dd"):
+                erc20_from_address = "0x" + data[34:74]
+                erc20_to_address = "0x" + data[98:138]
+            else:
+                erc20_from_address = from_address
+                erc20_to_address = "0x" + data[34:74]
+            await self.db.execute(
+                queries.INSERT_TOKEN_TRANSACTION,
+                db_tx['transaction_id'], 0, erc20_token['contract_address'],
+                erc20_from_address, erc20_to_address, hex(token_value))
+
     async def get_transaction(self, tx_hash):
 
         if not validate_transaction_hash(tx_hash):
             raise JsonRPCInvalidParamsError(data={'id': 'invalid_transaction_hash', 'message': 'Invalid Transaction Hash'})
 
+        cached = await transaction_cache.get(tx_hash)
+        if cached is not None:
+            return json_decode(cached)
+
         tx = await self.eth.eth_getTransactionByHash(tx_hash)
         if tx is None:
             async with self.db:
-                tx = await self.db.fetchrow(
-                    "SELECT * FROM transactions WHERE "
-                    "hash = $1 AND (status != 'error' OR status = 'new') "
-                    "ORDER BY transaction_id DESC",
-                    tx_hash)
+                tx = await self.db.fetchrow(queries.ACTIVE_TRANSACTION_BY_HASH, tx_hash)
             if tx:
                 tx = database_transaction_to_rlp_transaction(tx)
                 tx = transaction_to_json(tx)
+        if tx is not None:
+            await transaction_cache.set(tx_hash, json_encode(tx), transaction_cache.ttl(tx))
         return tx
 
     async def cancel_queued_transaction(self, tx_hash, signature):
@@ -529,8 +851,7 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
             raise JsonRPCInvalidParamsError(data={'id': 'invalid_signature', 'message': 'Invalid Signature'})
 
         async with self.db:
-            tx = await self.db.fetchrow("SELECT * FROM transactions WHERE hash = $1 AND (status != 'error' OR status = 'new')",
-                                        tx_hash)
+            tx = await self.db.fetchrow(queries.ACTIVE_TRANSACTION_BY_HASH, tx_hash)
         if tx is None:
             raise JsonRPCError(None, -32000, "Transaction not found",
                                {'id': 'not_found', 'message': 'Transaction not found'})
@@ -552,17 +873,20 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
         if token_address is not None and not validate_address(token_address):
             raise JsonRPCInvalidParamsError(data={'id': 'invalid_token_address', 'message': 'Invalid Token Address'})
 
-        # get token balances
-        async with self.db:
-            result = await self.db.execute("UPDATE token_registrations SET last_queried = (now() AT TIME ZONE 'utc') WHERE eth_address = $1", eth_address)
-            await self.db.commit()
-        registered = result == "UPDATE 1"
+        # the query time is written to the database in batches by the erc20 manager
+        await token_registration_cache.touch(eth_address)
+        registered = token_registration_cache.is_registered(eth_address)
+        if not registered:
+            async with self.db:
+                registered = await self.db.fetchval(queries.TOKEN_REGISTERED, eth_address) is not None
 
         if not registered or force_update:
             erc20_dispatcher.update_token_cache("*", eth_address)
-            async with self.db:
-                await self.db.execute("INSERT INTO token_registrations (eth_address) VALUES ($1) ON CONFLICT (eth_address) DO NOTHING", eth_address)
-                await self.db.commit()
+            if not registered:
+                async with self.db:
+                    await self.db.execute("INSERT INTO token_registrations (eth_address) VALUES ($1) ON CONFLICT (eth_address) DO NOTHING", eth_address)
+                    await self.db.commit()
+        token_registration_cache.set_registered(eth_address)
 
         if token_address:
             async with self.db:
@@ -585,11 +909,7 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
                             'icon_url': None,
                             'format': token['format']
                         }
-                balance = await self.db.fetchval(
-                    "SELECT balance "
-                    "FROM token_balances "
-                    "WHERE eth_address = $1 AND contract_address = $2",
-                    eth_address, token_address)
+                balance = await self.db.fetchval(queries.TOKEN_BALANCE, token_address, eth_address)
             if balance is None:
                 balance = "0x0"
             details = {
@@ -666,9 +986,7 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
             }
             if self.user_toshi_id:
                 async with self.db:
-                    balance = await self.db.fetchval(
-                        "SELECT balance FROM token_balances WHERE contract_address = $1 and eth_address = $2",
-                        contract_address, self.user_toshi_id)
+                    balance = await self.db.fetchval(queries.TOKEN_BALANCE, contract_address, self.user_toshi_id)
                 if balance is None:
                     try:
                         balance = await self.eth.eth_call(to_address=contract_address, data="{}000000000000000000000000{}".format(
@@ -794,6 +1112,7 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
                                   "SET name = EXCLUDED.name, symbol = EXCLUDED.symbol, decimals = EXCLUDED.decimals, balance = EXCLUDED.balance, visibility = EXCLUDED.visibility",
                                   self.user_toshi_id, contract_address, name, symbol, decimals, balance, 2)
             await self.db.commit()
+        await invalidate_addresses(self.user_toshi_id)
 
         return token
 
@@ -811,6 +1130,7 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
                                   "WHERE eth_address = $1 AND contract_address = $2",
                                   self.user_toshi_id, contract_address)
             await self.db.commit()
+        await invalidate_addresses(self.user_toshi_id)
 
     async def get_collectibles(self, address, contract_address=None):
 
@@ -821,7 +1141,7 @@ class ToshiEthJsonRPC(JsonRPCBase, BalanceMixin, DatabaseMixin, AnalyticsMixin,
 
         if contract_address is None:
             async with self.db:
-                collectibles = await self.db.fetch(COLLECTIBLE_UNION_QUERY, address)
+                collectibles = await self.db.fetch(COLLECTIBLE_SUMMARY_QUERY, address)
 
             return {"collectibles": [{
                 "contract_address": c['contract_address'],
@@ -6,19 +6,22 @@ import time
 from tornado.httpclient import AsyncHTTPClient
 from tornado.escape import json_decode, json_encode
 
+from toshieth.cache import invalidate_transaction, invalidate_addresses
+from toshieth.ethclient import EthereumClientMixin, get_ethereum_client
 from toshieth.mixins import BalanceMixin
+from toshieth.nonce import nonce_manager
+from toshieth.rebroadcast import RebroadcastScheduler
+from toshieth.subscriptions import websocket_registry
 from toshieth.tasks import (
     BaseEthServiceWorker, BaseTaskHandler,
     manager_dispatcher, erc20_dispatcher, eth_dispatcher, push_dispatcher
 )
-from toshi.ethereum.mixin import EthereumMixin
-from toshi.jsonrpc.client import JsonRPCClient
 from toshi.jsonrpc.errors import JsonRPCError
 from toshi.log import configure_logger, log_unhandled_exceptions
 from toshi.utils import parse_int
 from toshi.sofa import SofaPayment
 from toshi.ethereum.tx import (
-    create_transaction, encode_transaction, calculate_transaction_hash
+    create_transaction, encode_transaction
 )
 from toshi.ethereum.utils import data_decoder, data_encoder, decode_single_address
 from ethereum.abi import decode_abi
@@ -30,7 +33,16 @@ log = logging.getLogger("toshieth.manager")
 
 TRANSACTION_PROCESSING_TIMEOUT = 120
 
-class TransactionQueueHandler(EthereumMixin, BalanceMixin, BaseTaskHandler):
+# limits on the amount of work done in a single sanity check run
+SANITY_CHECK_TIME_BUDGET = 30
+SANITY_CHECK_ADDRESS_BATCH_SIZE = 500
+SANITY_CHECK_BULK_REQUEST_SIZE = 100
+SANITY_CHECK_CURSOR_REDIS_KEY = 'sanity_check_cursor'
+
+class TransactionQueueHandler(EthereumClientMixin, BalanceMixin, BaseTaskHandler):
+
+    def initialize(self, rebroadcast_scheduler=None):
+        self.rebroadcast_scheduler = rebroadcast_scheduler
 
     @log_unhandled_exceptions(logger=log)
     async def process_transaction_queue(self, ethereum_address):
@@ -422,6 +434,25 @@ class TransactionQueueHandler(EthereumMixin, BalanceMixin, BaseTaskHandler):
                                       status, transaction_id)
                 await self.db.commit()
 
+        try:
+            await invalidate_transaction(tx['hash'])
+            await invalidate_addresses(tx['from_address'], tx['to_address'])
+        except:
+            log.exception("Error invalidating cached transaction {}".format(tx['hash']))
+
+        # keep the sender's stored nonce in line with the transaction's status
+        if status == 'confirmed':
+            await nonce_manager.confirmed(tx['from_address'], tx['nonce'])
+        elif status == 'error':
+            await nonce_manager.reset(tx['from_address'])
+
+        # keep the rebroadcast scheduler up to date with internal transactions
+        if self.rebroadcast_scheduler is not None and tx['v'] is not None:
+            if status == 'unconfirmed':
+                self.rebroadcast_scheduler.track(tx)
+            else:
+                self.rebroadcast_scheduler.untrack(tx['hash'])
+
         # render notification
 
         # don't send "queued"
@@ -495,139 +526,130 @@ class TransactionQueueHandler(EthereumMixin, BalanceMixin, BaseTaskHandler):
             manager_dispatcher.process_transaction_queue(to_address)
 
     async def send_notification(self, address, message):
+        if await websocket_registry.has_subscribers(address):
+            eth_dispatcher.send_notification(address, message)
         async with self.db:
             rows = await self.db.fetch(
                 "SELECT DISTINCT(service) FROM notification_registrations WHERE eth_address = $1",
                 address)
         services = [row['service'] for row in rows]
-        if 'ws' in services:
-            eth_dispatcher.send_notification(address, message)
         if 'gcm' in services or 'apn' in services:
             push_dispatcher.send_notification(address, message)
 
-    @log_unhandled_exceptions(logger=log)
-    async def sanity_check(self, frequency):
-        async with self.db:
-            rows = await self.db.fetch(
-                "SELECT DISTINCT from_address FROM transactions WHERE (status = 'unconfirmed' OR status = 'queued' OR status = 'new') "
-                "AND v IS NOT NULL AND created < (now() AT TIME ZONE 'utc') - interval '3 minutes'"
-            )
-            rows2 = await self.db.fetch(
-                "WITH t1 AS (SELECT DISTINCT from_address FROM transactions WHERE (status = 'new' OR status = 'queued') AND v IS NOT NULL), "
-                "t2 AS (SELECT from_address, COUNT(*) FROM transactions WHERE (status = 'unconfirmed' AND v IS NOT NULL) GROUP BY from_address) "
-                "SELECT t1.from_address FROM t1 LEFT JOIN t2 ON t1.from_address = t2.from_address WHERE t2.count IS NULL;")
-        if rows or rows2:
-            log.debug("sanity check found {} addresses with potential problematic transactions".format(len(rows) + len(rows2)))
-
-        rows = set([row['from_address'] for row in rows]).union(set([row['from_address'] for row in rows2]))
+    async def _get_transactions_by_hash(self, hashes):
+        """Looks up the given transaction hashes on the node using chunked
+        bulk requests. Hashes that could not be checked due to errors are
+        not included in the result, hashes not known by the node map to None"""
 
-        addresses_to_check = set()
+        results = {}
+        for i in range(0, len(hashes), SANITY_CHECK_BULK_REQUEST_SIZE):
+            bulk = self.eth.bulk()
+            futures = [(tx_hash, bulk.eth_getTransactionByHash(tx_hash))
+                       for tx_hash in hashes[i:i + SANITY_CHECK_BULK_REQUEST_SIZE]]
+            try:
+                await bulk.execute()
+            except:
+                log.exception("Error getting transactions in sanity check")
+                continue
+            for tx_hash, future in futures:
+                try:
+                    results[tx_hash] = future.result()
+                except:
+                    log.exception("Error getting transaction {} in sanity check".format(tx_hash))
+        return results
 
-        old_and_unconfirmed = []
+    async def _sanity_check_batch(self, cursor, addresses_to_check):
+        """Checks the next batch of addresses with potentially problematic
+        queued transactions, starting after `cursor`.
 
-        for ethereum_address in rows:
+        Returns the list of addresses checked and the number of transaction
+        hashes looked up on the node"""
 
-            # check on queued transactions
-            async with self.db:
-                queued_transactions = await self.db.fetch(
-                    "SELECT * FROM transactions "
-                    "WHERE from_address = $1 "
-                    "AND (status = 'new' OR status = 'queued') AND v IS NOT NULL",
-                    ethereum_address)
+        # NOTE: unconfirmed transactions are watched by the rebroadcast scheduler
+        async with self.db:
+            rows = await self.db.fetch(
+                "WITH suspects AS ("
+                "SELECT from_address AS address FROM transactions "
+                "WHERE (status = 'unconfirmed' OR status = 'queued' OR status = 'new') "
+                "AND v IS NOT NULL AND from_address > $1 "
+                "GROUP BY from_address "
+                "HAVING bool_or(status = 'new' OR status = 'queued') "
+                # either something has been waiting for too long, or there are
+                # queued transactions without any unconfirmed ones to wait on
+                "AND (MIN(created) < (now() AT TIME ZONE 'utc') - interval '3 minutes' "
+                "OR NOT bool_or(status = 'unconfirmed')) "
+                "ORDER BY from_address LIMIT $2) "
+                "SELECT s.address AS suspect, t.transaction_id, t.hash, t.to_address, t.v "
+                "FROM suspects s LEFT JOIN transactions t ON t.to_address = s.address "
+                "AND (t.status = 'unconfirmed' OR t.status = 'queued' OR t.status = 'new') "
+                "ORDER BY s.address",
+                cursor, SANITY_CHECK_ADDRESS_BATCH_SIZE)
+
+        incoming = {}
+        for row in rows:
+            transactions = incoming.setdefault(row['suspect'], [])
+            if row['transaction_id'] is not None:
+                transactions.append(row)
+
+        # make sure there are pending incoming transactions
+        incoming_to_check = []
+        for ethereum_address, incoming_transactions in incoming.items():
+            if not incoming_transactions:
+                log.error("ERROR: {} has transactions in it's queue, but no unconfirmed transactions!".format(ethereum_address))
+                # trigger queue processing as last resort
+                addresses_to_check.add(ethereum_address)
+            else:
+                # check health of the incoming external transactions
+                incoming_to_check.extend(tx for tx in incoming_transactions if tx['v'] is None)
 
-            if queued_transactions:
-                # make sure there are pending incoming transactions
-                async with self.db:
-                    incoming_transactions = await self.db.fetch(
-                        "SELECT * FROM transactions "
-                        "WHERE to_address = $1 "
-                        "AND (status = 'unconfirmed' OR status = 'queued' OR status = 'new')",
-                        ethereum_address)
-
-                if not incoming_transactions:
-                    log.error("ERROR: {} has transactions in it's queue, but no unconfirmed transactions!".format(ethereum_address))
-                    # trigger queue processing as last resort
-                    addresses_to_check.add(ethereum_address)
-                else:
-                    # check health of the incoming transaction
-                    for transaction in incoming_transactions:
-                        if transaction['v'] is None:
-                            try:
-                                tx = await self.eth.eth_getTransactionByHash(transaction['hash'])
-                            except:
-                                log.exception("Error getting transaction {} in sanity check", transaction['hash'])
-                                continue
-                            if tx is None:
-                                log.warning("external transaction (id: {}) no longer found on nodes".format(transaction['transaction_id']))
-                                await self.update_transaction(transaction['transaction_id'], 'error')
-                                addresses_to_check.add(ethereum_address)
-                            elif tx['blockNumber'] is not None:
-                                log.warning("external transaction (id: {}) confirmed on node, but wasn't confirmed in db".format(transaction['transaction_id']))
-                                await self.update_transaction(transaction['transaction_id'], 'confirmed')
-                                addresses_to_check.add(ethereum_address)
+        node_transactions = await self._get_transactions_by_hash(
+            list({tx['hash'] for tx in incoming_to_check}))
 
-                # no need to continue with dealing with unconfirmed transactions if there are queued ones
+        for transaction in incoming_to_check:
+            if transaction['hash'] not in node_transactions:
                 continue
+            tx = node_transactions[transaction['hash']]
+            if tx is None:
+                log.warning("external transaction (id: {}) no longer found on nodes".format(transaction['transaction_id']))
+                await self.update_transaction(transaction['transaction_id'], 'error')
+                addresses_to_check.add(transaction['to_address'])
+            elif tx['blockNumber'] is not None:
+                log.warning("external transaction (id: {}) confirmed on node, but wasn't confirmed in db".format(transaction['transaction_id']))
+                await self.update_transaction(transaction['transaction_id'], 'confirmed')
+                addresses_to_check.add(transaction['to_address'])
+
+        return sorted(incoming.keys()), len(node_transactions)
 
-            async with self.db:
-                unconfirmed_transactions = await self.db.fetch(
-                    "SELECT * FROM transactions "
-                    "WHERE from_address = $1 "
-                    "AND status = 'unconfirmed' AND v IS NOT NULL",
-                    ethereum_address)
-
-            if unconfirmed_transactions:
-
-                for transaction in unconfirmed_transactions:
-
-                    # check on unconfirmed transactions first
-                    if transaction['status'] == 'unconfirmed':
-                        # we neehed to check the true status of unconfirmed transactions
-                        # as the block monitor may be inbetween calls and not have seen
-                        # this transaction to mark it as confirmed.
-                        try:
-                            tx = await self.eth.eth_getTransactionByHash(transaction['hash'])
-                        except:
-                            log.exception("Error getting transaction {} in sanity check", transaction['hash'])
-                            continue
-
-                        # sanity check to make sure the tx still exists
-                        if tx is None:
-                            # if not, try resubmit
-                            # NOTE: it may just be an issue with load balanced nodes not seeing all pending transactions
-                            # so we don't want to adjust the status of the transaction at all at this stage
-                            value = parse_int(transaction['value'])
-                            gas = parse_int(transaction['gas'])
-                            gas_price = parse_int(transaction['gas_price'])
-                            data = data_decoder(transaction['data']) if transaction['data'] else b''
-                            tx = create_transaction(nonce=transaction['nonce'], value=value, gasprice=gas_price, startgas=gas,
-                                                    to=transaction['to_address'], data=data,
-                                                    v=parse_int(transaction['v']),
-                                                    r=parse_int(transaction['r']),
-                                                    s=parse_int(transaction['s']))
-                            if calculate_transaction_hash(tx) != transaction['hash']:
-                                log.warning("error resubmitting transaction {}: regenerating tx resulted in a different hash".format(transaction['hash']))
-                            else:
-                                tx_encoded = encode_transaction(tx)
-                                try:
-                                    await self.eth.eth_sendRawTransaction(tx_encoded)
-                                    addresses_to_check.add(transaction['from_address'])
-                                except Exception as e:
-                                    # note: usually not critical, don't panic
-                                    log.warning("error resubmitting transaction {}: {}".format(transaction['hash'], str(e)))
-
-                        elif tx['blockNumber'] is not None:
-                            # confirmed! update the status
-                            await self.update_transaction(transaction['transaction_id'], 'confirmed')
-                            addresses_to_check.add(transaction['from_address'])
-                            addresses_to_check.add(transaction['to_address'])
-
-                        else:
+    @log_unhandled_exceptions(logger=log)
+    async def sanity_check(self, frequency):
 
-                            old_and_unconfirmed.append(transaction['hash'])
+        start_time = time.time()
+        # resume from where the last run stopped if it ran out of time
+        cursor = await self.redis.get(SANITY_CHECK_CURSOR_REDIS_KEY, encoding='utf-8') or ''
 
-        if len(old_and_unconfirmed):
-            log.warning("WARNING: {} transactions are old and unconfirmed!".format(len(old_and_unconfirmed)))
+        addresses_to_check = set()
+        addresses_checked = 0
+        hashes_checked = 0
+
+        while True:
+            addresses, hashes = await self._sanity_check_batch(cursor, addresses_to_check)
+            addresses_checked += len(addresses)
+            hashes_checked += hashes
+            if len(addresses) < SANITY_CHECK_ADDRESS_BATCH_SIZE:
+                # reached the end of the sweep, start from the beginning next time
+                cursor = ''
+                break
+            cursor = addresses[-1]
+            if time.time() - start_time >= SANITY_CHECK_TIME_BUDGET:
+                log.info("sanity check ran out of time, resuming from {} on next run".format(cursor))
+                break
+
+        await self.redis.set(SANITY_CHECK_CURSOR_REDIS_KEY, cursor)
+
+        if addresses_checked:
+            log.debug("sanity check found {} addresses with potential problematic transactions".format(addresses_checked))
+        log.info("sanity check checked {} addresses and {} transaction hashes in {} seconds".format(
+            addresses_checked, hashes_checked, round(time.time() - start_time, 2)))
 
         for address in addresses_to_check:
             # make sure we don't try process any contract deployments
@@ -696,16 +718,8 @@ class TransactionQueueHandler(EthereumMixin, BalanceMixin, BaseTaskHandler):
                 log.exception("Error updating default gas price from EthGasStation")
 
         try:
-            # use the monitor url if available
-            if 'monitor' in config:
-                node_url = config['monitor']['url']
-            else:
-                log.warning("monitor using config['ethereum'] node")
-                node_url = config['ethereum']['url']
-            eth = JsonRPCClient(node_url,
-                                connect_timeout=5.0,
-                                request_timeout=10.0)
-            eth_gasprice = await eth.eth_gasPrice()
+            # use the monitor nodes if available
+            eth_gasprice = await get_ethereum_client('monitor').eth_gasPrice()
             eth_gasprice = hex(eth_gasprice)
         except:
             log.exception("Error updating default gas price from eth node")
@@ -729,11 +743,18 @@ class TransactionQueueHandler(EthereumMixin, BalanceMixin, BaseTaskHandler):
 class TaskManager(BaseEthServiceWorker):
 
     def __init__(self):
-        super().__init__([(TransactionQueueHandler,)], queue_name="manager")
+        super().__init__([], queue_name="manager")
+        self.rebroadcast_scheduler = RebroadcastScheduler()
+        self.add_task_handler(TransactionQueueHandler, kwargs={'rebroadcast_scheduler': self.rebroadcast_scheduler})
         configure_logger(log)
 
     def start_interval_services(self):
         manager_dispatcher.sanity_check(60).delay(60)
+        asyncio.get_event_loop().create_task(self.rebroadcast_scheduler.start(self.pool))
+
+    def shutdown(self):
+        self.rebroadcast_scheduler.shutdown()
+        return super().shutdown()
 
     async def _work(self):
         await super()._work()
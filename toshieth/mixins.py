@@ -1,4 +1,10 @@
-from toshi.utils import parse_int
+import asyncio
+from functools import partial
+
+from tornado.escape import json_encode
+
+from toshieth import queries
+from toshieth.cache import balance_cache, response_cache
 
 class BalanceMixin:
 
@@ -12,38 +18,65 @@ class BalanceMixin:
           - the total value of pending transactions sent from the given address
           - the total value of pending transactions sent to the given address
         """
+        return (await self.get_balances_for_addresses([eth_address], include_queued=include_queued))[eth_address]
+
+    async def get_balances_for_addresses(self, eth_addresses, include_queued=True):
+        """Gets the balances (as returned by `get_balances`) of multiple eth
+        addresses at once, using a single query for the pending transactions and
+        a single batch of ethereum calls at the same block.
+
+        Returns a dict mapping each address to its balances tuple
+        """
+        eth_addresses = list(set(eth_addresses))
         async with self.db:
             # get the last block number to use in ethereum calls
             # to avoid race conditions in transactions being confirmed
             # on the network before the block monitor sees and updates them in the database
-            block = (await self.db.fetchval("SELECT blocknumber FROM last_blocknumber"))
+            rows = await self.db.fetch(queries.PENDING_BALANCES, eth_addresses, include_queued)
 
-            pending_sent = await self.db.fetch(
-                "SELECT hash, value, gas, gas_price, status FROM transactions "
-                "WHERE from_address = $1 "
-                "AND ("
-                "((status != 'error' AND status != 'confirmed') OR status = 'new') "
-                "OR (status = 'confirmed' AND blocknumber > $2))",
-                eth_address, block or 0)
+        # the calls are all made in the same event loop iteration, so the
+        # ethereum client sends the cache misses as a single batch request
+        confirmed_balances = await asyncio.gather(*[
+            balance_cache.get(
+                row['eth_address'], row['blocknumber'],
+                partial(self.eth.eth_getBalance, row['eth_address'], block=row['blocknumber'] or "latest"))
+            for row in rows])
 
-            pending_received = await self.db.fetch(
-                "SELECT hash, value, status FROM transactions "
-                "WHERE to_address = $1 "
-                "AND ("
-                "((status != 'error' AND status != 'confirmed') OR status = 'new') "
-                "OR (status = 'confirmed' AND blocknumber > $2))",
-                eth_address, block or 0)
+        balances = {}
+        for row, confirmed_balance in zip(rows, confirmed_balances):
+            pending_sent = int(row['pending_sent'])
+            pending_received = int(row['pending_received'])
+            balance = (confirmed_balance + pending_received) - pending_sent
+            balances[row['eth_address']] = (confirmed_balance, balance, pending_sent, pending_received)
+        return balances
 
-        pending_sent = sum(parse_int(p['value']) + (parse_int(p['gas']) * parse_int(p['gas_price']))
-                           for p in pending_sent
-                           if include_queued or p['status'] == 'unconfirmed')
+class CachedResponseMixin:
 
-        pending_received = sum(parse_int(p['value'])
-                               for p in pending_received
-                               if include_queued or p['status'] == 'unconfirmed')
+    async def write_cached_response(self, func, address=None):
+        """writes the json response produced by `func`, reusing the response
+        from the cache if the request was already handled in the current
+        block and nothing has changed for the given address since.
 
-        confirmed_balance = await self.eth.eth_getBalance(eth_address, block=block or "latest")
+        Returns True if the response came from the cache"""
 
-        balance = (confirmed_balance + pending_received) - pending_sent
+        # responses can include urls built from the request's host (e.g.
+        # token icons), so requests for different hosts are cached separately
+        key = await response_cache.key("{}://{}{}".format(
+            self.request.protocol, self.request.host, self.request.uri), address)
+        response = response_cache.get(key) if key is not None else None
+        cached = response is not None
+        if response is None:
+            body = json_encode(await func()).encode('utf-8')
+            if key is None:
+                self.set_header("Content-Type", "application/json; charset=UTF-8")
+                self.write(body)
+                return False
+            response = response_cache.set(key, body)
 
-        return confirmed_balance, balance, pending_sent, pending_received
+        self.set_header("Etag", '"{}"'.format(response.etag))
+        if self.check_etag_header():
+            self.set_status(304)
+            return cached
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(response.body)
+        return cached
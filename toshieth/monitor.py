@@ -8,6 +8,7 @@ from toshi.log import configure_logger, log_unhandled_exceptions
 from toshi.database import prepare_database
 from toshi.redis import prepare_redis, get_redis_connection
 from toshi.config import config
+from toshieth.subscriptions import websocket_registry
 from toshieth.tasks import manager_dispatcher, erc20_dispatcher, eth_dispatcher, collectibles_dispatcher
 
 from toshi.utils import parse_int
@@ -15,6 +16,9 @@ from toshi.ethereum.utils import data_decoder
 
 from .constants import TRANSFER_TOPIC, DEPOSIT_TOPIC, WITHDRAWAL_TOPIC, WETH_CONTRACT_ADDRESS
 from .utils import get_transaction_log_index
+from .cache import publish_new_block, publish_reorg
+from .nonce import nonce_manager
+from .ethclient import get_ethereum_client, get_node_urls
 
 DEFAULT_BLOCK_CHECK_DELAY = 0
 DEFAULT_POLL_DELAY = 1
@@ -42,17 +46,16 @@ class BlockMonitor:
         configure_logger(log)
 
         if 'monitor' in config:
-            node_url = config['monitor']['url']
+            section = 'monitor'
         else:
             log.warning("monitor using config['ethereum'] node")
-            node_url = config['ethereum']['url']
+            section = 'ethereum'
 
-        self.eth = JsonRPCClient(node_url,
-                                 connect_timeout=5.0,
-                                 request_timeout=10.0)
+        self.eth = get_ethereum_client(section)
         # filter health processes depend on some of the calls failing on the first time
-        # so we have a separate client to handle those
-        self.filter_eth = JsonRPCClient(node_url,
+        # so we have a separate client to handle those. Filters only exist on the
+        # node they were created on, so this always uses the first node
+        self.filter_eth = JsonRPCClient(get_node_urls(section)[0],
                                         force_instance=True,
                                         connect_timeout=10.0,
                                         request_timeout=60.0)
@@ -240,18 +243,16 @@ class BlockMonitor:
                     process_tx_tasks.append(
                         asyncio.get_event_loop().create_task(self.process_transaction(tx, is_reorg=is_reorg)))
                 await asyncio.gather(*process_tx_tasks)
+                await nonce_manager.observe_block(block['transactions'])
 
                 if logs_list:
                     # send notifications for anyone registered
-                    async with self.pool.acquire() as con:
-                        for event in logs_list:
-                            for topic in event['topics']:
-                                filters = await con.fetch(
-                                    "SELECT * FROM filter_registrations WHERE contract_address = $1 AND topic_id = $2",
-                                    event['address'], topic)
-                                for filter in filters:
-                                    eth_dispatcher.send_filter_notification(
-                                        filter['filter_id'], filter['topic'], event['data'])
+                    for event in logs_list:
+                        for topic in event['topics']:
+                            filters = await websocket_registry.get_filters(event['address'], topic)
+                            for filter_id, filter_topic in filters:
+                                eth_dispatcher.send_filter_notification(
+                                    filter_id, filter_topic, event['data'])
 
                 # update the latest block number, only if it is larger than the
                 # current block number.
@@ -263,6 +264,11 @@ class BlockMonitor:
                     await con.execute("UPDATE last_blocknumber SET blocknumber = $1 "
                                       "WHERE blocknumber < $1",
                                       block_number)
+                    # confirmed transactions in processed blocks are now part
+                    # of the balances returned by the node
+                    await con.execute("DELETE FROM pending_balances "
+                                      "WHERE blocknumber > 0 AND blocknumber <= $1",
+                                      block_number)
                     await con.execute("INSERT INTO blocks (blocknumber, timestamp, hash, parent_hash) "
                                       "VALUES ($1, $2, $3, $4) "
                                       "ON CONFLICT (blocknumber) DO UPDATE "
@@ -272,6 +278,10 @@ class BlockMonitor:
                                       block['hash'], block['parentHash'])
 
                 collectibles_dispatcher.notify_new_block(block_number)
+                try:
+                    await publish_new_block(block_number)
+                except:
+                    log.exception("Failed to publish new block notification")
                 processing_end_time = asyncio.get_event_loop().time()
                 self._blocktimes.append(processing_end_time - processing_start_time)
                 if len(self._blocktimes) > 100:
@@ -661,6 +671,10 @@ class BlockMonitor:
                               forked_at_blocknumber - 1)
 
         self.last_block_number = forked_at_blocknumber
+        try:
+            await publish_reorg(forked_at_blocknumber)
+        except:
+            log.exception("Failed to publish reorg notification")
         return True
 
     def run_sanity_check(self):
@@ -0,0 +1,135 @@
+import logging
+
+from toshi.redis import get_redis_connection
+from toshi.utils import parse_int
+
+from toshieth.cache import SingleFlight
+
+log = logging.getLogger("toshieth.nonce")
+
+# the stored nonce is recomputed from the node at least this often, in case
+# transactions were sent from the address by something other than the service
+NONCE_TTL = 3600
+
+# raises the stored nonce to ARGV[1] (never lowering it) and returns the result
+_RAISE_NONCE_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]))
+local nonce = tonumber(ARGV[1])
+if current == nil or current < nonce then
+    redis.call('SET', KEYS[1], nonce, 'EX', ARGV[2])
+    return nonce
+end
+return current
+"""
+
+# raises the stored nonces of KEYS[i] to ARGV[i] for any keys that are already
+# stored, with the expiry time as the last argument
+_OBSERVE_NONCES_SCRIPT = """
+local ttl = ARGV[#ARGV]
+for i, key in ipairs(KEYS) do
+    local current = tonumber(redis.call('GET', key))
+    local nonce = tonumber(ARGV[i])
+    if current ~= nil and current < nonce then
+        redis.call('SET', key, nonce, 'EX', ttl)
+    end
+end
+return 0
+"""
+
+class NonceManager:
+    """Keeps the next usable nonce of each sender in redis.
+
+    The nonce is raised atomically when transactions are submitted or
+    confirmed (including transactions seen in new blocks that weren't sent
+    through the service), and dropped when a transaction errors so it is
+    recomputed (by the given `reconcile` function, usually from the database
+    and the node) the next time it's needed"""
+
+    def __init__(self, ttl=NONCE_TTL):
+        self.ttl = ttl
+        self._single_flight = SingleFlight()
+
+    def redis_key(self, address):
+        # addresses from clients may be checksummed, while everything that
+        # raises or resets the nonce uses lowercase addresses
+        return "toshieth.nonce:{}".format(address.lower())
+
+    async def get(self, address, reconcile):
+        """returns the next usable nonce for the given address"""
+
+        try:
+            nonce = await get_redis_connection().get(self.redis_key(address), encoding='utf-8')
+        except:
+            log.exception("Error reading nonce of {} from redis".format(address))
+            return await reconcile()
+        if nonce is not None:
+            return int(nonce)
+        # concurrent requests for the same sender share a single reconciliation
+        return await self._single_flight.do(address.lower(), lambda: self._reconcile(address, reconcile, force=False))
+
+    async def reconcile(self, address, reconcile):
+        """recomputes the nonce for the given address, replacing the stored
+        value even if it is higher"""
+
+        return await self._reconcile(address, reconcile, force=True)
+
+    async def _reconcile(self, address, reconcile, force):
+        nonce = await reconcile()
+        try:
+            if force:
+                await get_redis_connection().set(self.redis_key(address), nonce, expire=self.ttl)
+            else:
+                # transactions submitted while the nonce was being computed
+                # may have already raised it
+                nonce = await self._raise(address, nonce)
+        except:
+            log.exception("Error storing nonce of {} in redis".format(address))
+        return nonce
+
+    async def _raise(self, address, nonce):
+        return int(await get_redis_connection().eval(
+            _RAISE_NONCE_SCRIPT, keys=[self.redis_key(address)], args=[nonce, self.ttl]))
+
+    async def submitted(self, address, nonce):
+        """marks the given nonce as used by a new transaction"""
+
+        try:
+            await self._raise(address, nonce + 1)
+        except:
+            log.exception("Error updating nonce of {} in redis".format(address))
+
+    async def confirmed(self, address, nonce):
+        """marks the given nonce as used by a confirmed transaction"""
+
+        await self.submitted(address, nonce)
+
+    async def observe_block(self, transactions):
+        """raises the stored nonces of the senders of the given block
+        transactions, so transactions sent from the same addresses by
+        something other than the service are accounted for"""
+
+        nonces = {}
+        for tx in transactions:
+            nonce = parse_int(tx['nonce'])
+            if tx['from'] is not None and nonce is not None:
+                nonces[tx['from']] = max(nonce + 1, nonces.get(tx['from'], 0))
+        if not nonces:
+            return
+        try:
+            await get_redis_connection().eval(
+                _OBSERVE_NONCES_SCRIPT,
+                keys=[self.redis_key(address) for address in nonces],
+                args=list(nonces.values()) + [self.ttl])
+        except:
+            log.exception("Error updating nonces from block transactions")
+
+    async def reset(self, address):
+        """drops the stored nonce, used when a transaction is overwritten or
+        fails, as the following nonces may be reused"""
+
+        try:
+            await get_redis_connection().delete(self.redis_key(address))
+        except:
+            log.exception("Error removing nonce of {} from redis".format(address))
+
+nonce_manager = NonceManager()
@@ -0,0 +1,63 @@
+# the hot queries of the json rpc and http handlers. asyncpg prepares every
+# query it runs and caches the prepared statements per connection, keyed by
+# the query text, so keeping them here makes sure every caller shares the same
+# statement rather than preparing slightly different copies of it. queries
+# that are built dynamically don't belong here.
+
+# the pending transaction totals of multiple addresses, along with the last
+# block seen by the block monitor
+PENDING_BALANCES = (
+    "SELECT b.blocknumber, a.eth_address, "
+    "COALESCE(SUM(p.pending_sent), 0) AS pending_sent, "
+    "COALESCE(SUM(p.pending_received), 0) AS pending_received "
+    "FROM (SELECT MAX(blocknumber) AS blocknumber FROM last_blocknumber) b "
+    "CROSS JOIN UNNEST($1::VARCHAR[]) AS a (eth_address) "
+    "LEFT JOIN pending_balances p "
+    "ON p.eth_address = a.eth_address "
+    "AND (p.blocknumber = 0 OR p.blocknumber > COALESCE(b.blocknumber, 0)) "
+    "AND ($2 OR p.status = 'unconfirmed') "
+    "GROUP BY b.blocknumber, a.eth_address")
+
+# the highest nonce of the address's queued and unconfirmed transactions
+LAST_QUEUED_NONCE = (
+    "SELECT nonce FROM transactions "
+    "WHERE from_address = $1 "
+    "AND (status = 'new' OR status = 'queued' OR status = 'unconfirmed') "
+    "ORDER BY nonce DESC LIMIT 1")
+
+# a transaction that can still be overwritten by a new one with the same nonce
+ACTIVE_TRANSACTION_BY_NONCE = (
+    "SELECT * FROM transactions WHERE "
+    "from_address = $1 AND nonce = $2 AND "
+    "(status != 'error' or status = 'new')")
+
+ACTIVE_TRANSACTION_BY_HASH = (
+    "SELECT * FROM transactions WHERE "
+    "hash = $1 AND (status != 'error' OR status = 'new') "
+    "ORDER BY transaction_id DESC")
+
+TRANSACTION_BY_HASH = "SELECT * FROM transactions where hash = $1 ORDER BY transaction_id DESC"
+
+INSERT_TRANSACTION = (
+    "INSERT INTO transactions "
+    "(hash, from_address, to_address, nonce, "
+    "value, gas, gas_price, "
+    "data, v, r, s, "
+    "sender_toshi_id) "
+    "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12) "
+    "RETURNING transaction_id")
+
+INSERT_TOKEN_TRANSACTION = (
+    "INSERT INTO token_transactions "
+    "(transaction_id, transaction_log_index, contract_address, from_address, to_address, value) "
+    "VALUES ($1, $2, $3, $4, $5, $6)")
+
+TOKEN = "SELECT * FROM tokens WHERE contract_address = $1"
+
+TOKENS = "SELECT * FROM tokens WHERE contract_address = ANY($1)"
+
+TOKEN_BALANCE = "SELECT balance FROM token_balances WHERE contract_address = $1 AND eth_address = $2"
+
+TOKEN_REGISTERED = "SELECT 1 FROM token_registrations WHERE eth_address = $1"
+
+TOSHI_IDS = "SELECT eth_address, toshi_id FROM notification_registrations WHERE eth_address = ANY($1)"
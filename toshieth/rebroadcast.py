@@ -0,0 +1,304 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+import uuid
+
+from toshi.ethereum.tx import encode_transaction, calculate_transaction_hash
+from toshi.log import configure_logger, log_unhandled_exceptions
+from toshi.redis import get_redis_connection
+
+from toshieth.ethclient import get_ethereum_client
+from toshieth.tasks import manager_dispatcher
+from toshieth.utils import database_transaction_to_rlp_transaction
+
+log = logging.getLogger("toshieth.rebroadcast")
+
+# delay before the first node visibility check of a new unconfirmed transaction
+REBROADCAST_INITIAL_DELAY = 5
+# upper bound for the exponential backoff between checks
+REBROADCAST_MAX_DELAY = 300
+# maximum number of transactions being checked at the same time
+REBROADCAST_CONCURRENCY = 10
+# how long a manager process stays in charge of rebroadcasting without
+# renewing its lease
+REBROADCAST_LEASE_TTL = 30
+# how often the lease is renewed and the transactions updated since the
+# last sync are reloaded from the database
+REBROADCAST_SYNC_INTERVAL = 10
+# how often all the unconfirmed transactions are reloaded, in case anything
+# was missed
+REBROADCAST_FULL_SYNC_INTERVAL = 600
+# how far before the last sync to look for updates, so updates committed
+# after a sync started aren't missed
+REBROADCAST_SYNC_OVERLAP = 60
+
+REBROADCAST_LEASE_KEY = "toshieth.rebroadcast:lease"
+
+# renews the lease if it's held by ARGV[1], or takes it if nobody holds it
+_RENEW_LEASE_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if holder == ARGV[1] then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+elseif holder == false then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# releases the lease if it's held by ARGV[1]
+_RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+UNCONFIRMED_TRANSACTIONS = (
+    "SELECT transaction_id, hash, from_address, to_address, nonce, value, gas, gas_price, data, v, r, s, status "
+    "FROM transactions WHERE status = 'unconfirmed' AND v IS NOT NULL")
+
+UPDATED_TRANSACTIONS = (
+    "SELECT transaction_id, hash, from_address, to_address, nonce, value, gas, gas_price, data, v, r, s, status "
+    "FROM transactions WHERE updated > $1 AND v IS NOT NULL")
+
+class _ScheduledTransaction:
+    __slots__ = ('transaction', 'delay', 'due', 'resubmissions')
+
+    def __init__(self, transaction, delay):
+        self.transaction = transaction
+        self.delay = delay
+        self.due = None
+        self.resubmissions = 0
+
+class RebroadcastScheduler:
+    """Keeps track of all the unconfirmed internal transactions in a time
+    ordered queue, checking if they are still visible on the node and
+    resubmitting them if they are not. Each transaction backs off
+    exponentially between checks until it is confirmed or untracked.
+
+    Only one manager process rebroadcasts at a time, the one holding the
+    lease in redis. Every `sync_interval` seconds it loads the transactions
+    updated since the last sync, which picks up transactions whose status
+    was changed by other processes. All the unconfirmed transactions are
+    only loaded when the lease is taken and every `full_sync_interval`
+    seconds. The transaction's status is checked again before it is
+    resubmitted."""
+
+    def __init__(self, eth=None, *, initial_delay=REBROADCAST_INITIAL_DELAY,
+                 max_delay=REBROADCAST_MAX_DELAY, concurrency=REBROADCAST_CONCURRENCY,
+                 lease_ttl=REBROADCAST_LEASE_TTL, sync_interval=REBROADCAST_SYNC_INTERVAL,
+                 full_sync_interval=REBROADCAST_FULL_SYNC_INTERVAL):
+        configure_logger(log)
+        self.eth = eth or get_ethereum_client()
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.lease_ttl = lease_ttl
+        self.sync_interval = sync_interval
+        self.full_sync_interval = full_sync_interval
+        self.pool = None
+        self.leader = False
+        # the database time of the last sync, and when the next full sync is due
+        self._synced = None
+        self._next_full_sync = 0
+        self._lease_id = uuid.uuid4().hex
+        self._sync_process = None
+        self._queue = []
+        self._transactions = {}
+        self._counter = itertools.count()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._process = None
+        self._shutdown = False
+
+    def __len__(self):
+        return len(self._transactions)
+
+    async def start(self, pool):
+        """starts the scheduling loop, and the loop that keeps the lease and
+        the unconfirmed internal transactions up to date using the given
+        database pool"""
+
+        if self._process is not None:
+            return
+        self.pool = pool
+        await self.sync()
+        self._process = asyncio.get_event_loop().create_task(self._run())
+        self._sync_process = asyncio.get_event_loop().create_task(self._sync_loop())
+
+    def shutdown(self):
+        self._shutdown = True
+        self._wakeup.set()
+        if self._sync_process is not None:
+            self._sync_process.cancel()
+            self._sync_process = None
+        if self.leader:
+            self.leader = False
+            # let another process take over straight away
+            return asyncio.get_event_loop().create_task(self._release_lease())
+
+    async def _release_lease(self):
+        try:
+            await get_redis_connection().eval(
+                _RELEASE_LEASE_SCRIPT, keys=[REBROADCAST_LEASE_KEY], args=[self._lease_id])
+        except:
+            log.exception("Error releasing rebroadcast lease")
+
+    async def _sync_loop(self):
+        while not self._shutdown:
+            await asyncio.sleep(self.sync_interval)
+            await self.sync()
+
+    async def sync(self):
+        """renews (or takes) the lease, and if this process holds it,
+        reloads the internal transactions that were updated since the last
+        sync (or all the unconfirmed ones if a full sync is due)"""
+
+        try:
+            leader = bool(await get_redis_connection().eval(
+                _RENEW_LEASE_SCRIPT, keys=[REBROADCAST_LEASE_KEY], args=[self._lease_id, self.lease_ttl]))
+        except:
+            log.exception("Error renewing rebroadcast lease")
+            leader = False
+
+        if not leader:
+            if self.leader:
+                log.info("lost rebroadcast lease, no longer tracking unconfirmed transactions")
+            self.leader = False
+            self._synced = None
+            self._transactions.clear()
+            return
+
+        loop = asyncio.get_event_loop()
+        full = not self.leader or self._synced is None or loop.time() >= self._next_full_sync
+        try:
+            async with self.pool.acquire() as con:
+                synced = await con.fetchval("SELECT (now() AT TIME ZONE 'utc')")
+                if full:
+                    rows = await con.fetch(UNCONFIRMED_TRANSACTIONS)
+                else:
+                    rows = await con.fetch(UPDATED_TRANSACTIONS,
+                                           self._synced - datetime.timedelta(seconds=REBROADCAST_SYNC_OVERLAP))
+        except:
+            log.exception("Error loading unconfirmed transactions")
+            return
+        if not self.leader:
+            log.info("took rebroadcast lease, tracking {} unconfirmed transactions".format(len(rows)))
+        self.leader = True
+        self._synced = synced
+        if full:
+            self._next_full_sync = loop.time() + self.full_sync_interval
+            unconfirmed = {row['hash'] for row in rows}
+            for tx_hash in [tx_hash for tx_hash in self._transactions if tx_hash not in unconfirmed]:
+                self.untrack(tx_hash)
+        for row in rows:
+            if row['status'] == 'unconfirmed':
+                self.track(row)
+            else:
+                self.untrack(row['hash'])
+
+    def track(self, transaction):
+        """starts tracking the given transaction (which must include all the
+        fields required to regenerate the raw transaction). ignored unless
+        this process holds the lease, the process that does will load the
+        transaction from the database"""
+
+        if not self.leader or transaction['hash'] in self._transactions:
+            return
+        entry = _ScheduledTransaction(dict(transaction), self.initial_delay)
+        self._transactions[transaction['hash']] = entry
+        self._schedule(entry)
+
+    def untrack(self, tx_hash):
+        # any entries left in the queue are skipped when they come due
+        self._transactions.pop(tx_hash, None)
+
+    def _schedule(self, entry):
+        entry.due = asyncio.get_event_loop().time() + entry.delay
+        heapq.heappush(self._queue, (entry.due, next(self._counter), entry.transaction['hash']))
+        if self._queue[0][2] == entry.transaction['hash']:
+            # new earliest entry, make sure the loop doesn't oversleep
+            self._wakeup.set()
+
+    def _backoff(self, entry):
+        entry.delay = min(entry.delay * 2, self.max_delay)
+        self._schedule(entry)
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while not self._shutdown:
+            now = loop.time()
+            while self._queue and self._queue[0][0] <= now:
+                due, _, tx_hash = heapq.heappop(self._queue)
+                entry = self._transactions.get(tx_hash)
+                # skip untracked transactions and stale queue entries
+                if entry is None or entry.due != due:
+                    continue
+                await self._semaphore.acquire()
+                loop.create_task(self._check(entry))
+            timeout = self._queue[0][0] - loop.time() if self._queue else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    @log_unhandled_exceptions(logger=log)
+    async def _check(self, entry):
+        transaction = entry.transaction
+        try:
+            try:
+                tx = await self.eth.eth_getTransactionByHash(transaction['hash'])
+            except:
+                log.exception("Error getting transaction {}".format(transaction['hash']))
+                self._backoff(entry)
+                return
+
+            if self._transactions.get(transaction['hash']) is not entry:
+                # untracked while the request was in progress
+                return
+
+            if tx is None:
+                # the transaction may have been confirmed or failed in another
+                # process since it was loaded
+                try:
+                    async with self.pool.acquire() as con:
+                        status = await con.fetchval("SELECT status FROM transactions WHERE hash = $1", transaction['hash'])
+                except:
+                    log.exception("Error getting status of transaction {}".format(transaction['hash']))
+                    self._backoff(entry)
+                    return
+                if status != 'unconfirmed':
+                    self.untrack(transaction['hash'])
+                    return
+                # NOTE: it may just be an issue with load balanced nodes not seeing all pending transactions
+                # so we don't want to adjust the status of the transaction at all at this stage
+                await self._resubmit(entry)
+                if self._transactions.get(transaction['hash']) is entry:
+                    self._backoff(entry)
+            elif tx['blockNumber'] is not None:
+                self.untrack(transaction['hash'])
+                manager_dispatcher.update_transaction(transaction['transaction_id'], 'confirmed')
+            else:
+                self._backoff(entry)
+        finally:
+            self._semaphore.release()
+
+    async def _resubmit(self, entry):
+        transaction = entry.transaction
+        tx = database_transaction_to_rlp_transaction(transaction)
+        if calculate_transaction_hash(tx) != transaction['hash']:
+            log.warning("error resubmitting transaction {}: regenerating tx resulted in a different hash".format(transaction['hash']))
+            # nothing more can be done with this transaction
+            self.untrack(transaction['hash'])
+            return
+        try:
+            await self.eth.eth_sendRawTransaction(encode_transaction(tx))
+            entry.resubmissions += 1
+            log.info("resubmitted transaction {} (attempt {})".format(transaction['hash'], entry.resubmissions))
+        except Exception as e:
+            # note: usually not critical, don't panic
+            log.warning("error resubmitting transaction {}: {}".format(transaction['hash'], str(e)))
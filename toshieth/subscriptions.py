@@ -0,0 +1,138 @@
+import time
+import uuid
+
+from tornado.escape import json_decode, json_encode
+from toshi.redis import get_redis_connection
+
+# websocket sessions are dropped from the registry if they haven't been
+# refreshed (by the websocket's keep alive pings) for this long
+SESSION_TTL = 90
+
+class WebsocketRegistry:
+    """Keeps track of the addresses and event filters websocket sessions are
+    subscribed to in redis, rather than in the database, as they only
+    live as long as the websocket connections.
+
+    For each address (and each contract address and topic) there is a sorted
+    set of the sessions subscribed to it, scored by the time the session
+    expires, so subscriptions of sessions that disappeared without closing
+    (e.g. when a process crashed) are ignored once the session hasn't been
+    refreshed for `SESSION_TTL` seconds. Each session also has a set of its
+    addresses and a hash of its filters, so they can be refreshed and
+    removed in bulk"""
+
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+
+    def address_key(self, address):
+        return "toshieth.ws:address:{}".format(address)
+
+    def filter_key(self, contract_address, topic_id):
+        return "toshieth.ws:filter:{}:{}".format(contract_address, topic_id)
+
+    def session_addresses_key(self, session_id):
+        return "toshieth.ws:session:{}:addresses".format(session_id)
+
+    def session_filters_key(self, session_id):
+        return "toshieth.ws:session:{}:filters".format(session_id)
+
+    @property
+    def connection(self):
+        return get_redis_connection()
+
+    async def subscribe(self, session_id, addresses):
+        if not addresses:
+            return
+        expires = time.time() + self.ttl
+        pipe = self.connection.pipeline()
+        for address in addresses:
+            pipe.zadd(self.address_key(address), expires, session_id)
+            pipe.expire(self.address_key(address), self.ttl)
+        pipe.sadd(self.session_addresses_key(session_id), *addresses)
+        pipe.expire(self.session_addresses_key(session_id), self.ttl)
+        await pipe.execute()
+
+    async def unsubscribe(self, session_id, addresses):
+        if not addresses:
+            return
+        pipe = self.connection.pipeline()
+        for address in addresses:
+            pipe.zrem(self.address_key(address), session_id)
+        pipe.srem(self.session_addresses_key(session_id), *addresses)
+        await pipe.execute()
+
+    async def add_filter(self, session_id, contract_address, topic_id, topic):
+        """registers a filter for the session, returning the id of the
+        session's existing filter for the contract address and topic if
+        there already is one"""
+
+        filters = await self.connection.hgetall(self.session_filters_key(session_id), encoding='utf-8')
+        for filter_id, details in filters.items():
+            if json_decode(details)[:2] == [contract_address, topic_id]:
+                return filter_id
+        filter_id = uuid.uuid4().hex
+        expires = time.time() + self.ttl
+        pipe = self.connection.pipeline()
+        pipe.hset(self.session_filters_key(session_id), filter_id, json_encode([contract_address, topic_id, topic]))
+        pipe.expire(self.session_filters_key(session_id), self.ttl)
+        pipe.zadd(self.filter_key(contract_address, topic_id), expires, json_encode([filter_id, topic]))
+        pipe.expire(self.filter_key(contract_address, topic_id), self.ttl)
+        await pipe.execute()
+        return filter_id
+
+    async def remove_filters(self, session_id, filter_ids):
+        if not filter_ids:
+            return
+        details = await self.connection.hmget(self.session_filters_key(session_id), *filter_ids, encoding='utf-8')
+        pipe = self.connection.pipeline()
+        for filter_id, filter_details in zip(filter_ids, details):
+            if filter_details is None:
+                continue
+            contract_address, topic_id, topic = json_decode(filter_details)
+            pipe.zrem(self.filter_key(contract_address, topic_id), json_encode([filter_id, topic]))
+        pipe.hdel(self.session_filters_key(session_id), *filter_ids)
+        await pipe.execute()
+
+    async def refresh(self, session_id):
+        """extends the life of all the session's subscriptions"""
+
+        pipe = self.connection.pipeline()
+        fut_addresses = pipe.smembers(self.session_addresses_key(session_id), encoding='utf-8')
+        fut_filters = pipe.hgetall(self.session_filters_key(session_id), encoding='utf-8')
+        await pipe.execute()
+        addresses, filters = fut_addresses.result(), fut_filters.result()
+        if not addresses and not filters:
+            return
+
+        expires = time.time() + self.ttl
+        pipe = self.connection.pipeline()
+        for address in addresses:
+            pipe.zadd(self.address_key(address), expires, session_id)
+            pipe.expire(self.address_key(address), self.ttl)
+        for filter_id, details in filters.items():
+            contract_address, topic_id, topic = json_decode(details)
+            pipe.zadd(self.filter_key(contract_address, topic_id), expires, json_encode([filter_id, topic]))
+            pipe.expire(self.filter_key(contract_address, topic_id), self.ttl)
+        pipe.expire(self.session_addresses_key(session_id), self.ttl)
+        pipe.expire(self.session_filters_key(session_id), self.ttl)
+        await pipe.execute()
+
+    async def has_subscribers(self, address):
+        """checks if any live sessions are subscribed to the address"""
+
+        return await self.connection.zcount(self.address_key(address), min=time.time()) > 0
+
+    async def get_filters(self, contract_address, topic_id):
+        """returns a list of (filter_id, topic) tuples of the live filters
+        for the contract address and topic"""
+
+        key = self.filter_key(contract_address, topic_id)
+        now = time.time()
+        pipe = self.connection.pipeline()
+        # clean up filters of sessions that have expired
+        pipe.zremrangebyscore(key, max=now)
+        fut = pipe.zrangebyscore(key, min=now, encoding='utf-8')
+        await pipe.execute()
+        return [tuple(json_decode(member)) for member in fut.result()]
+
+websocket_registry = WebsocketRegistry()
@@ -1,5 +1,8 @@
 import asyncio
+import binascii
+import logging
 
+from tornado.escape import json_encode
 from toshi.database import prepare_database, DatabaseMixin
 from toshi.redis import prepare_redis, get_redis_connection, RedisMixin
 from trq.worker import Worker
@@ -18,12 +21,13 @@ class BaseEthServiceWorker:
         self._handlers = handlers or []
         self._queue_name = queue_name
         self.worker = None
+        self.pool = None
 
     def work(self):
         return asyncio.get_event_loop().create_task(self._work())
 
     async def _work(self):
-        await prepare_database(handle_migration=False)
+        self.pool = await prepare_database(handle_migration=False)
         redis = await prepare_redis()
         self.worker = Worker(self._handlers, queue_name=self._queue_name, connection=redis)
         self.worker.work()
@@ -37,6 +41,52 @@ class BaseEthServiceWorker:
         else:
             self.worker.add_task_handler(cls, args=args, kwargs=kwargs)
 
+log = logging.getLogger("toshieth.tasks")
+
+# websocket notifications are spread over this many redis pub/sub channels,
+# so each web process only receives the notifications of the shards its
+# connections are subscribed to
+NOTIFICATION_SHARDS = 256
+
+def notification_channel(kind, key):
+    """returns the pub/sub channel notifications of the given kind
+    ('transaction' or 'filter') for the given address or filter id are
+    published on"""
+    shard = binascii.crc32("{}:{}".format(kind, key).encode('utf-8')) % NOTIFICATION_SHARDS
+    return "toshieth.notifications:{}".format(shard)
+
+class NotificationDispatcher:
+    """Publishes websocket notifications on the sharded pub/sub channels,
+    so they reach every web process that has a matching subscriber rather
+    than the single worker that takes them off a queue.
+
+    Like the task dispatchers, calls return straight away and the message
+    is sent in the background"""
+
+    def send_notification(self, subscription_id, message):
+        return self._publish(notification_channel('transaction', subscription_id), {
+            'type': 'transaction',
+            'subscription_id': subscription_id,
+            'message': message
+        })
+
+    def send_filter_notification(self, filter_id, topic, data):
+        return self._publish(notification_channel('filter', filter_id), {
+            'type': 'filter',
+            'filter_id': filter_id,
+            'topic': topic,
+            'data': data
+        })
+
+    def _publish(self, channel, notification):
+        return asyncio.get_event_loop().create_task(self._do_publish(channel, json_encode(notification)))
+
+    async def _do_publish(self, channel, message):
+        try:
+            await get_redis_connection().publish(channel, message)
+        except:
+            log.exception("Error publishing notification on {}".format(channel))
+
 class Dispatcher(_Dispatcher):
     def __init__(self, *, queue_name):
         super().__init__(queue_name=queue_name)
@@ -47,6 +97,6 @@ class Dispatcher(_Dispatcher):
 
 manager_dispatcher = Dispatcher(queue_name="manager")
 push_dispatcher = Dispatcher(queue_name="pushservice")
-eth_dispatcher = Dispatcher(queue_name="ethservice")
+eth_dispatcher = NotificationDispatcher()
 erc20_dispatcher = Dispatcher(queue_name="erc20")
 collectibles_dispatcher = Dispatcher(queue_name="collectibles")
@@ -1,5 +1,7 @@
 import asyncio
 
+import toshieth.cache
+import toshieth.analytics
 import toshieth.monitor
 import toshieth.manager
 import toshieth.push_service
@@ -27,6 +29,12 @@ class EthServiceBaseTest(AsyncHandlerTest):
 
     APPLICATION_CLASS = Application
 
+    def setUp(self):
+        super().setUp()
+        # make sure nothing cached by previous tests is used
+        toshieth.cache.clear_caches()
+        toshieth.analytics.analytics_buffer.clear()
+
     def get_urls(self):
         return urls
 
@@ -115,6 +115,36 @@ class TransactionListTest(EthServiceBaseTest):
                 self.assertEqual(int(tx['nonce'], 16), nonce)
                 nonce -= 1
 
+    @gen_test
+    @requires_database
+    async def test_cursor_pagination(self):
+        async with self.pool.acquire() as con:
+            for i in range(20):
+                # mix of outgoing, incoming and transactions to self
+                from_address = TEST_ADDRESS if i % 3 != 1 else random_address()
+                to_address = TEST_ADDRESS if i % 3 != 0 else random_address()
+                await con.execute("INSERT INTO transactions (hash, from_address, to_address, nonce, value, status) VALUES ($1, $2, $3, $4, $5, $6)", random_hash(), from_address, to_address, i, hex(random.randint(1, 100) ** 16), 'confirmed')
+
+        for order in ['desc', 'asc']:
+            nonces = []
+            cursor = None
+            while True:
+                url = "/address/{}?limit={}&order={}".format(TEST_ADDRESS, 6, order)
+                if cursor:
+                    url += "&cursor={}".format(cursor)
+                resp = await self.fetch(url)
+                self.assertResponseCodeEqual(resp, 200)
+                body = json_decode(resp.body)
+                nonces.extend(int(tx['nonce'], 16) for tx in body['transactions'])
+                cursor = body['next_cursor']
+                if cursor is None:
+                    break
+            expected = list(range(20))
+            self.assertEqual(nonces, expected[::-1] if order == 'desc' else expected)
+
+        resp = await self.fetch("/address/{}?cursor=bad".format(TEST_ADDRESS))
+        self.assertResponseCodeEqual(resp, 400)
+
     @gen_test
     @requires_database
     async def test_order_filtering(self):
@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+from tornado.testing import gen_test
+
+from toshieth.test.base import EthServiceBaseTest
+from toshieth.analytics import AnalyticsBuffer
+from toshi.test.database import requires_database
+
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+TEST_ADDRESS_2 = "0x0000000000000000000000000000000000000001"
+TEST_TOSHI_ID = "0x0000000000000000000000000000000000000002"
+
+class FakeTracker:
+
+    def __init__(self, application):
+        self.application = application
+        self.events = []
+
+    def track(self, toshi_id, event, add_user_agent=True):
+        self.events.append((toshi_id, event, add_user_agent))
+
+class AnalyticsBufferTest(EthServiceBaseTest):
+
+    @gen_test(timeout=15)
+    @requires_database
+    async def test_analytics_buffer(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO notification_registrations (toshi_id, service, registration_id, eth_address) "
+                              "VALUES ($1, $2, $3, $4)",
+                              TEST_TOSHI_ID, 'apn', 'abc', TEST_ADDRESS)
+
+        tracker = FakeTracker(SimpleNamespace(connection_pool=self.pool))
+        buffer = AnalyticsBuffer(flush_interval=60)
+        buffer.add(tracker, None, TEST_ADDRESS, "Sent transaction")
+        buffer.add(tracker, None, TEST_ADDRESS_2, "Received transaction", add_user_agent=False)
+        buffer.add(tracker, TEST_ADDRESS_2, TEST_ADDRESS_2, "Sent transaction")
+
+        # nothing is sent until the buffer is flushed
+        self.assertEqual(tracker.events, [])
+        await buffer.flush()
+        self.assertEqual(tracker.events, [
+            (TEST_TOSHI_ID, "Sent transaction", True),
+            (None, "Received transaction", False),
+            (TEST_ADDRESS_2, "Sent transaction", True)])
@@ -3,6 +3,7 @@ from toshieth.app import urls
 from tornado.escape import json_decode
 from tornado.testing import gen_test
 from toshi.test.database import requires_database
+from toshi.test.redis import requires_redis
 from toshi.test.ethereum.parity import requires_parity
 from toshi.test.ethereum.faucet import FaucetMixin, FAUCET_ADDRESS
 from toshi.utils import parse_int
@@ -11,6 +12,7 @@ from toshi.handlers import BaseHandler
 from toshi.database import DatabaseMixin
 from toshi.ethereum.mixin import EthereumMixin
 from toshieth.mixins import BalanceMixin
+from toshieth.cache import notify_new_block, clear_caches, invalidate_addresses
 
 from toshi.ethereum.tx import DEFAULT_STARTGAS, DEFAULT_GASPRICE
 
@@ -88,6 +90,84 @@ class BalanceTest(FaucetMixin, AsyncHandlerTest):
         self.assertEqual(parse_int(data['confirmed_balance']), val)
         self.assertEqual(parse_int(data['unconfirmed_balance']), val * 3)
 
+    @gen_test(timeout=30)
+    @requires_database
+    @requires_parity
+    async def test_get_multiple_balances(self):
+
+        tx_hash = '0x2f321aa116146a9bc62b61c76508295f708f42d56340c9e613ebfc27e33f240c'
+        addr = '0x39bf9e501e61440b4b268d7b2e9aa2458dd201bb'
+        empty_addr = '0x056db290f8ba3250ca64a45d16284d04bc6f5fbf'
+        val = 761751855997712
+
+        await self.faucet(addr, val)
+
+        async with self.pool.acquire() as con:
+            await con.execute(
+                "INSERT INTO transactions (hash, from_address, to_address, nonce, value, gas, gas_price, status) "
+                "VALUES ($1, $2, $3, $4, $5, $6, $7, $8)",
+                tx_hash, FAUCET_ADDRESS, addr, 0, hex(val),
+                hex(DEFAULT_STARTGAS), hex(DEFAULT_GASPRICE),
+                'unconfirmed')
+
+        resp = await self.fetch('/balances?address={}&address={}&address={}'.format(addr, empty_addr, FAUCET_ADDRESS))
+        self.assertEqual(resp.code, 200)
+        balances = json_decode(resp.body)['balances']
+        self.assertEqual(len(balances), 3)
+
+        self.assertEqual(parse_int(balances[addr]['confirmed_balance']), val)
+        self.assertEqual(parse_int(balances[addr]['unconfirmed_balance']), val * 2)
+        self.assertEqual(balances[empty_addr]['confirmed_balance'], "0x0")
+        self.assertEqual(balances[empty_addr]['unconfirmed_balance'], "0x0")
+
+        # make sure the results match the single address endpoint
+        for address in [addr, empty_addr, FAUCET_ADDRESS]:
+            resp = await self.fetch('/balance/{}'.format(address))
+            self.assertEqual(json_decode(resp.body), balances[address])
+
+        resp = await self.fetch('/balances?address={}&address=0x1234'.format(addr))
+        self.assertEqual(resp.code, 400)
+
+        resp = await self.fetch('/balances')
+        self.assertEqual(resp.code, 400)
+
+    @gen_test(timeout=30)
+    @requires_database
+    @requires_redis
+    @requires_parity
+    async def test_cached_balance(self):
+
+        addr = '0x39bf9e501e61440b4b268d7b2e9aa2458dd201bb'
+        val = 761751855997712
+
+        await self.faucet(addr, val)
+        # responses are only cached once the latest block is known
+        notify_new_block(1)
+        try:
+            resp = await self.fetch('/balance/{}'.format(addr))
+            self.assertEqual(resp.code, 200)
+            etag = resp.headers['Etag']
+            self.assertEqual(parse_int(json_decode(resp.body)['unconfirmed_balance']), val)
+
+            async with self.pool.acquire() as con:
+                await con.execute(
+                    "INSERT INTO transactions (hash, from_address, to_address, nonce, value, gas, gas_price, status) "
+                    "VALUES ($1, $2, $3, $4, $5, $6, $7, $8)",
+                    '0x2f321aa116146a9bc62b61c76508295f708f42d56340c9e613ebfc27e33f240c', FAUCET_ADDRESS, addr, 0, hex(val),
+                    hex(DEFAULT_STARTGAS), hex(DEFAULT_GASPRICE), 'unconfirmed')
+
+            # served from the cache until the address is invalidated
+            resp = await self.fetch('/balance/{}'.format(addr), headers={'If-None-Match': etag})
+            self.assertEqual(resp.code, 304)
+
+            await invalidate_addresses(addr)
+            resp = await self.fetch('/balance/{}'.format(addr), headers={'If-None-Match': etag})
+            self.assertEqual(resp.code, 200)
+            self.assertNotEqual(resp.headers['Etag'], etag)
+            self.assertEqual(parse_int(json_decode(resp.body)['unconfirmed_balance']), val * 2)
+        finally:
+            clear_caches()
+
     @gen_test(timeout=30)
     @requires_database
     @requires_parity
@@ -177,6 +257,51 @@ class BalanceTest(FaucetMixin, AsyncHandlerTest):
         self.assertEqual(parse_int(data['confirmed_balance']), 0)
         self.assertEqual(parse_int(data['unconfirmed_balance']), sent_val * 3)
 
+    @gen_test(timeout=30)
+    @requires_database
+    @requires_parity
+    async def test_get_balance_after_status_changes(self):
+
+        tx1_hash = '0x2f321aa116146a9bc62b61c76508295f708f42d56340c9e613ebfc27e33f240c'
+        tx2_hash = '0x2f321aa116146a9bc62b61c76508295f708f42d56340c9e613ebfc27e33f240d'
+        addr = '0x39bf9e501e61440b4b268d7b2e9aa2458dd201bb'
+        val = 761751855997712
+
+        await self.faucet(addr, val)
+
+        async with self.pool.acquire() as con:
+            await con.execute(
+                "INSERT INTO transactions (hash, from_address, to_address, nonce, value, gas, gas_price, status) "
+                "VALUES ($1, $2, $3, $4, $5, $6, $7, $8)",
+                tx1_hash, FAUCET_ADDRESS, addr, 0, hex(val),
+                hex(DEFAULT_STARTGAS), hex(DEFAULT_GASPRICE),
+                'unconfirmed')
+            await con.execute(
+                "INSERT INTO transactions (hash, from_address, to_address, nonce, value, gas, gas_price, status) "
+                "VALUES ($1, $2, $3, $4, $5, $6, $7, $8)",
+                tx2_hash, FAUCET_ADDRESS, addr, 1, hex(val),
+                hex(DEFAULT_STARTGAS), hex(DEFAULT_GASPRICE),
+                'unconfirmed')
+
+        resp = await self.fetch('/balance/{}'.format(addr))
+        self.assertEqual(resp.code, 200)
+        data = json_decode(resp.body)
+        self.assertEqual(parse_int(data['unconfirmed_balance']), val * 3)
+
+        async with self.pool.acquire() as con:
+            await con.execute("UPDATE transactions SET status = 'error' WHERE hash = $1", tx2_hash)
+            rows = await con.fetch("SELECT * FROM pending_balances WHERE eth_address = $1", addr)
+
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['status'], 'unconfirmed')
+        self.assertEqual(int(rows[0]['pending_received']), val)
+
+        resp = await self.fetch('/balance/{}'.format(addr))
+        self.assertEqual(resp.code, 200)
+        data = json_decode(resp.body)
+        self.assertEqual(parse_int(data['confirmed_balance']), val)
+        self.assertEqual(parse_int(data['unconfirmed_balance']), val * 2)
+
 class SimpleHandler(BalanceMixin, EthereumMixin, DatabaseMixin, BaseHandler):
 
     async def get(self, address):
@@ -0,0 +1,204 @@
+import asyncio
+from tornado.testing import gen_test
+
+from toshieth.test.base import EthServiceBaseTest
+from toshieth.cache import (
+    LRUCache, SingleFlight, BlockCache, RedisChannelListener, GasPriceWhitelistCache, notify_new_block
+)
+from toshieth.database import connect
+from toshi.test.database import requires_database
+from toshi.test.redis import requires_redis
+
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+TEST_ADDRESS_2 = "0x0000000000000000000000000000000000000001"
+TEST_CHANNEL = "toshieth.test_channel"
+
+class CacheTest(EthServiceBaseTest):
+
+    @gen_test(timeout=15)
+    async def test_lru_cache(self):
+
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # reading 'a' makes 'b' the least recently used entry
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('b', 'default'), 'default')
+
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertNotIn('a', cache)
+        self.assertIsNone(cache.pop('a'))
+
+        cache.set(('x', 1), 1)
+        cache.evict(lambda key: isinstance(key, tuple))
+        self.assertNotIn(('x', 1), cache)
+        self.assertIn('c', cache)
+
+        # expired entries are dropped when they are read
+        cache = LRUCache(ttl=0.1)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=60)
+        await asyncio.sleep(0.2)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(len(cache), 1)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    @gen_test(timeout=15)
+    async def test_single_flight(self):
+
+        single_flight = SingleFlight()
+        calls = []
+
+        async def func():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            return len(calls)
+
+        # concurrent callers for the same key share the result
+        results = await asyncio.gather(*[single_flight.do('a', func) for _ in range(5)],
+                                       single_flight.do('b', func))
+        self.assertEqual(results[:5], [results[0]] * 5)
+        self.assertEqual(len(calls), 2)
+
+        # once the call is done the next one starts a new call
+        self.assertEqual(await single_flight.do('a', func), 3)
+
+        # errors are passed to every caller
+        async def fail():
+            calls.append(1)
+            await asyncio.sleep(0.1)
+            raise Exception("failed")
+
+        results = await asyncio.gather(*[single_flight.do('a', fail) for _ in range(3)], return_exceptions=True)
+        self.assertEqual(len(calls), 4)
+        for result in results:
+            self.assertIsInstance(result, Exception)
+            self.assertEqual(str(result), "failed")
+
+        # a failed call doesn't prevent the next one
+        self.assertEqual(await single_flight.do('a', func), 5)
+
+    @gen_test(timeout=15)
+    @requires_redis
+    async def test_block_cache(self):
+
+        cache = BlockCache('test_block_cache')
+        calls = []
+
+        async def func(value):
+            calls.append(value)
+            await asyncio.sleep(0.1)
+            return value
+
+        # concurrent lookups share a single call
+        results = await asyncio.gather(*[cache.get(TEST_ADDRESS, 10, lambda: func(1)) for _ in range(5)])
+        self.assertEqual(results, [1] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(await cache.get(TEST_ADDRESS, 10, lambda: func(2)), 1)
+        self.assertEqual(len(calls), 1)
+
+        # other processes read the value from redis
+        other = BlockCache('test_block_cache')
+        self.assertEqual(await other.get(TEST_ADDRESS, 10, lambda: func(2)), 1)
+        self.assertEqual(len(calls), 1)
+
+        # without a block number nothing is cached
+        self.assertEqual(await cache.get(TEST_ADDRESS, None, lambda: func(3)), 3)
+        self.assertEqual(await cache.get(TEST_ADDRESS, None, lambda: func(4)), 4)
+        self.assertEqual(len(calls), 3)
+
+        # newer blocks are looked up separately and evict older local entries
+        self.assertEqual(await cache.get(TEST_ADDRESS, 11, lambda: func(5)), 5)
+        self.assertEqual(len(calls), 4)
+        self.assertNotIn((TEST_ADDRESS, 10), cache._lru)
+
+        # values for blocks older than the latest aren't kept locally
+        notify_new_block(12)
+        self.assertEqual(cache.blocknumber, 12)
+        self.assertEqual(other.blocknumber, 12)
+        self.assertEqual(len(cache._lru), 0)
+        await self.redis.delete(cache.redis_key(TEST_ADDRESS, 11))
+        self.assertEqual(await cache.get(TEST_ADDRESS, 11, lambda: func(6)), 6)
+        self.assertNotIn((TEST_ADDRESS, 11), cache._lru)
+
+        cache.clear()
+        self.assertEqual(cache.blocknumber, 0)
+
+    @gen_test(timeout=15)
+    @requires_redis
+    async def test_redis_channel_listener(self):
+
+        listener = RedisChannelListener()
+        messages = []
+
+        def fail(message):
+            raise Exception("failed")
+
+        listener.listen(TEST_CHANNEL, fail)
+        listener.listen(TEST_CHANNEL, messages.append)
+        try:
+            # wait for the subscription to be set up
+            while await self.redis.publish(TEST_CHANNEL, "ping") == 0:
+                await asyncio.sleep(0.05)
+            await self.redis.publish(TEST_CHANNEL, "hello")
+            while "hello" not in messages:
+                await asyncio.sleep(0.05)
+            # errors in one callback don't stop the others
+            self.assertEqual(messages[-1], "hello")
+        finally:
+            listener.shutdown()
+
+        await asyncio.sleep(0.1)
+        # nothing is received after shutting down
+        await self.redis.publish(TEST_CHANNEL, "bye")
+        await asyncio.sleep(0.1)
+        self.assertNotIn("bye", messages)
+
+    @gen_test(timeout=15)
+    @requires_database
+    async def test_gas_price_whitelist_listener(self):
+
+        cache = GasPriceWhitelistCache()
+        connections = []
+
+        async def connect_listener():
+            con = await connect()
+            connections.append(con)
+            return con
+
+        async def wait_for_whitelist(address):
+            while address not in (await cache.get(self.pool))[0]:
+                await asyncio.sleep(0.05)
+
+        await cache.listen(connect_listener, check_interval=0.1)
+        try:
+            self.assertEqual(await cache.get(self.pool), (frozenset(), frozenset()))
+            while not connections:
+                await asyncio.sleep(0.05)
+
+            # changes are picked up without waiting for the cache to expire
+            async with self.pool.acquire() as con:
+                await con.execute("INSERT INTO from_address_gas_price_whitelist (address) VALUES ($1)", TEST_ADDRESS)
+            await wait_for_whitelist(TEST_ADDRESS)
+
+            # the listener reconnects if its connection is lost
+            async with self.pool.acquire() as con:
+                await con.execute("SELECT pg_terminate_backend($1)", connections[0].get_server_pid())
+            while len(connections) < 2:
+                await asyncio.sleep(0.05)
+            async with self.pool.acquire() as con:
+                await con.execute("INSERT INTO from_address_gas_price_whitelist (address) VALUES ($1)", TEST_ADDRESS_2)
+            await wait_for_whitelist(TEST_ADDRESS_2)
+        finally:
+            await cache.stop_listening()
+
+        # the connection is closed once the listener is stopped
+        self.assertEqual(len(connections), 2)
+        self.assertTrue(connections[1].is_closed())
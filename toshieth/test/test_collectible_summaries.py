@@ -0,0 +1,87 @@
+import asyncio
+from tornado.testing import gen_test
+
+from toshieth.test.base import EthServiceBaseTest
+from toshieth.collectibles.base import update_collectible_owner_summaries, update_fungible_collectible_owner_summaries
+from toshieth.collectibles.punks import CRYPTO_PUNKS_CONTRACT_ADDRESS
+from toshi.test.database import requires_database
+
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+TEST_ADDRESS_2 = "0x0000000000000000000000000000000000000001"
+FUNGIBLE_COLLECTIBLE_ADDRESS = "0x0000000000000000000000000000000000000010"
+ASSET_ADDRESSES = ["0x0000000000000000000000000000000000000011", "0x0000000000000000000000000000000000000012"]
+
+class CollectibleSummariesTest(EthServiceBaseTest):
+
+    async def get_summaries(self, collectible_address):
+        async with self.pool.acquire() as con:
+            rows = await con.fetch("SELECT owner_address, value FROM collectible_owner_summaries "
+                                   "WHERE collectible_address = $1", collectible_address)
+        return {row['owner_address']: row['value'] for row in rows}
+
+    @gen_test(timeout=15)
+    @requires_database
+    async def test_punks_summaries(self):
+
+        async with self.pool.acquire() as con:
+            async with con.transaction():
+                await con.executemany(
+                    "INSERT INTO collectible_tokens (contract_address, token_id, owner_address) VALUES ($1, $2, $3)",
+                    [(CRYPTO_PUNKS_CONTRACT_ADDRESS, hex(i), TEST_ADDRESS) for i in range(3)])
+                await update_collectible_owner_summaries(con, CRYPTO_PUNKS_CONTRACT_ADDRESS, [TEST_ADDRESS])
+        self.assertEqual(await self.get_summaries(CRYPTO_PUNKS_CONTRACT_ADDRESS), {TEST_ADDRESS: 3})
+
+        # transfers recount both the previous and the new owner
+        async with self.pool.acquire() as con:
+            async with con.transaction():
+                await con.execute("UPDATE collectible_tokens SET owner_address = $1 WHERE contract_address = $2",
+                                  TEST_ADDRESS_2, CRYPTO_PUNKS_CONTRACT_ADDRESS)
+                await update_collectible_owner_summaries(con, CRYPTO_PUNKS_CONTRACT_ADDRESS, [TEST_ADDRESS, TEST_ADDRESS_2])
+        self.assertEqual(await self.get_summaries(CRYPTO_PUNKS_CONTRACT_ADDRESS), {TEST_ADDRESS_2: 3})
+
+    @gen_test(timeout=15)
+    @requires_database
+    async def test_concurrent_fungible_summaries(self):
+
+        async with self.pool.acquire() as con:
+            await con.executemany(
+                "INSERT INTO fungible_collectibles (contract_address, collectible_address, ready) VALUES ($1, $2, TRUE)",
+                [(address, FUNGIBLE_COLLECTIBLE_ADDRESS) for address in ASSET_ADDRESSES])
+
+        # balances of different assets of the same collectible are updated
+        # concurrently, as by the fungible collectible manager
+        con1 = await self.pool.acquire()
+        con2 = await self.pool.acquire()
+        try:
+            tr1 = con1.transaction()
+            await tr1.start()
+            await con1.execute("INSERT INTO fungible_collectible_balances (contract_address, owner_address, balance) "
+                               "VALUES ($1, $2, $3)", ASSET_ADDRESSES[0], TEST_ADDRESS, hex(1))
+            await update_fungible_collectible_owner_summaries(con1, FUNGIBLE_COLLECTIBLE_ADDRESS, [TEST_ADDRESS])
+
+            async def update_second_asset():
+                async with con2.transaction():
+                    await con2.execute("INSERT INTO fungible_collectible_balances (contract_address, owner_address, balance) "
+                                       "VALUES ($1, $2, $3)", ASSET_ADDRESSES[1], TEST_ADDRESS, hex(1))
+                    await update_fungible_collectible_owner_summaries(con2, FUNGIBLE_COLLECTIBLE_ADDRESS, [TEST_ADDRESS])
+            second = asyncio.get_event_loop().create_task(update_second_asset())
+            # give the second update time to block on the first
+            await asyncio.sleep(0.5)
+            self.assertFalse(second.done())
+
+            await tr1.commit()
+            await second
+        finally:
+            await self.pool.release(con1)
+            await self.pool.release(con2)
+
+        # the second recount includes the first asset
+        self.assertEqual(await self.get_summaries(FUNGIBLE_COLLECTIBLE_ADDRESS), {TEST_ADDRESS: 2})
+
+        # assets with a zero balance don't count
+        async with self.pool.acquire() as con:
+            async with con.transaction():
+                await con.execute("UPDATE fungible_collectible_balances SET balance = '0x0' WHERE contract_address = $1",
+                                  ASSET_ADDRESSES[0])
+                await update_fungible_collectible_owner_summaries(con, FUNGIBLE_COLLECTIBLE_ADDRESS, [TEST_ADDRESS])
+        self.assertEqual(await self.get_summaries(FUNGIBLE_COLLECTIBLE_ADDRESS), {TEST_ADDRESS: 1})
@@ -0,0 +1,79 @@
+import asyncio
+from tornado.testing import gen_test
+
+from toshieth.test.base import EthServiceBaseTest
+from toshieth.database import RequestDatabaseContext
+from toshi.test.database import requires_database
+
+class RequestDatabaseContextTest(EthServiceBaseTest):
+
+    @gen_test(timeout=15)
+    @requires_database
+    async def test_request_database_context(self):
+
+        db = RequestDatabaseContext(self.pool)
+        db.hold()
+
+        async with db:
+            pid = await db.fetchval("SELECT pg_backend_pid()")
+            # nested blocks share the outer transaction
+            async with db:
+                await db.execute("INSERT INTO token_registrations (eth_address) VALUES ($1)", "0x0000000000000000000000000000000000000001")
+            await db.commit()
+
+        # the connection is held between blocks
+        async with db:
+            self.assertEqual(await db.fetchval("SELECT pg_backend_pid()"), pid)
+            await db.execute("INSERT INTO token_registrations (eth_address) VALUES ($1)", "0x0000000000000000000000000000000000000002")
+            # concurrent statements take turns on the connection
+            results = await asyncio.gather(*[db.fetchval("SELECT $1::INTEGER", i) for i in range(5)])
+            self.assertEqual(results, list(range(5)))
+            # not committed
+
+        await db.release()
+        self.assertIsNone(db.connection)
+
+        async with self.pool.acquire() as con:
+            rows = await con.fetch("SELECT eth_address FROM token_registrations ORDER BY eth_address")
+        self.assertEqual([row['eth_address'] for row in rows], ["0x0000000000000000000000000000000000000001"])
+
+        # without holding the connection it's released after each block
+        db = RequestDatabaseContext(self.pool)
+        async with db:
+            await db.fetchval("SELECT 1")
+        self.assertIsNone(db.connection)
+
+    @gen_test(timeout=15)
+    @requires_database
+    async def test_concurrent_blocks(self):
+
+        db = RequestDatabaseContext(self.pool)
+        other_entered = asyncio.Event()
+        committed = asyncio.Event()
+
+        async def commit_block():
+            async with db:
+                await db.execute("INSERT INTO token_registrations (eth_address) VALUES ($1)", "0x0000000000000000000000000000000000000001")
+                await other_entered.wait()
+                await db.commit()
+                committed.set()
+            return db.connection
+
+        async def rollback_block():
+            async with db:
+                other_entered.set()
+                # still running after the other block committed
+                await committed.wait()
+                await db.execute("INSERT INTO token_registrations (eth_address) VALUES ($1)", "0x0000000000000000000000000000000000000002")
+                self.assertIsNotNone(db.transaction)
+                # not committed
+
+        connection, _ = await asyncio.gather(commit_block(), rollback_block())
+        # the connection is kept until the last block exits
+        self.assertIsNotNone(connection)
+        self.assertIsNone(db.connection)
+        self.assertEqual(db.depth, 0)
+
+        async with self.pool.acquire() as con:
+            rows = await con.fetch("SELECT eth_address FROM token_registrations ORDER BY eth_address")
+        self.assertEqual([row['eth_address'] for row in rows], ["0x0000000000000000000000000000000000000001"])
@@ -9,6 +9,10 @@ from toshieth.test.base import EthServiceBaseTest, requires_full_stack
 from toshi.test.ethereum.faucet import FAUCET_PRIVATE_KEY
 from toshi.sofa import parse_sofa_message
 from toshi.ethereum.utils import private_key_to_address, data_decoder
+from toshi.ethereum.tx import decode_transaction
+from toshi.utils import parse_int
+
+from toshieth.cache import gas_estimate_cache
 
 from toshi.ethereum.contract import Contract
 
@@ -893,3 +897,93 @@ class ERC20Test(EthServiceBaseTest):
                                       body={"contract_address": contract.address},
                                       signing_key=os.urandom(32))
         self.assertEqual(res.code, 400)
+
+    @gen_test(timeout=60)
+    @requires_full_stack(parity=True)
+    async def test_erc20_transfer_gas_estimate_cache(self, *, parity):
+
+        contract = await self.deploy_erc20_contract("TST", "Test Token", 18)
+        await contract.transfer.set_sender(FAUCET_PRIVATE_KEY)(TEST_ADDRESS, 10 * 10 ** 18)
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO token_balances (contract_address, eth_address, balance) VALUES ($1, $2, $3)",
+                              contract.address, TEST_ADDRESS, hex(10 * 10 ** 18))
+
+        self.assertEqual(len(gas_estimate_cache), 0)
+        tx = await self.get_tx_skel(TEST_PRIVATE_KEY, TEST_ADDRESS_2, 10 ** 18, token_address=contract.address)
+        node_gas = decode_transaction(tx).startgas
+        self.assertEqual(len(gas_estimate_cache), 1)
+
+        # a second transfer of the same shape uses the cached estimate
+        tx = await self.get_tx_skel(TEST_PRIVATE_KEY, TEST_ADDRESS_2, 2 * 10 ** 18, token_address=contract.address)
+        self.assertGreaterEqual(decode_transaction(tx).startgas, node_gas)
+        self.assertEqual(len(gas_estimate_cache), 1)
+
+        # transfers the sender can't afford still go through the node
+        await self.get_tx_skel(TEST_PRIVATE_KEY, TEST_ADDRESS_2, 20 * 10 ** 18,
+                               token_address=contract.address, expected_response_code=400)
+
+        # the cached estimate includes a new storage slot for the recipient,
+        # so it also covers transfers to addresses that already hold tokens
+        await contract.transfer.set_sender(FAUCET_PRIVATE_KEY)(TEST_ADDRESS_2, 10 ** 18)
+        tx = await self.get_tx_skel(TEST_PRIVATE_KEY, TEST_ADDRESS_2, 10 ** 18, token_address=contract.address)
+        self.assertGreaterEqual(decode_transaction(tx).startgas, node_gas)
+        self.assertEqual(len(gas_estimate_cache), 1)
+
+        # estimates for transfers to existing holders are lower, so they aren't cached
+        gas_estimate_cache.clear()
+        tx = await self.get_tx_skel(TEST_PRIVATE_KEY, TEST_ADDRESS_2, 10 ** 18, token_address=contract.address)
+        self.assertLess(decode_transaction(tx).startgas, node_gas)
+        self.assertEqual(len(gas_estimate_cache), 0)
+
+    @gen_test(timeout=60)
+    @requires_full_stack(parity=True)
+    async def test_erc20_transaction_skeleton_batch(self, *, parity):
+
+        contract = await self.deploy_erc20_contract("TST", "Test Token", 18)
+        await contract.transfer.set_sender(FAUCET_PRIVATE_KEY)(TEST_ADDRESS, 10 * 10 ** 18)
+        await self.faucet(TEST_ADDRESS, 10 ** 18)
+        async with self.pool.acquire() as con:
+            await con.execute("INSERT INTO token_balances (contract_address, eth_address, balance) VALUES ($1, $2, $3)",
+                              contract.address, TEST_ADDRESS, hex(10 * 10 ** 18))
+
+        resp = await self.fetch("/tx/skel/batch", method="POST", body={
+            "transactions": [
+                {"from": TEST_ADDRESS, "to": TEST_ADDRESS_2, "value": 6 * 10 ** 18, "token_address": contract.address},
+                {"from": TEST_ADDRESS, "to": TEST_ADDRESS_2, "value": 6 * 10 ** 18, "token_address": contract.address},
+                {"from": TEST_ADDRESS, "to": TEST_ADDRESS_2, "value": "max", "token_address": contract.address}
+            ]
+        })
+        self.assertResponseCodeEqual(resp, 200, resp.body)
+        body = json_decode(resp.body)
+        self.assertEqual(parse_int(body['transactions'][0]['value']), 6 * 10 ** 18)
+        # the second transfer is more than what's left after the first
+        self.assertEqual(body['transactions'][1]['errors'][0]['id'], 'insufficient_funds')
+        # and "max" only gets what's left
+        self.assertEqual(parse_int(body['transactions'][2]['value']), 4 * 10 ** 18)
+        self.assertEqual([parse_int(body['transactions'][i]['nonce']) for i in (0, 2)], [0, 1])
+
+    @gen_test(timeout=30)
+    @requires_full_stack(erc20_manager=True)
+    async def test_token_registration_last_queried_is_batched(self, *, erc20_manager):
+
+        resp = await self.fetch("/tokens/{}".format(TEST_ADDRESS))
+        self.assertEqual(resp.code, 200)
+        async with self.pool.acquire() as con:
+            registration = await con.fetchrow("SELECT * FROM token_registrations WHERE eth_address = $1", TEST_ADDRESS)
+            self.assertIsNotNone(registration)
+            await con.execute("UPDATE token_registrations SET last_queried = last_queried - INTERVAL '1 day' "
+                              "WHERE eth_address = $1", TEST_ADDRESS)
+
+        # reading again doesn't touch the database
+        resp = await self.fetch("/tokens/{}".format(TEST_ADDRESS))
+        self.assertEqual(resp.code, 200)
+        async with self.pool.acquire() as con:
+            last_queried = await con.fetchval("SELECT last_queried FROM token_registrations WHERE eth_address = $1", TEST_ADDRESS)
+        self.assertLess(last_queried, registration['last_queried'])
+
+        from toshieth.tasks import erc20_dispatcher
+        erc20_dispatcher.flush_token_registrations(0)
+        while last_queried < registration['last_queried']:
+            await asyncio.sleep(0.1)
+            async with self.pool.acquire() as con:
+                last_queried = await con.fetchval("SELECT last_queried FROM token_registrations WHERE eth_address = $1", TEST_ADDRESS)
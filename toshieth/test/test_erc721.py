@@ -123,6 +123,15 @@ class ERC721Test(EthServiceBaseTest):
         body = json_decode(resp.body)
         self.assertEqual(len(body['tokens']), len(users_tokens) - 1)
 
+        # the collectibles list is served from the owner summaries
+        for address, count in [(TEST_ADDRESS, len(users_tokens) - 1), (TEST_ADDRESS_2, 1)]:
+            resp = await self.fetch("/collectibles/{}".format(address))
+            self.assertResponseCodeEqual(resp, 200)
+            body = json_decode(resp.body)
+            self.assertEqual(len(body['collectibles']), 1)
+            self.assertEqual(body['collectibles'][0]['contract_address'], contract.address)
+            self.assertEqual(body['collectibles'][0]['value'], hex(count))
+
     @gen_test(timeout=60)
     @requires_full_stack(parity=True, push_client=True, block_monitor=True, collectible_monitor=True)
     async def test_not_quite_erc721_transfer(self, *, parity, push_client, monitor, collectible_monitor):
@@ -0,0 +1,94 @@
+import asyncio
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from toshieth.ethclient import EthereumClient
+from toshieth.test.test_node_pool import FakeNode
+from toshi.jsonrpc.errors import JsonRPCError
+
+TEST_ADDRESSES = ["0x000000000000000000000000000000000000000{}".format(i) for i in range(1, 4)]
+
+class EthereumClientTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.node = FakeNode()
+
+    def tearDown(self):
+        self.node.stop()
+        super().tearDown()
+
+    @gen_test(timeout=10)
+    async def test_batches_calls(self):
+
+        client = EthereumClient(self.node.url)
+
+        # calls made in the same loop iteration are sent as one request
+        results = await asyncio.gather(*[client.eth_getBalance(address) for address in TEST_ADDRESSES])
+        self.assertEqual(results, [self.node.url] * 3)
+        self.assertEqual(self.node.requests, [3])
+
+        results = await asyncio.gather(client.eth_getBalance(TEST_ADDRESSES[0]), client.eth_getCode(TEST_ADDRESSES[0]))
+        self.assertEqual(results, [self.node.url] * 2)
+        self.assertEqual(self.node.requests, [3, 2])
+
+        await client.eth_getBalance(TEST_ADDRESSES[0])
+        self.assertEqual(self.node.requests, [3, 2, 1])
+
+        stats = client.stats()
+        self.assertEqual(stats['eth_getBalance']['calls'], 5)
+        self.assertEqual(stats['eth_getCode']['calls'], 1)
+
+    @gen_test(timeout=10)
+    async def test_shares_identical_calls(self):
+
+        client = EthereumClient(self.node.url)
+
+        results = await asyncio.gather(*[client.eth_getCode(TEST_ADDRESSES[0]) for _ in range(5)],
+                                       client.eth_getCode(TEST_ADDRESSES[1]))
+        self.assertEqual(results, [self.node.url] * 6)
+        self.assertEqual(self.node.calls.count('eth_getCode'), 2)
+
+        # calls with side effects are always sent
+        await asyncio.gather(*[client.eth_sendRawTransaction("0x00") for _ in range(2)])
+        self.assertEqual(self.node.calls.count('eth_sendRawTransaction'), 2)
+
+        # finished calls aren't reused
+        await client.eth_getCode(TEST_ADDRESSES[0])
+        self.assertEqual(self.node.calls.count('eth_getCode'), 3)
+
+    @gen_test(timeout=10)
+    async def test_errors_passed_to_each_caller(self):
+
+        client = EthereumClient(self.node.url, should_retry=False)
+
+        # json rpc errors only fail the call that caused them
+        self.node.errors.add('eth_getCode')
+        results = await asyncio.gather(client.eth_getCode(TEST_ADDRESSES[0]), client.eth_getBalance(TEST_ADDRESSES[0]),
+                                       return_exceptions=True)
+        self.assertIsInstance(results[0], JsonRPCError)
+        self.assertEqual(results[1], self.node.url)
+        self.assertEqual(self.node.requests, [2])
+
+        # failed requests fail every call in the batch
+        self.node.fail = True
+        results = await asyncio.gather(*[client.eth_getBalance(address) for address in TEST_ADDRESSES],
+                                       return_exceptions=True)
+        for result in results:
+            self.assertIsInstance(result, Exception)
+        self.assertEqual(client.stats()['eth_getBalance']['errors'], 3)
+
+        # the client keeps working once the node recovers
+        self.node.fail = False
+        self.assertEqual(await client.eth_getBalance(TEST_ADDRESSES[0]), self.node.url)
+
+    @gen_test(timeout=10)
+    async def test_limits_concurrent_requests(self):
+
+        self.node.delay = 0.1
+        client = EthereumClient(self.node.url, max_concurrency=2, batch=False)
+
+        results = await asyncio.gather(*[client.eth_getBalance(address) for address in TEST_ADDRESSES])
+        self.assertEqual(results, [self.node.url] * 3)
+        self.assertEqual(self.node.requests, [1, 1, 1])
+        self.assertEqual(self.node.max_active, 2)
@@ -0,0 +1,182 @@
+import asyncio
+import tornado.web
+
+from tornado.escape import json_decode, json_encode
+from tornado.httpserver import HTTPServer
+from tornado.testing import AsyncTestCase, gen_test, bind_unused_port
+
+from toshieth.ethclient import EthereumNodePool
+
+class FakeNodeHandler(tornado.web.RequestHandler):
+
+    def initialize(self, node):
+        self.node = node
+
+    async def post(self):
+        data = json_decode(self.request.body)
+        self.node.requests.append(len(data) if isinstance(data, list) else 1)
+        self.node.active += 1
+        self.node.max_active = max(self.node.active, self.node.max_active)
+        try:
+            await asyncio.sleep(self.node.delay)
+        finally:
+            self.node.active -= 1
+        if self.node.fail:
+            raise tornado.web.HTTPError(500)
+        if isinstance(data, list):
+            self.write(json_encode([self.node.handle(request) for request in data]))
+        else:
+            self.write(json_encode(self.node.handle(data)))
+
+class FakeNode:
+    """Minimal json rpc server that answers with its own url so the tests
+    can tell which node handled each call"""
+
+    def __init__(self, head=100, delay=0.0):
+        self.head = head
+        self.delay = delay
+        self.calls = []
+        # the number of calls in each http request
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        # methods that return json rpc errors
+        self.errors = set()
+        # whether requests fail with an http error
+        self.fail = False
+        sock, port = bind_unused_port()
+        self.url = "http://127.0.0.1:{}/".format(port)
+        self.server = HTTPServer(tornado.web.Application([(r"/", FakeNodeHandler, {'node': self})]))
+        self.server.add_sockets([sock])
+
+    def handle(self, request):
+        self.calls.append(request['method'])
+        if request['method'] in self.errors:
+            return {'jsonrpc': '2.0', 'id': request['id'], 'error': {'code': -32000, 'message': "failed"}}
+        if request['method'] == 'eth_blockNumber':
+            result = hex(self.head)
+        else:
+            result = self.url
+        return {'jsonrpc': '2.0', 'id': request['id'], 'result': result}
+
+    def stop(self):
+        self.server.stop()
+
+class NodePoolTest(AsyncTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.nodes = []
+
+    def tearDown(self):
+        for node in self.nodes:
+            node.stop()
+        super().tearDown()
+
+    def start_nodes(self, *nodes):
+        self.nodes.extend(nodes)
+        return EthereumNodePool([node.url for node in nodes], hedge_delay=0.2, head_refresh_interval=0.1)
+
+    @gen_test(timeout=10)
+    async def test_routes_to_fastest_node(self):
+
+        slow = FakeNode(delay=0.1)
+        fast = FakeNode()
+        pool = self.start_nodes(slow, fast)
+        try:
+            for _ in range(5):
+                await pool.eth_getCode("0x0000000000000000000000000000000000000000")
+            # once the latency is known the fast node should be preferred
+            self.assertEqual(await pool.eth_getCode("0x0000000000000000000000000000000000000000"), fast.url)
+        finally:
+            pool.shutdown()
+
+    @gen_test(timeout=10)
+    async def test_routes_to_node_with_required_block(self):
+
+        behind = FakeNode(head=100)
+        synced = FakeNode(head=101, delay=0.05)
+        pool = self.start_nodes(behind, synced)
+        try:
+            await pool.eth_blockNumber()
+            await asyncio.sleep(0.3)
+            result = await pool.eth_getBalance("0x0000000000000000000000000000000000000000", block=101)
+            self.assertEqual(result, synced.url)
+        finally:
+            pool.shutdown()
+
+    @gen_test(timeout=10)
+    async def test_hedges_slow_reads(self):
+
+        stuck = FakeNode(delay=5)
+        backup = FakeNode()
+        pool = self.start_nodes(stuck, backup)
+        try:
+            start = asyncio.get_event_loop().time()
+            result = await pool.eth_getCode("0x0000000000000000000000000000000000000000")
+            self.assertEqual(result, backup.url)
+            self.assertLess(asyncio.get_event_loop().time() - start, 1)
+        finally:
+            pool.shutdown()
+
+    @gen_test(timeout=10)
+    async def test_sends_transactions_to_all_nodes(self):
+
+        nodes = [FakeNode(), FakeNode(), FakeNode()]
+        pool = self.start_nodes(*nodes)
+        try:
+            await pool.eth_sendRawTransaction("0x00")
+            for node in nodes:
+                self.assertIn('eth_sendRawTransaction', node.calls)
+        finally:
+            pool.shutdown()
+
+    @gen_test(timeout=10)
+    async def test_routes_latest_and_hash_lookups_to_synced_nodes(self):
+
+        behind = FakeNode(head=100)
+        synced = FakeNode(head=105, delay=0.05)
+        pool = self.start_nodes(behind, synced)
+        try:
+            await pool.eth_blockNumber()
+            await asyncio.sleep(0.3)
+            tx_hash = "0x" + "00" * 32
+            address = "0x0000000000000000000000000000000000000000"
+            self.assertEqual(await pool.eth_getTransactionReceipt(tx_hash), synced.url)
+            self.assertEqual(await pool.eth_getTransactionByHash(tx_hash), synced.url)
+            self.assertEqual(await pool.eth_getTransactionCount(address), synced.url)
+            self.assertEqual(await pool.eth_getTransactionCount(address, block="latest"), synced.url)
+            # older blocks can still be read from the faster node
+            self.assertEqual(await pool.eth_getBalance(address, block=100), behind.url)
+
+            # nodes within the tolerance are used as well
+            behind.head = 104
+            await asyncio.sleep(0.3)
+            self.assertEqual(await pool.eth_getTransactionReceipt(tx_hash), behind.url)
+        finally:
+            pool.shutdown()
+
+    @gen_test(timeout=10)
+    async def test_bulk_requests_use_required_block(self):
+
+        behind = FakeNode(head=100)
+        synced = FakeNode(head=105, delay=0.05)
+        pool = self.start_nodes(behind, synced)
+        try:
+            await pool.eth_blockNumber()
+            await asyncio.sleep(0.3)
+
+            bulk = pool.bulk()
+            balance = bulk.eth_getBalance("0x0000000000000000000000000000000000000000", block=100)
+            await bulk.execute()
+            self.assertEqual(balance.result(), behind.url)
+
+            # the node has to satisfy every call in the request
+            bulk = pool.bulk()
+            balance = bulk.eth_getBalance("0x0000000000000000000000000000000000000000", block=100)
+            receipt = bulk.eth_getTransactionReceipt("0x" + "00" * 32)
+            await bulk.execute()
+            self.assertEqual(balance.result(), synced.url)
+            self.assertEqual(receipt.result(), synced.url)
+        finally:
+            pool.shutdown()
@@ -0,0 +1,54 @@
+import asyncio
+from tornado.testing import gen_test
+
+from toshieth.test.base import EthServiceBaseTest
+from toshieth.nonce import NonceManager
+from toshi.test.redis import requires_redis
+
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+
+class NonceManagerTest(EthServiceBaseTest):
+
+    @gen_test(timeout=15)
+    @requires_redis
+    async def test_nonce_manager(self):
+
+        nonces = NonceManager()
+        reconciliations = []
+
+        async def reconcile():
+            reconciliations.append(1)
+            await asyncio.sleep(0.1)
+            return 5
+
+        # concurrent lookups share a single reconciliation
+        results = await asyncio.gather(*[nonces.get(TEST_ADDRESS, reconcile) for _ in range(5)])
+        self.assertEqual(results, [5] * 5)
+        self.assertEqual(len(reconciliations), 1)
+
+        # submitted transactions raise the nonce without hitting the node
+        await nonces.submitted(TEST_ADDRESS, 5)
+        self.assertEqual(await nonces.get(TEST_ADDRESS, reconcile), 6)
+        await nonces.submitted(TEST_ADDRESS, 3)
+        self.assertEqual(await nonces.get(TEST_ADDRESS, reconcile), 6)
+        self.assertEqual(len(reconciliations), 1)
+
+        # transactions seen in blocks only raise nonces that are already stored
+        await nonces.observe_block([{'from': TEST_ADDRESS, 'nonce': hex(9)},
+                                    {'from': "0x0000000000000000000000000000000000000000", 'nonce': hex(1)}])
+        self.assertEqual(await nonces.get(TEST_ADDRESS, reconcile), 10)
+        self.assertIsNone(await self.redis.get(nonces.redis_key("0x0000000000000000000000000000000000000000")))
+
+        # errors cause the nonce to be recomputed
+        await nonces.reset(TEST_ADDRESS)
+        self.assertEqual(await nonces.get(TEST_ADDRESS, reconcile), 5)
+        self.assertEqual(len(reconciliations), 2)
+
+        # checksummed addresses share the nonce of the lowercase address
+        self.assertEqual(await nonces.get(TEST_ADDRESS.upper().replace('0X', '0x'), reconcile), 5)
+        self.assertEqual(len(reconciliations), 2)
+
+        # forced reconciliation can lower the nonce
+        await nonces.submitted(TEST_ADDRESS, 20)
+        self.assertEqual(await nonces.reconcile(TEST_ADDRESS, reconcile), 5)
+        self.assertEqual(await nonces.get(TEST_ADDRESS, reconcile), 5)
@@ -0,0 +1,114 @@
+import asyncio
+from tornado.testing import gen_test
+
+from toshieth.test.base import EthServiceBaseTest
+from toshieth.rebroadcast import RebroadcastScheduler
+from toshi.ethereum.tx import sign_transaction, create_transaction, encode_transaction, calculate_transaction_hash
+from toshi.ethereum.utils import data_decoder
+from toshi.test.database import requires_database
+from toshi.test.redis import requires_redis
+
+TEST_PRIVATE_KEY = data_decoder("0xe8f32e723decf4051aefac8e2c93c9c5b214313817cdb01a1494b917c8436b35")
+TEST_ADDRESS = "0x056db290f8ba3250ca64a45d16284d04bc6f5fbf"
+TEST_ADDRESS_2 = "0x0000000000000000000000000000000000000001"
+
+class FakeEthereumClient:
+    """pretends the node doesn't know about any transactions"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def eth_getTransactionByHash(self, tx_hash):
+        return None
+
+    async def eth_sendRawTransaction(self, tx):
+        self.sent.append(tx)
+
+class RebroadcastSchedulerTest(EthServiceBaseTest):
+
+    async def insert_transaction(self, nonce):
+        tx = create_transaction(nonce=nonce, gasprice=10 ** 10, startgas=21000, to=TEST_ADDRESS_2, value=10 ** 18)
+        sign_transaction(tx, TEST_PRIVATE_KEY)
+        tx_hash = calculate_transaction_hash(tx)
+        async with self.pool.acquire() as con:
+            # data is left NULL, as it is for plain eth transfers
+            await con.execute(
+                "INSERT INTO transactions (hash, from_address, to_address, nonce, value, gas, gas_price, v, r, s, status) "
+                "VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, 'unconfirmed')",
+                tx_hash, TEST_ADDRESS, TEST_ADDRESS_2, nonce, hex(tx.value), hex(tx.startgas), hex(tx.gasprice),
+                hex(tx.v), hex(tx.r), hex(tx.s))
+        return tx_hash, encode_transaction(tx)
+
+    async def shutdown(self, scheduler):
+        task = scheduler.shutdown()
+        if task is not None:
+            await task
+
+    @gen_test(timeout=15)
+    @requires_database
+    @requires_redis
+    async def test_rebroadcast_scheduler(self):
+
+        tx_hash, raw_tx = await self.insert_transaction(0)
+
+        eth = FakeEthereumClient()
+        scheduler = RebroadcastScheduler(eth, initial_delay=0.1, max_delay=0.1)
+        await scheduler.start(self.pool)
+        try:
+            self.assertEqual(len(scheduler), 1)
+            # transactions the node doesn't know about are resubmitted
+            while not eth.sent:
+                await asyncio.sleep(0.05)
+            self.assertEqual(eth.sent[0], raw_tx)
+
+            # once the transaction is confirmed elsewhere it's no longer resubmitted
+            async with self.pool.acquire() as con:
+                await con.execute("UPDATE transactions SET status = 'confirmed' WHERE hash = $1", tx_hash)
+            await asyncio.sleep(0.3)
+            self.assertEqual(len(scheduler), 0)
+            sent = len(eth.sent)
+            await asyncio.sleep(0.3)
+            self.assertEqual(len(eth.sent), sent)
+        finally:
+            await self.shutdown(scheduler)
+
+    @gen_test(timeout=15)
+    @requires_database
+    @requires_redis
+    async def test_rebroadcast_lease(self):
+
+        await self.insert_transaction(0)
+
+        # each scheduler stands in for a separate manager process
+        schedulers = [RebroadcastScheduler(FakeEthereumClient(), initial_delay=60, sync_interval=0.1)
+                      for _ in range(2)]
+        for scheduler in schedulers:
+            await scheduler.start(self.pool)
+        try:
+            self.assertTrue(schedulers[0].leader)
+            self.assertFalse(schedulers[1].leader)
+            self.assertEqual(len(schedulers[0]), 1)
+            self.assertEqual(len(schedulers[1]), 0)
+
+            # transactions added by other processes are picked up by the leader
+            tx_hash, _ = await self.insert_transaction(1)
+            schedulers[1].track({'hash': tx_hash})
+            self.assertEqual(len(schedulers[1]), 0)
+            await asyncio.sleep(0.3)
+            self.assertEqual(len(schedulers[0]), 2)
+
+            # and transactions confirmed by other processes are dropped
+            async with self.pool.acquire() as con:
+                await con.execute("UPDATE transactions SET status = 'confirmed', updated = (now() AT TIME ZONE 'utc') "
+                                  "WHERE hash = $1", tx_hash)
+            await asyncio.sleep(0.3)
+            self.assertEqual(len(schedulers[0]), 1)
+
+            # another process takes over when the leader shuts down
+            await self.shutdown(schedulers[0])
+            await asyncio.sleep(0.3)
+            self.assertTrue(schedulers[1].leader)
+            self.assertEqual(len(schedulers[1]), 1)
+        finally:
+            for scheduler in schedulers:
+                await self.shutdown(scheduler)
@@ -45,3 +45,43 @@ class SOFATest(EthServiceBaseTest):
         message = parse_sofa_message(resp.body.decode('utf-8'))
         self.assertEqual(message["txHash"], tx_hash)
         self.assertEqual(message["status"], "confirmed")
+
+    @gen_test(timeout=30)
+    @requires_full_stack
+    async def test_cached_sofa_payment_updates_on_confirmation(self):
+
+        body = {
+            "from": FAUCET_ADDRESS,
+            "to": TEST_ADDRESS,
+            "value": 10 ** 10
+        }
+
+        resp = await self.fetch("/tx/skel", method="POST", body=body)
+        self.assertEqual(resp.code, 200)
+
+        body = json_decode(resp.body)
+        tx = sign_transaction(body['tx'], FAUCET_PRIVATE_KEY)
+        resp = await self.fetch("/tx", method="POST", body={
+            "tx": tx
+        })
+        self.assertEqual(resp.code, 200, resp.body)
+        body = json_decode(resp.body)
+        tx_hash = body['tx_hash']
+
+        # populate the cache while the transaction is still pending
+        resp = await self.fetch("/tx/{}?format=sofa".format(tx_hash), method="GET")
+        self.assertEqual(resp.code, 200, resp.body)
+        message = parse_sofa_message(resp.body.decode('utf-8'))
+        self.assertEqual(message["txHash"], tx_hash)
+
+        await self.wait_on_tx_confirmation(tx_hash)
+
+        # the status change should have invalidated the cached payment
+        resp = await self.fetch("/tx/{}?format=sofa".format(tx_hash), method="GET")
+        self.assertEqual(resp.code, 200, resp.body)
+        message = parse_sofa_message(resp.body.decode('utf-8'))
+        self.assertEqual(message["status"], "confirmed")
+
+        resp = await self.fetch("/tx/{}".format(tx_hash), method="GET")
+        self.assertEqual(resp.code, 200, resp.body)
+        self.assertIsNotNone(json_decode(resp.body)['blockNumber'])
@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 import blockies
 import hashlib
+import os
+import tempfile
 
 from tornado.escape import json_decode
 from tornado.testing import gen_test
 
 from toshieth.app import urls
+from toshieth.cache import icon_cache, notify_new_block, clear_caches, token_registration_cache
+from toshi.config import config
 from toshi.test.database import requires_database
+from toshi.test.redis import requires_redis
 from toshi.test.base import AsyncHandlerTest
 
 # reuse constant from test_avatar.py (toshiid)
@@ -107,6 +112,82 @@ class TokenHandlerTest(AsyncHandlerTest):
             else:
                 self.assertEqual(token['icon'], url)
 
+    @gen_test
+    @requires_database
+    async def test_token_list_etag(self):
+
+        async with self.pool.acquire() as con:
+            await con.execute(
+                "INSERT INTO tokens "
+                "(contract_address, symbol, name, decimals) "
+                "VALUES ($1, $2, $3, $4)",
+                "0x1111111111111111111111111111111111111111", "ABC", "Awesome Balls Currency Token", 18
+            )
+
+        resp = await self.fetch("/tokens", method="GET")
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(len(json_decode(resp.body)['tokens']), 1)
+        etag = resp.headers.get('Etag')
+        self.assertIsNotNone(etag)
+
+        resp = await self.fetch("/tokens", method="GET", headers={'If-None-Match': etag})
+        self.assertResponseCodeEqual(resp, 304)
+
+        # adding a token should change the list
+        async with self.pool.acquire() as con:
+            await con.execute(
+                "INSERT INTO tokens "
+                "(contract_address, symbol, name, decimals) "
+                "VALUES ($1, $2, $3, $4)",
+                "0x2222222222222222222222222222222222222222", "YAC", "Yet Another Currency Token", 2
+            )
+
+        resp = await self.fetch("/tokens", method="GET", headers={'If-None-Match': etag})
+        self.assertResponseCodeEqual(resp, 200)
+        self.assertEqual(len(json_decode(resp.body)['tokens']), 2)
+        self.assertNotEqual(resp.headers.get('Etag'), etag)
+
+    @gen_test
+    @requires_database
+    async def test_token_icon_cache(self):
+        image = blockies.create(TEST_ADDRESS, size=8, scale=12)
+        hasher = hashlib.md5()
+        hasher.update(image)
+        hash = hasher.hexdigest()
+        contract_address = "0x1111111111111111111111111111111111111111"
+
+        async with self.pool.acquire() as con:
+            await con.execute(
+                "INSERT INTO tokens "
+                "(contract_address, symbol, name, decimals, icon, hash, format) "
+                "VALUES ($1, $2, $3, $4, $5, $6, $7)",
+                contract_address, "ABC", "Awesome Balls Currency Token", 18, image, hash, 'png'
+            )
+
+        icon_cache.clear()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            config['icons'] = {'cache_dir': cache_dir}
+            try:
+                resp = await self.fetch("/token/{}.png".format(contract_address))
+                self.assertResponseCodeEqual(resp, 200)
+                self.assertEqual(resp.body, image)
+                etag = resp.headers.get('Etag')
+                self.assertTrue(os.path.exists(os.path.join(cache_dir, "{}.png.{}".format(contract_address, hash))))
+
+                resp = await self.fetch("/token/{}.png".format(contract_address), headers={'If-None-Match': etag})
+                self.assertResponseCodeEqual(resp, 304)
+
+                # the icon should now be served from the disk cache
+                icon_cache.clear()
+                async with self.pool.acquire() as con:
+                    await con.execute("UPDATE tokens SET icon = NULL WHERE contract_address = $1", contract_address)
+                resp = await self.fetch("/token/{}.png".format(contract_address))
+                self.assertResponseCodeEqual(resp, 200)
+                self.assertEqual(resp.body, image)
+            finally:
+                del config['icons']
+                icon_cache.clear()
+
     @gen_test
     @requires_database
     async def test_token_balances(self):
@@ -183,3 +264,50 @@ class TokenHandlerTest(AsyncHandlerTest):
         # make sure single token balance for non-existent token 404s
         resp = await self.fetch("/tokens/{}/{}".format(TEST_ADDRESS_2, "0x3333333333333333333333333333333333333333"))
         self.assertResponseCodeEqual(resp, 404)
+
+    @gen_test
+    @requires_database
+    @requires_redis
+    async def test_cached_token_balances(self):
+        image = blockies.create(TEST_ADDRESS, size=8, scale=12)
+        hasher = hashlib.md5()
+        hasher.update(image)
+        hash = hasher.hexdigest()
+
+        async with self.pool.acquire() as con:
+            await con.execute(
+                "INSERT INTO tokens "
+                "(contract_address, symbol, name, decimals, icon, hash, format) "
+                "VALUES ($1, $2, $3, $4, $5, $6, $7)",
+                "0x1111111111111111111111111111111111111111", "ABC", "Awesome Balls Currency Token", 18, image, hash, 'png'
+            )
+            await con.execute(
+                "INSERT INTO token_balances "
+                "(contract_address, eth_address, balance) "
+                "VALUES ($1, $2, $3)",
+                "0x1111111111111111111111111111111111111111", TEST_ADDRESS, hex(2 * 10 ** 18))
+            await con.execute("INSERT INTO token_registrations (eth_address) VALUES ($1)", TEST_ADDRESS)
+
+        # responses are only cached once the latest block is known
+        notify_new_block(1)
+        try:
+            # a request with a different host doesn't change the icon urls other clients get
+            resp = await self.fetch("/tokens/{}".format(TEST_ADDRESS), headers={'Host': 'evil.example.com'})
+            self.assertResponseCodeEqual(resp, 200)
+            self.assertTrue(json_decode(resp.body)['tokens'][0]['icon'].startswith("http://evil.example.com/"))
+
+            evil_etag = resp.headers['Etag']
+
+            resp = await self.fetch("/tokens/{}".format(TEST_ADDRESS), headers={'If-None-Match': evil_etag})
+            self.assertResponseCodeEqual(resp, 200)
+            self.assertEqual(json_decode(resp.body)['tokens'][0]['icon'],
+                             self.get_url("/token/0x1111111111111111111111111111111111111111.png"))
+            self.assertNotEqual(resp.headers['Etag'], evil_etag)
+
+            # polls served from the cache still count as queries
+            await token_registration_cache.pop_touched()
+            resp = await self.fetch("/tokens/{}".format(TEST_ADDRESS))
+            self.assertResponseCodeEqual(resp, 200)
+            self.assertIn(TEST_ADDRESS, await token_registration_cache.pop_touched())
+        finally:
+            clear_caches()
@@ -200,6 +200,41 @@ class TransactionTest(EthServiceBaseTest):
         for tx_hash in tx_hashes:
             await self.wait_on_tx_confirmation(tx_hash)
 
+    @gen_test(timeout=30)
+    @requires_full_stack
+    async def test_send_transaction_batch(self):
+
+        resp = await self.fetch("/tx/skel/batch", method="POST", body={
+            "transactions": [{"from": FAUCET_ADDRESS, "to": TEST_ADDRESS, "value": 10 ** 10}] * 5
+        })
+        self.assertResponseCodeEqual(resp, 200, resp.body)
+        txs = [sign_transaction(skel['tx'], FAUCET_PRIVATE_KEY) for skel in json_decode(resp.body)['transactions']]
+
+        # send them out of order, with a duplicate nonce
+        resp = await self.fetch("/tx/batch", method="POST", body={
+            "transactions": [{"tx": tx} for tx in reversed(txs)] + [{"tx": txs[0]}]
+        })
+        self.assertResponseCodeEqual(resp, 200, resp.body)
+        results = json_decode(resp.body)['transactions']
+        self.assertEqual(len(results), 6)
+        for result in results[:5]:
+            self.assertIn('tx_hash', result)
+        self.assertEqual(results[5]['errors'][0]['id'], 'invalid_nonce')
+
+        async with self.pool.acquire() as con:
+            rows = await con.fetch("SELECT * FROM transactions WHERE from_address = $1", FAUCET_ADDRESS)
+        self.assertEqual(len(rows), 5)
+
+        for result in results[:5]:
+            await self.wait_on_tx_confirmation(result['tx_hash'])
+
+        # nonces that have already been used are rejected
+        resp = await self.fetch("/tx/batch", method="POST", body={
+            "transactions": [{"tx": txs[-1]}]
+        })
+        self.assertResponseCodeEqual(resp, 200, resp.body)
+        self.assertEqual(json_decode(resp.body)['transactions'][0]['errors'][0]['id'], 'invalid_nonce')
+
     @gen_test(timeout=30)
     @requires_full_stack
     async def test_empty_account(self):
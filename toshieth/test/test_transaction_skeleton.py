@@ -3,7 +3,7 @@ import os
 from tornado.testing import gen_test
 from tornado.escape import json_decode
 from toshieth.test.base import EthServiceBaseTest, requires_full_stack
-from toshi.ethereum.utils import private_key_to_address, data_decoder
+from toshi.ethereum.utils import private_key_to_address, data_decoder, checksum_encode_address
 from toshi.utils import parse_int
 from toshi.test.ethereum.faucet import FAUCET_PRIVATE_KEY
 
@@ -156,3 +156,131 @@ class TransactionSkeletonTest(EthServiceBaseTest):
 
         })
         self.assertEqual(resp.code, 400)
+
+    @gen_test(timeout=30)
+    @requires_full_stack(block_monitor=True)
+    async def test_create_transaction_skeleton_batch(self, *, monitor):
+
+        await self.faucet(TEST_ADDRESS, 10 * 10 ** 18)
+
+        resp = await self.fetch("/tx/skel/batch", method="POST", body={
+            "transactions": [
+                {"from": TEST_ADDRESS, "to": TEST_ADDRESS_2, "value": 10 ** 18},
+                {"from": TEST_ADDRESS, "to": "0x1234", "value": 10 ** 18},
+                {"from": TEST_ADDRESS, "to": TEST_ADDRESS_3, "value": 10 ** 18},
+                {"from": TEST_ADDRESS, "to": TEST_ADDRESS_4, "value": 10 ** 18}
+            ]
+        })
+        self.assertResponseCodeEqual(resp, 200, resp.body)
+        body = json_decode(resp.body)
+        self.assertEqual(len(body['transactions']), 4)
+        self.assertEqual(body['transactions'][1]['errors'][0]['id'], 'invalid_to_address')
+
+        # the failed request shouldn't leave a gap in the nonces
+        successful = [body['transactions'][i] for i in (0, 2, 3)]
+        self.assertEqual([parse_int(skel['nonce']) for skel in successful], [0, 1, 2])
+
+        for skel in successful:
+            tx_hash = await self.sign_and_send_tx(TEST_PRIVATE_KEY, skel['tx'])
+        await self.wait_on_tx_confirmation(tx_hash)
+
+    @gen_test(timeout=30)
+    @requires_full_stack(block_monitor=True)
+    async def test_create_transaction_skeleton_batch_same_sender_balance(self, *, monitor):
+
+        await self.faucet(TEST_ADDRESS, 10 * 10 ** 18)
+
+        resp = await self.fetch("/tx/skel/batch", method="POST", body={
+            "transactions": [
+                {"from": TEST_ADDRESS, "to": TEST_ADDRESS_2, "value": 4 * 10 ** 18},
+                {"from": TEST_ADDRESS, "to": TEST_ADDRESS_3, "value": 4 * 10 ** 18},
+                {"from": TEST_ADDRESS, "to": TEST_ADDRESS_4, "value": 4 * 10 ** 18},
+                {"from": TEST_ADDRESS, "to": TEST_ADDRESS_4, "value": "max"}
+            ]
+        })
+        self.assertResponseCodeEqual(resp, 200, resp.body)
+        body = json_decode(resp.body)
+        # the third transaction is more than what's left after the first two
+        self.assertEqual(body['transactions'][2]['errors'][0]['id'], 'insufficient_funds')
+
+        # "max" only gets what's left after the others
+        successful = [body['transactions'][i] for i in (0, 1, 3)]
+        self.assertEqual([parse_int(skel['nonce']) for skel in successful], [0, 1, 2])
+        self.assertEqual(sum(parse_int(skel['value']) + parse_int(skel['gas']) * parse_int(skel['gas_price'])
+                             for skel in successful), 10 * 10 ** 18)
+
+        for skel in successful:
+            tx_hash = await self.sign_and_send_tx(TEST_PRIVATE_KEY, skel['tx'])
+        await self.wait_on_tx_confirmation(tx_hash)
+
+    @gen_test(timeout=30)
+    @requires_full_stack(block_monitor=True)
+    async def test_create_transaction_skeleton_batch_sender_nonces(self, *, monitor):
+
+        await self.faucet(TEST_ADDRESS, 10 * 10 ** 18)
+        checksummed_address = checksum_encode_address(TEST_ADDRESS)
+
+        # different spellings of the same sender share the nonce counter
+        resp = await self.fetch("/tx/skel/batch", method="POST", body={
+            "transactions": [
+                {"from": TEST_ADDRESS, "to": TEST_ADDRESS_2, "value": 10 ** 18},
+                {"from": checksummed_address, "to": TEST_ADDRESS_3, "value": 10 ** 18}
+            ]
+        })
+        self.assertResponseCodeEqual(resp, 200, resp.body)
+        body = json_decode(resp.body)
+        self.assertEqual([parse_int(skel['nonce']) for skel in body['transactions']], [0, 1])
+
+        # explicit nonces aren't given out again
+        resp = await self.fetch("/tx/skel/batch", method="POST", body={
+            "transactions": [
+                {"from": checksummed_address, "to": TEST_ADDRESS_2, "value": 10 ** 18, "nonce": hex(1)},
+                {"from": TEST_ADDRESS, "to": TEST_ADDRESS_3, "value": 10 ** 18},
+                {"from": checksummed_address, "to": TEST_ADDRESS_4, "value": 10 ** 18}
+            ]
+        })
+        self.assertResponseCodeEqual(resp, 200, resp.body)
+        body = json_decode(resp.body)
+        self.assertEqual([parse_int(skel['nonce']) for skel in body['transactions']], [1, 2, 3])
+
+    @gen_test(timeout=30)
+    @requires_full_stack(block_monitor=True)
+    async def test_create_transaction_skeleton_checksummed_sender(self, *, monitor):
+
+        await self.faucet(TEST_ADDRESS, 10 * 10 ** 18)
+        checksummed_address = checksum_encode_address(TEST_ADDRESS)
+
+        resp = await self.fetch("/tx/skel", method="POST", body={
+            "from": checksummed_address,
+            "to": TEST_ADDRESS_2,
+            "value": 10 ** 18
+        })
+        self.assertResponseCodeEqual(resp, 200, resp.body)
+        body = json_decode(resp.body)
+        self.assertEqual(parse_int(body['nonce']), 0)
+        await self.sign_and_send_tx(TEST_PRIVATE_KEY, body['tx'])
+
+        # the nonce used by the sent transaction is accounted for no matter
+        # how the sender's address is written
+        for from_address in (checksummed_address, TEST_ADDRESS):
+            resp = await self.fetch("/tx/skel", method="POST", body={
+                "from": from_address,
+                "to": TEST_ADDRESS_2,
+                "value": 10 ** 18
+            })
+            self.assertResponseCodeEqual(resp, 200, resp.body)
+            self.assertEqual(parse_int(json_decode(resp.body)['nonce']), 1)
+
+    @gen_test(timeout=30)
+    @requires_full_stack
+    async def test_create_transaction_skeleton_batch_bad_arguments(self):
+
+        resp = await self.fetch("/tx/skel/batch", method="POST", body={
+            "transactions": {"from": TEST_ADDRESS, "to": TEST_ADDRESS_2, "value": 10 ** 18}
+        })
+        self.assertResponseCodeEqual(resp, 400, resp.body)
+
+        resp = await self.fetch("/tx/skel/batch", method="POST", body={
+            "transactions": [{"from": TEST_ADDRESS, "to": TEST_ADDRESS_2, "value": 10 ** 18}] * 101
+        })
+        self.assertResponseCodeEqual(resp, 400, resp.body)
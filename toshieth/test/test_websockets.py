@@ -1,3 +1,5 @@
+import aioredis
+import asyncio
 import os
 import time
 import random
@@ -6,9 +8,17 @@ from toshieth.test.base import EthServiceBaseTest, requires_full_stack
 from tornado.testing import gen_test
 from toshi.test.ethereum.faucet import FaucetMixin
 from toshi.ethereum.tx import sign_transaction, create_transaction, DEFAULT_STARTGAS, DEFAULT_GASPRICE, encode_transaction
-from toshi.ethereum.utils import data_encoder
+from toshi.ethereum.utils import data_encoder, decode_event_data
 from toshi.sofa import parse_sofa_message
 from toshi.jsonrpc.errors import JsonRPCError
+from toshi.config import config
+from toshi.redis import get_redis_connection
+from toshi.test.redis import requires_redis
+from tornado.escape import json_decode, json_encode
+from toshieth.subscriptions import WebsocketRegistry, websocket_registry
+from toshieth.tasks import eth_dispatcher, notification_channel
+import toshieth.websocket
+from toshieth.websocket import EthServiceWorker, WebsocketHandler, websocket_status
 
 from toshieth.test.test_transaction import (
     TEST_PRIVATE_KEY as TEST_ID_KEY,
@@ -28,9 +38,7 @@ class WebsocketTest(FaucetMixin, EthServiceBaseTest):
         ws_con = await self.websocket_connect(TEST_ID_KEY)
         await ws_con.call("subscribe", [TEST_ID_ADDRESS])
 
-        async with self.pool.acquire() as con:
-            row = await con.fetchrow("SELECT COUNT(*) FROM notification_registrations WHERE toshi_id = $1", TEST_ID_ADDRESS)
-        self.assertEqual(row['count'], 1)
+        self.assertTrue(await websocket_registry.has_subscribers(TEST_ID_ADDRESS))
 
         tx_hash = await self.faucet(TEST_ID_ADDRESS, val)
 
@@ -81,9 +89,7 @@ class WebsocketTest(FaucetMixin, EthServiceBaseTest):
         ws_con = await self.websocket_connect(None)
         await ws_con.call("subscribe", [TEST_ID_ADDRESS])
 
-        async with self.pool.acquire() as con:
-            row = await con.fetchrow("SELECT COUNT(*) FROM notification_registrations WHERE eth_address = $1", TEST_ID_ADDRESS)
-        self.assertEqual(row['count'], 1)
+        self.assertTrue(await websocket_registry.has_subscribers(TEST_ID_ADDRESS))
 
         tx_hash = await self.faucet(TEST_ID_ADDRESS, val)
 
@@ -328,3 +334,218 @@ class WebsocketTest(FaucetMixin, EthServiceBaseTest):
 
         with self.assertRaises(JsonRPCError):
             await ws_con.call("subscribe", "not an address")
+
+    @gen_test(timeout=30)
+    @requires_redis
+    async def test_notifications_reach_subscribed_processes(self):
+
+        # each worker stands in for a separate web process, with its own
+        # redis connections
+        connections = [await aioredis.create_redis_pool(config['redis']['url'], minsize=1, maxsize=2)
+                       for _ in range(2)]
+        workers = [EthServiceWorker(connection) for connection in connections]
+        for worker in workers:
+            await worker.work()
+        try:
+            received = asyncio.Queue()
+            await workers[1].subscribe(TEST_ID_ADDRESS, lambda *args: received.put_nowait(args))
+            await workers[1].filter("filter-1", lambda *args: received.put_nowait(args))
+            self.assertEqual(workers[0]._subscribed, set())
+
+            await eth_dispatcher.send_notification(TEST_ID_ADDRESS, "SOFA::Payment:{}")
+            self.assertEqual(await asyncio.wait_for(received.get(), 5), (TEST_ID_ADDRESS, "SOFA::Payment:{}"))
+            topic, data = "Transfer(address,address,uint256)", "0x" + "0" * 192
+            await eth_dispatcher.send_filter_notification("filter-1", topic, data)
+            self.assertEqual(await asyncio.wait_for(received.get(), 5), ("filter-1", topic, json_encode(decode_event_data(topic, data))))
+            # the decoded arguments are reused for the next delivery of the same log
+            self.assertIn((topic, data), workers[1]._event_arguments)
+
+            # the channels are subscribed to again after the pub/sub connection is dropped
+            await get_redis_connection().execute('CLIENT', 'KILL', 'TYPE', 'pubsub')
+            channel = notification_channel('transaction', TEST_ID_ADDRESS)
+            for _ in range(50):
+                await asyncio.sleep(0.1)
+                if channel in workers[1]._subscribed:
+                    break
+            self.assertIn(channel, workers[1]._subscribed)
+            await eth_dispatcher.send_notification(TEST_ID_ADDRESS, "SOFA::Payment:{}")
+            self.assertEqual(await asyncio.wait_for(received.get(), 5), (TEST_ID_ADDRESS, "SOFA::Payment:{}"))
+
+            # the shard's channel is dropped once nothing is subscribed to it
+            await workers[1].unsubscribe(TEST_ID_ADDRESS, workers[1].callbacks[TEST_ID_ADDRESS][0])
+            self.assertNotIn(channel, workers[1]._channel_keys)
+        finally:
+            for worker in workers:
+                await worker.shutdown()
+            for connection in connections:
+                connection.close()
+                await connection.wait_closed()
+
+    @gen_test(timeout=30)
+    @requires_redis
+    async def test_websocket_registry(self):
+
+        await websocket_registry.subscribe("session-1", [TEST_ID_ADDRESS, TEST_WALLET_ADDRESS])
+        self.assertTrue(await websocket_registry.has_subscribers(TEST_ID_ADDRESS))
+        await websocket_registry.unsubscribe("session-1", [TEST_ID_ADDRESS])
+        self.assertFalse(await websocket_registry.has_subscribers(TEST_ID_ADDRESS))
+        self.assertTrue(await websocket_registry.has_subscribers(TEST_WALLET_ADDRESS))
+
+        filter_id = await websocket_registry.add_filter("session-1", TEST_ID_ADDRESS, "0x01", "Transfer(address,address,uint256)")
+        # filtering the same thing again gives the same filter
+        self.assertEqual(await websocket_registry.add_filter("session-1", TEST_ID_ADDRESS, "0x01", "Transfer(address,address,uint256)"), filter_id)
+        self.assertEqual(await websocket_registry.get_filters(TEST_ID_ADDRESS, "0x01"), [(filter_id, "Transfer(address,address,uint256)")])
+        await websocket_registry.remove_filters("session-1", [filter_id])
+        self.assertEqual(await websocket_registry.get_filters(TEST_ID_ADDRESS, "0x01"), [])
+
+        # sessions that stop refreshing their subscriptions are ignored
+        await WebsocketRegistry(ttl=1).subscribe("session-2", [TEST_ID_ADDRESS])
+        await websocket_registry.subscribe("session-3", [TEST_ID_ADDRESS])
+        await asyncio.sleep(1.5)
+        self.assertTrue(await websocket_registry.has_subscribers(TEST_ID_ADDRESS))
+        await websocket_registry.unsubscribe("session-3", [TEST_ID_ADDRESS])
+        self.assertFalse(await websocket_registry.has_subscribers(TEST_ID_ADDRESS))
+
+    @gen_test(timeout=30)
+    @requires_full_stack
+    async def test_websocket_status(self):
+
+        ws_con = await self.websocket_connect(TEST_ID_KEY)
+        await ws_con.call("subscribe", [TEST_ID_ADDRESS])
+
+        resp = await self.fetch("/status/websockets")
+        self.assertEqual(resp.code, 200)
+        body = json_decode(resp.body)
+        self.assertEqual(body['connections'], 1)
+        self.assertEqual(body['queued_notifications'], 0)
+        self.assertEqual(body['dropped_clients'], 0)
+
+class QueueingWebsocket(WebsocketHandler):
+    """Stands in for an open websocket connection, recording the frames
+    written to it. While `block_writes` is set writes don't complete until
+    `finish_write` is called"""
+
+    def __init__(self):
+        # skip the request handler setup
+        self.ws_connection = True
+        self.frames = []
+        self.closed = None
+        self.block_writes = False
+        self._write_future = None
+        self.open()
+
+    def write_message(self, message, binary=False):
+        self.frames.append(message)
+        if self.block_writes:
+            self._write_future = asyncio.get_event_loop().create_future()
+            return self._write_future
+
+    async def finish_write(self):
+        self._write_future.set_result(None)
+        # let the done callbacks run
+        await asyncio.sleep(0)
+
+    def close(self, code=None, reason=None):
+        self.closed = code
+        self.ws_connection = None
+
+    def disconnect(self):
+        self.io_loop.remove_timeout(self._pingcb)
+        toshieth.websocket._open_websockets.discard(self)
+
+class WebsocketQueueTest(EthServiceBaseTest):
+
+    def setUp(self):
+        super().setUp()
+        self.dropped_clients = toshieth.websocket._dropped_clients
+
+    def tearDown(self):
+        toshieth.websocket._dropped_clients = self.dropped_clients
+        if 'websocket' in config:
+            del config['websocket']
+        super().tearDown()
+
+    def create_websocket(self):
+        ws = QueueingWebsocket()
+        self.addCleanup(ws.disconnect)
+        return ws
+
+    def send_notifications(self, ws, *messages):
+        for message in messages:
+            ws.send_transaction_notification(TEST_ID_ADDRESS, message)
+
+    @gen_test(timeout=10)
+    async def test_notifications_batched_while_writing(self):
+
+        ws = self.create_websocket()
+        ws.block_writes = True
+
+        # idle clients get notifications straight away
+        self.send_notifications(ws, "1")
+        self.assertEqual(len(ws.frames), 1)
+        self.assertEqual(json_decode(ws.frames[0])['params']['message'], "1")
+
+        # anything queued while the previous frame is being written is sent together
+        self.send_notifications(ws, "2", "3", "4")
+        self.assertEqual(len(ws.frames), 1)
+        status = websocket_status()
+        self.assertEqual(status['queued_notifications'], 3)
+        self.assertEqual(status['max_queue_depth'], 3)
+
+        await ws.finish_write()
+        self.assertEqual(len(ws.frames), 2)
+        batch = json_decode(ws.frames[1])
+        self.assertIsInstance(batch, list)
+        self.assertEqual([notification['params']['message'] for notification in batch], ["2", "3", "4"])
+        self.assertEqual(websocket_status()['queued_notifications'], 0)
+
+        await ws.finish_write()
+        self.send_notifications(ws, "5")
+        self.assertEqual(len(ws.frames), 3)
+        self.assertEqual(json_decode(ws.frames[2])['params']['message'], "5")
+        self.assertIsNone(ws.closed)
+
+    @gen_test(timeout=10)
+    async def test_slow_clients_dropped(self):
+
+        config['websocket'] = {'max_queue_size': '2'}
+        ws = self.create_websocket()
+        ws.block_writes = True
+
+        self.send_notifications(ws, "1", "2", "3")
+        self.assertIsNone(ws.closed)
+        self.send_notifications(ws, "4")
+        self.assertEqual(ws.closed, 1008)
+        self.assertEqual(len(ws.outbound), 0)
+        self.assertEqual(websocket_status()['dropped_clients'], self.dropped_clients + 1)
+
+        config['websocket'] = {'max_lag': '0.1'}
+        ws = self.create_websocket()
+        ws.block_writes = True
+
+        self.send_notifications(ws, "1", "2")
+        await asyncio.sleep(0.2)
+        self.assertIsNone(ws.closed)
+        self.send_notifications(ws, "3")
+        self.assertEqual(ws.closed, 1008)
+        self.assertEqual(len(ws.frames), 1)
+        self.assertEqual(websocket_status()['dropped_clients'], self.dropped_clients + 2)
+
+    @gen_test(timeout=10)
+    async def test_flush_window(self):
+
+        config['websocket'] = {'flush_window': '0.1'}
+        ws = self.create_websocket()
+
+        self.send_notifications(ws, "1", "2", "3")
+        self.assertEqual(len(ws.frames), 0)
+        await asyncio.sleep(0.2)
+        self.assertEqual(len(ws.frames), 1)
+        batch = json_decode(ws.frames[0])
+        self.assertEqual([notification['params']['message'] for notification in batch], ["1", "2", "3"])
+
+        # a single notification in the window is sent on its own
+        self.send_notifications(ws, "4")
+        await asyncio.sleep(0.2)
+        self.assertEqual(len(ws.frames), 2)
+        self.assertEqual(json_decode(ws.frames[1])['params']['message'], "4")
@@ -40,7 +40,7 @@ def database_transaction_to_rlp_transaction(transaction):
 
     tx = create_transaction(nonce=nonce, gasprice=gas_price, startgas=gas,
                             to=transaction['to_address'], value=value,
-                            data=data_decoder(transaction['data']),
+                            data=data_decoder(transaction['data']) if transaction['data'] else b'',
                             v=parse_int(transaction['v']),
                             r=parse_int(transaction['r']),
                             s=parse_int(transaction['s']))
@@ -1,8 +1,10 @@
 import asyncio
+import collections
 import os
 import uuid
 import time
 import traceback
+import weakref
 
 import tornado.ioloop
 import tornado.websocket
@@ -10,9 +12,9 @@ import tornado.web
 
 from datetime import datetime
 from toshi.database import DatabaseMixin
-from toshi.handlers import RequestVerificationMixin
+from toshi.handlers import BaseHandler, RequestVerificationMixin
 from toshi.utils import validate_address, validate_hex_string
-from trq.worker import Worker
+from aioredis.pubsub import Receiver
 from toshi.redis import get_redis_connection
 from toshi.sofa import SofaPayment
 from toshi.utils import parse_int
@@ -21,8 +23,46 @@ from toshi.ethereum.mixin import EthereumMixin
 
 from toshi.config import config
 from toshi.log import log
+from tornado.escape import json_decode, json_encode
 from toshi.jsonrpc.errors import JsonRPCInvalidParamsError
 from .jsonrpc import ToshiEthJsonRPC
+from .cache import LRUCache
+from .subscriptions import websocket_registry
+from .tasks import notification_channel
+
+# notifications waiting to be sent to a client are capped at this many,
+# clients that fall further behind are disconnected
+DEFAULT_MAX_QUEUE_SIZE = 1000
+# clients that haven't accepted a notification for this many seconds are
+# disconnected
+DEFAULT_MAX_LAG = 30
+# how long notifications are held back so they can be sent together. when 0
+# notifications are only merged while the client is still receiving the
+# previous frame
+DEFAULT_FLUSH_WINDOW = 0
+
+def get_websocket_setting(name, default):
+    if 'websocket' in config:
+        return config['websocket'].getfloat(name, default)
+    return default
+
+# the open websocket connections of this process, for the status endpoint
+_open_websockets = weakref.WeakSet()
+_dropped_clients = 0
+
+def websocket_status():
+    depths = [len(ws.outbound) for ws in _open_websockets]
+    return {
+        "connections": len(depths),
+        "queued_notifications": sum(depths),
+        "max_queue_depth": max(depths, default=0),
+        "dropped_clients": _dropped_clients
+    }
+
+class WebsocketStatusHandler(BaseHandler):
+
+    def get(self):
+        self.write(websocket_status())
 
 class WebsocketJsonRPCHandler(ToshiEthJsonRPC):
 
@@ -156,12 +196,22 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler, DatabaseMixin, Ethere
 
         self.session_id = uuid.uuid4().hex
         self.io_loop = tornado.ioloop.IOLoop.current()
+        self.outbound = collections.deque()
+        # when the oldest notification in the outbound queue was queued
+        self._outbound_since = None
+        self._writing = None
+        self._flush_handle = None
+        _open_websockets.add(self)
         self.schedule_ping()
 
     def on_close(self):
+        _open_websockets.discard(self)
         if hasattr(self, '_pingcb'):
             self.io_loop.remove_timeout(self._pingcb)
-        self.io_loop.add_callback(self.unsubscribe, self.subscription_ids)
+        if getattr(self, '_flush_handle', None) is not None:
+            self.io_loop.remove_timeout(self._flush_handle)
+            self._flush_handle = None
+        self.io_loop.add_callback(self.unsubscribe, list(self.subscription_ids))
         self.io_loop.add_callback(self.remove_filters, list(self.filter_ids))
 
     def schedule_ping(self):
@@ -175,11 +225,19 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler, DatabaseMixin, Ethere
 
     def on_pong(self, data):
         self.schedule_ping()
+        # keep the session's subscriptions alive while the connection is
+        self.io_loop.add_callback(self.refresh_subscriptions)
+
+    async def refresh_subscriptions(self):
+        try:
+            await websocket_registry.refresh(self.session_id)
+        except:
+            log.exception("Error refreshing websocket subscriptions")
 
     async def _on_message(self, message):
         try:
-            response = await WebsocketJsonRPCHandler(
-                self.user_toshi_id, self.application, self)(message)
+            async with WebsocketJsonRPCHandler(self.user_toshi_id, self.application, self) as rpc:
+                response = await rpc(message)
             if response:
                 self.write_message(response)
         except:
@@ -192,155 +250,331 @@ class WebsocketHandler(tornado.websocket.WebSocketHandler, DatabaseMixin, Ethere
         tornado.ioloop.IOLoop.current().add_callback(self._on_message, message)
 
     async def subscribe(self, addresses):
-        async with self.db.acquire() as db:
-            for address in addresses:
-                await db.execute(
-                    "INSERT INTO notification_registrations (toshi_id, service, registration_id, eth_address) "
-                    "VALUES ($1, $2, $3, $4) ON CONFLICT (toshi_id, service, registration_id, eth_address) DO NOTHING",
-                    self.user_toshi_id, 'ws', self.session_id, address)
-            await db.commit()
+        await websocket_registry.subscribe(self.session_id, addresses)
 
         for address in addresses:
-            self.application.worker.subscribe(
+            await self.application.worker.subscribe(
                 address, self.send_transaction_notification)
         self.subscription_ids.update(addresses)
 
     async def unsubscribe(self, addresses):
         self.subscription_ids.difference_update(addresses)
-        async with self.db.acquire() as db:
-            for address in addresses:
-                await db.execute(
-                    "DELETE FROM notification_registrations WHERE toshi_id = $1 AND service = $2 AND registration_id = $3 AND eth_address = $4",
-                    self.user_toshi_id, 'ws', self.session_id, address)
-            await db.commit()
+        await websocket_registry.unsubscribe(self.session_id, addresses)
         for address in addresses:
-            self.application.worker.unsubscribe(
+            await self.application.worker.unsubscribe(
                 address, self.send_transaction_notification)
 
-    def send_transaction_notification(self, subscription_id, message):
+    def queue_notification(self, notification):
+        """queues the given serialized notification to be sent to the client.
+
+        Notifications that queue up while the client is still receiving
+        earlier ones are sent together as a single json rpc batch, and the
+        client is disconnected if it falls too far behind"""
+
         # make sure things are still connected
         if self.ws_connection is None:
             return
 
-        self.write_message({
+        if self.outbound and (
+                len(self.outbound) >= get_websocket_setting('max_queue_size', DEFAULT_MAX_QUEUE_SIZE) or
+                time.time() - self._outbound_since > get_websocket_setting('max_lag', DEFAULT_MAX_LAG)):
+            self.drop_client()
+            return
+
+        if not self.outbound:
+            self._outbound_since = time.time()
+        self.outbound.append(notification)
+        if self._writing is None and self._flush_handle is None:
+            flush_window = get_websocket_setting('flush_window', DEFAULT_FLUSH_WINDOW)
+            if flush_window > 0:
+                self._flush_handle = self.io_loop.call_later(flush_window, self.flush_notifications)
+            else:
+                self.flush_notifications()
+
+    def flush_notifications(self):
+        self._flush_handle = None
+        if not self.outbound or self.ws_connection is None:
+            return
+        if len(self.outbound) == 1:
+            frame = self.outbound.popleft()
+        else:
+            frame = "[{}]".format(",".join(self.outbound))
+            self.outbound.clear()
+        self._outbound_since = None
+        try:
+            future = self.write_message(frame)
+        except tornado.websocket.WebSocketClosedError:
+            return
+        if future is not None and not future.done():
+            # hold on to anything else until the client has received this
+            self._writing = future
+            future.add_done_callback(self._on_notifications_written)
+
+    def _on_notifications_written(self, future):
+        self._writing = None
+        if self.outbound:
+            self.flush_notifications()
+
+    def drop_client(self):
+        global _dropped_clients
+        _dropped_clients += 1
+        log.warning("Disconnecting websocket session {} with {} queued notifications".format(
+            self.session_id, len(self.outbound)))
+        self.outbound.clear()
+        self._outbound_since = None
+        self.close(1008, "Too far behind")
+
+    def send_transaction_notification(self, subscription_id, message):
+        self.queue_notification(json_encode({
             "jsonrpc": "2.0",
             "method": "subscription",
             "params": {
                 "subscription": subscription_id,
                 "message": message
             }
-        })
+        }))
 
     async def filter(self, contract_address, topic_id, topic):
-        new_filter_id = uuid.uuid4().hex
-        async with self.db.acquire() as db:
-            filter_id = await db.fetchval(
-                "INSERT INTO filter_registrations (filter_id, registration_id, contract_address, topic_id, topic) "
-                "VALUES ($1, $2, $3, $4, $5) ON CONFLICT (registration_id, contract_address, topic_id) "
-                "DO UPDATE SET registration_id = EXCLUDED.registration_id "
-                "RETURNING filter_id",
-                new_filter_id, self.session_id, contract_address, topic_id, topic)
-            if new_filter_id == filter_id:
-                await db.commit()
-                self.filter_ids.add(filter_id)
-        self.application.worker.filter(
+        filter_id = await websocket_registry.add_filter(self.session_id, contract_address, topic_id, topic)
+        self.filter_ids.add(filter_id)
+        await self.application.worker.filter(
             filter_id, self.send_filter_notification)
         return filter_id
 
     async def remove_filters(self, filter_ids):
-        if not isinstance(filter_ids, list):
+        if isinstance(filter_ids, (list, tuple, set)):
+            filter_ids = list(filter_ids)
+        else:
             filter_ids = [filter_ids]
-        async with self.db.acquire() as db:
-            await db.execute(
-                "DELETE FROM filter_registrations WHERE filter_id = ANY($1) AND registration_id = $2",
-                filter_ids, self.session_id)
-            await db.commit()
+        self.filter_ids.difference_update(filter_ids)
+        await websocket_registry.remove_filters(self.session_id, filter_ids)
 
         for filter_id in filter_ids:
-            self.application.worker.remove_filter(
+            await self.application.worker.remove_filter(
                 filter_id, self.send_filter_notification)
 
-    def send_filter_notification(self, filter_id, topic, data):
+    def send_filter_notification(self, filter_id, topic, arguments):
         # make sure things are still connected
         if self.ws_connection is None:
             return
 
-        args = decode_event_data(topic, data)
+        # the arguments are already decoded and serialized by the worker
+        self.queue_notification(
+            '{{"jsonrpc": "2.0", "method": "filter", "params": {{"filter_id": {}, "topic": {}, "arguments": {}}}}}'.format(
+                json_encode(filter_id), json_encode(topic), arguments))
 
-        self.write_message({
-            "jsonrpc": "2.0",
-            "method": "filter",
-            "params": {
-                "filter_id": filter_id,
-                "topic": topic,
-                "arguments": args
-            }
-        })
+# number of decoded (topic, data) pairs each worker keeps
+EVENT_ARGUMENTS_CACHE_SIZE = 1000
+# how long to wait between attempts to subscribe to the notification
+# channels again after losing the pub/sub connection
+WORKER_RESUBSCRIBE_DELAY = 1
 
-class WebsocketNotificationHandler:
+class EthServiceWorker:
+    """Delivers the notifications sent by `eth_dispatcher` to the callbacks
+    registered by this process's websocket connections.
 
-    def __init__(self, task_id, worker):
-        self.worker = worker
+    Only the pub/sub channels of the notification shards that have
+    registered callbacks are subscribed to, so each process only receives
+    a fraction of all notifications. If the pub/sub connection is lost the
+    channels are subscribed to again, retrying until redis is reachable"""
 
-    async def send_notification(self, subscription_id, message):
-        if subscription_id in self.worker.callbacks:
+    def __init__(self, connection=None):
+        self._connection = connection
+        self.callbacks = {}
+        self.filter_callbacks = {}
+        # number of addresses and filter ids with callbacks in each channel
+        self._channel_keys = collections.Counter()
+        self._subscribed = set()
+        self._receiver = None
+        self._reader = None
+        self._resubscriber = None
+        self._lock = asyncio.Lock()
+        # the same log is delivered once for every filter matching it, so
+        # decoded event arguments are kept around for the next delivery
+        self._event_arguments = LRUCache(EVENT_ARGUMENTS_CACHE_SIZE)
+
+    @property
+    def connection(self):
+        return self._connection or get_redis_connection()
+
+    def decode_event_arguments(self, topic, data):
+        """returns the json serialized arguments of the event, decoding them
+        only the first time the (topic, data) pair is seen"""
+
+        key = (topic, data)
+        arguments = self._event_arguments.get(key)
+        if arguments is None:
+            arguments = json_encode(decode_event_data(topic, data))
+            self._event_arguments.set(key, arguments)
+        return arguments
+
+    def work(self):
+        # the receiver isn't stopped when all its channels are closed, so
+        # it can be reused after unsubscribing from everything or losing
+        # the connection
+        self._receiver = Receiver(on_close=self._on_channel_closed)
+        self._reader = asyncio.get_event_loop().create_task(self._read())
+        return self._sync_channels(list(self._channel_keys))
+
+    async def shutdown(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        if self._resubscriber is not None:
+            self._resubscriber.cancel()
+            self._resubscriber = None
+        # stops channels closed by unsubscribing from being resubscribed to
+        receiver, self._receiver = self._receiver, None
+        async with self._lock:
+            if self._subscribed:
+                try:
+                    await self.connection.unsubscribe(*self._subscribed)
+                except:
+                    log.exception("Error unsubscribing from notification channels")
+            self._subscribed = set()
+        if receiver is not None:
+            receiver.stop()
+
+    async def _read(self):
+        receiver = self._receiver
+        while True:
+            try:
+                # only ends once the receiver is stopped
+                async for _, message in receiver.iter():
+                    await self._notify(message)
+                return
+            except asyncio.CancelledError:
+                raise
+            except:
+                log.exception("Error reading notifications")
+                await asyncio.sleep(1)
+
+    def _on_channel_closed(self, sender, exc=None):
+        channel = sender.name.decode('utf-8') if isinstance(sender.name, bytes) else sender.name
+        if self._channel_keys[channel] <= 0:
+            # unsubscribed from on purpose
+            return
+        # the pub/sub connection was lost
+        self._subscribed.discard(channel)
+        if self._resubscriber is None and self._receiver is not None:
+            log.warning("Lost subscription to notification channel {}, resubscribing".format(channel))
+            self._resubscriber = asyncio.get_event_loop().create_task(self._resubscribe())
+
+    async def _resubscribe(self):
+        try:
+            while True:
+                await asyncio.sleep(WORKER_RESUBSCRIBE_DELAY)
+                await self._do_sync_channels(list(self._channel_keys))
+                if all(channel in self._subscribed for channel in self._channel_keys):
+                    return
+        finally:
+            self._resubscriber = None
+
+    async def _notify(self, message):
+        try:
+            notification = json_decode(message)
+        except:
+            log.exception("Invalid notification: {}".format(message))
+            return
+        if notification.get('type') == 'transaction':
+            subscription_id = notification['subscription_id']
+            message = notification['message']
             # ignore TokenPayments sent to websockets for now
             # as it currently breaks bots
             if message.startswith("SOFA::TokenPayment:"):
                 return
-            for callback in self.worker.callbacks[subscription_id]:
-                try:
-                    f = callback(subscription_id, message)
-                    if asyncio.iscoroutine(f):
-                        await f
-                except:
-                    traceback.print_exc()
+            for callback in list(self.callbacks.get(subscription_id, [])):
+                await self._call(callback, subscription_id, message)
+        elif notification.get('type') == 'filter':
+            filter_id = notification['filter_id']
+            callbacks = list(self.filter_callbacks.get(filter_id, []))
+            if not callbacks:
+                return
+            topic = notification['topic']
+            try:
+                arguments = self.decode_event_arguments(topic, notification['data'])
+            except:
+                log.exception("Error decoding event data for topic '{}': {}".format(topic, notification['data']))
+                return
+            for callback in callbacks:
+                await self._call(callback, filter_id, topic, arguments)
 
-    async def send_filter_notification(self, filter_id, topic, data):
-        if filter_id in self.worker.filter_callbacks:
-            for callback in self.worker.filter_callbacks[filter_id]:
-                try:
-                    f = callback(filter_id, topic, data)
-                    if asyncio.iscoroutine(f):
-                        await f
-                except:
-                    traceback.print_exc()
+    async def _call(self, callback, *args):
+        try:
+            f = callback(*args)
+            if asyncio.iscoroutine(f):
+                await f
+        except:
+            traceback.print_exc()
 
-class EthServiceWorker(Worker):
-    def __init__(self):
-        super().__init__([(WebsocketNotificationHandler, self)],
-                         queue_name="ethservice")
+    def _sync_channels(self, channels):
+        """subscribes to or unsubscribes from the given channels depending on
+        whether any callbacks are still registered for them. returns a future
+        that completes once redis has been updated"""
 
-        self.callbacks = {}
-        self.filter_callbacks = {}
+        return asyncio.get_event_loop().create_task(self._do_sync_channels(channels))
 
-    @property
-    def connection(self):
-        return get_redis_connection()
+    async def _do_sync_channels(self, channels):
+        if self._receiver is None:
+            # not started yet, `work` will subscribe
+            return
+        async with self._lock:
+            subscribe = [channel for channel in channels
+                         if self._channel_keys[channel] > 0 and channel not in self._subscribed]
+            unsubscribe = [channel for channel in channels
+                           if self._channel_keys[channel] <= 0 and channel in self._subscribed]
+            try:
+                if subscribe:
+                    await self.connection.subscribe(*[self._receiver.channel(channel) for channel in subscribe])
+                    self._subscribed.update(subscribe)
+                if unsubscribe:
+                    await self.connection.unsubscribe(*unsubscribe)
+                    self._subscribed.difference_update(unsubscribe)
+            except:
+                log.exception("Error updating notification channel subscriptions")
+
+    def _add_callback(self, callbacks, kind, key, callback):
+        if key not in callbacks:
+            callbacks[key] = []
+            channel = notification_channel(kind, key)
+            self._channel_keys[channel] += 1
+        else:
+            channel = None
+        if callback not in callbacks[key]:
+            callbacks[key].append(callback)
+        return self._sync_channels([channel] if channel else [])
+
+    def _remove_callback(self, callbacks, kind, key, callback):
+        if key in callbacks and callback in callbacks[key]:
+            callbacks[key].remove(callback)
+            if not callbacks[key]:
+                callbacks.pop(key)
+                channel = notification_channel(kind, key)
+                self._channel_keys[channel] -= 1
+                if self._channel_keys[channel] <= 0:
+                    del self._channel_keys[channel]
+                return self._sync_channels([channel])
+        return self._sync_channels([])
 
     def subscribe(self, eth_address, callback):
         """Registers a callback to receive transaction notifications for the
-        given toshi identifier.
+        given eth address.
 
-        The callback must accept 2 parameters, the transaction dict, and the
-        sender's toshi identifier"""
-        callbacks = self.callbacks.setdefault(eth_address, [])
-        if callback not in callbacks:
-            callbacks.append(callback)
+        The callback must accept 2 parameters, the eth address and the
+        notification message. Returns a future that completes once this
+        process is receiving the address's notifications"""
+        return self._add_callback(self.callbacks, 'transaction', eth_address, callback)
 
     def unsubscribe(self, eth_address, callback):
-        if eth_address in self.callbacks and callback in self.callbacks[eth_address]:
-            self.callbacks[eth_address].remove(callback)
-            if not self.callbacks[eth_address]:
-                self.callbacks.pop(eth_address)
+        return self._remove_callback(self.callbacks, 'transaction', eth_address, callback)
 
     def filter(self, filter_id, callback):
-        callbacks = self.filter_callbacks.setdefault(filter_id, [])
-        if callback not in callbacks:
-            callbacks.append(callback)
+        """Registers a callback to receive the events matching the given
+        filter.
+
+        The callback must accept 3 parameters, the filter id, the event's
+        topic and the event's arguments serialized as json"""
+        return self._add_callback(self.filter_callbacks, 'filter', filter_id, callback)
 
     def remove_filter(self, filter_id, callback):
-        if filter_id in self.filter_callbacks and callback in self.filter_callbacks[filter_id]:
-            self.filter_callbacks[filter_id].remove(callback)
-            if not self.filter_callbacks[filter_id]:
-                self.filter_callbacks.pop(filter_id)
+        return self._remove_callback(self.filter_callbacks, 'filter', filter_id, callback)